@@ -0,0 +1,112 @@
+# Ingest benchmark: generates synthetic CMS-shaped files (bench/synth.py) at the chosen row count(s), runs the full
+# build pipeline on them offline (npi_csv_file_get.py, npi_csv_pecos_get.py, npi_csv_weekly_get.py, all with --archive)
+# into a fresh database, and reports per builder rows/s, MB/s, peak RSS, final database size and per-index build times.
+#   python bench/ingest.py --rows 100000 1000000 --weeks 1 --changes 20000
+#   python bench/ingest.py --rows 100000 --baseline bench/results/ingest-20241013-101500.json
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import argparse
+import subprocess
+import synth
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+
+# Run one builder on a fresh --report file; returns its report plus wall time and peak RSS (MB) of the builder process.
+def run_builder(script, archives, db_path, report_path):
+    env = dict(os.environ, NPI_DB=db_path)
+    command = [sys.executable, os.path.join(ROOT, script), '--report', report_path, '--archive'] + archives
+    print("\n----------- " + script + " " + " ".join(os.path.basename(archive) for archive in archives) + " -----------")
+    st = time.time()
+    builder = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    # wait4 gives this child's own resource usage; ru_maxrss is in KiB on Linux.
+    pid, status, usage = os.wait4(builder.pid, 0)
+    builder.returncode = os.waitstatus_to_exitcode(status)
+    if builder.returncode != 0:
+        sys.exit(script + " failed with status " + str(builder.returncode))
+    with open(report_path) as f:
+        report = json.load(f)
+    report['wall_seconds'] = round(time.time() - st, 2)
+    report['peak_rss_mb'] = round(usage.ru_maxrss / 1024, 1)
+    snapshot = report['snapshot']
+    report['db_mb'] = round(os.path.getsize(snapshot) / 1024 ** 2, 1)
+    report['index_files_mb'] = round(sum(os.path.getsize(path) for path in glob.glob(snapshot + '.*')) / 1024 ** 2, 1)
+    print("%s: %s s, peak RSS %s MB, database %s MB (+ %s MB index files)" % (script, report['wall_seconds'], report['peak_rss_mb'], report['db_mb'], report['index_files_mb']))
+    return report
+
+
+# Generate the files for rows NPIs and build them into a fresh database; returns the generation time and builder reports.
+def ingest(directory, rows, seed, weeks, changes):
+    shutil.rmtree(directory, ignore_errors=True)
+    st = time.time()
+    nppes_zip, pecos_csv = synth.write_files(directory, rows, seed)
+    weekly = synth.write_weekly_files(directory, rows, seed, weeks, changes)
+    result = {'rows': rows, 'generate_seconds': round(time.time() - st, 2),
+              'nppes_zip_mb': round(os.path.getsize(nppes_zip) / 1024 ** 2, 1), 'builds': {}}
+    db_path = os.path.join(directory, 'db', 'npi.db')
+    result['builds']['full'] = run_builder('npi_csv_file_get.py', [nppes_zip], db_path, os.path.join(directory, 'full_report.json'))
+    result['builds']['pecos'] = run_builder('npi_csv_pecos_get.py', [pecos_csv], db_path, os.path.join(directory, 'pecos_report.json'))
+    if weekly:
+        result['builds']['weekly'] = run_builder('npi_csv_weekly_get.py', weekly, db_path, os.path.join(directory, 'weekly_report.json'))
+    return result
+
+
+# Summary lines: load throughput, time, memory and size per builder, then index build times (vs the baseline run of the same size).
+def print_result(result, baseline=None):
+    print("\n=========== %s rows ===========" % result['rows'])
+    before = {}
+    for run in (baseline or []):
+        if run['rows'] == result['rows']:
+            before = run['builds']
+    print("%-8s %12s %9s %10s %12s %10s" % ('build', 'rows/s', 'MB/s', 'seconds', 'peak RSS MB', 'db MB'))
+    for name, report in result['builds'].items():
+        loads = [table for table in report['tables'].values() if 'rows_per_second' in table]
+        rows_per_second = round(sum(table['rows'] for table in loads) / max(sum(table['seconds'] for table in loads), 0.01))
+        mb_per_second = round(sum(table['bytes'] for table in loads) / 1024 ** 2 / max(sum(table['seconds'] for table in loads), 0.01), 1)
+        report['load_rows_per_second'] = rows_per_second
+        line = "%-8s %12s %9s %10s %12s %10s" % (name, rows_per_second, mb_per_second, report['seconds'], report['peak_rss_mb'], report['db_mb'])
+        if name in before:
+            line = line + "   rows/s %+.1f%%, time %+.1f%%, RSS %+.1f%% vs baseline" % (
+                (rows_per_second - before[name]['load_rows_per_second']) / before[name]['load_rows_per_second'] * 100,
+                (report['seconds'] - before[name]['seconds']) / max(before[name]['seconds'], 0.01) * 100,
+                (report['peak_rss_mb'] - before[name]['peak_rss_mb']) / before[name]['peak_rss_mb'] * 100)
+        print(line)
+    for name, report in result['builds'].items():
+        if report['indexes']:
+            print(name + " indexes: " + ", ".join("%s %ss" % (index, seconds) for index, seconds in report['indexes'].items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the database builders on synthetic NPPES/PECOS files, offline.")
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000], help="NPIs in the full file (one run per count)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--weeks', type=int, default=1, help="weekly update files applied after the full build (0: none)")
+    parser.add_argument('--changes', type=int, default=10000, help="NPIs changed per weekly file")
+    parser.add_argument('--dir', default=os.path.join(BENCH_DIR, 'data', 'ingest'), help="work directory (emptied for every run)")
+    parser.add_argument('--baseline', help="earlier results file to compare with")
+    parser.add_argument('--keep', action='store_true', help="keep the generated files and database of the last run")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['runs']
+    runs = []
+    for rows in args.rows:
+        result = ingest(args.dir, rows, args.seed, args.weeks, args.changes)
+        print_result(result, baseline)
+        runs.append(result)
+    if not args.keep:
+        shutil.rmtree(args.dir, ignore_errors=True)
+
+    os.makedirs(os.path.join(BENCH_DIR, 'results'), exist_ok=True)
+    out = os.path.join(BENCH_DIR, 'results', 'ingest-' + time.strftime('%Y%m%d-%H%M%S') + '.json')
+    with open(out, 'w') as f:
+        json.dump({'settings': vars(args), 'runs': runs}, f, indent=2)
+    print("\nResults written to " + out)
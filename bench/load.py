@@ -0,0 +1,160 @@
+# Load driver: posts a reproducible mix of /npi_check, /phone_check and /doc_check requests to a running app and
+# reports throughput and p50/p95/p99 latency per route, for the online (stub APIs up) and/or fallback (stub APIs down) mode.
+# Queries are sampled (seeded) from the same database the app serves.
+#   python bench/load.py --url http://127.0.0.1:8080 --db bench/data/db/npi.db --modes online fallback --out results.json
+import os
+import json
+import math
+import time
+import random
+import sqlite3
+import argparse
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Routes driven, with their share of the request mix.
+ROUTES = [('npi_check', 0.5), ('phone_check', 0.25), ('doc_check', 0.25)]
+
+# Stub control URLs (see stub_servers.py).
+CONTROLS = ['http://127.0.0.1:8081/_control', 'http://127.0.0.1:8082/_control']
+
+# One keep-alive session per driver thread.
+local = threading.local()
+
+
+# Sample count (form) queries per route from the database, the same ones for the same seed.
+def workload(db_path, count, seed):
+    rng = random.Random(seed)
+    con = sqlite3.connect(db_path)
+    low, high = con.execute("select min(npi), max(npi) from npi_lookup").fetchone()
+    queries = {'npi_check': [], 'phone_check': [], 'doc_check': []}
+    for i in range(count):
+        row = con.execute("select npi, last_name, first_name, practice_state, practice_phone from npi_lookup where npi >= ? limit 1",
+                          (rng.randint(low, high),)).fetchone()
+        npi, last_name, first_name, state, phone = row
+        queries['npi_check'].append({'NPINUMBER': str(npi)})
+        queries['phone_check'].append({'PHONENUMBER': phone or '2155551234'})
+        if last_name and first_name:
+            name = {'DOCTORNAME': first_name + ' ' + last_name}
+        else:
+            # Organization or deactivated NPI: search a common name instead.
+            name = {'DOCTORNAME': 'JOHN SMITH'}
+        if rng.random() < 0.5:
+            name['STATE'] = state or 'PA'
+        queries['doc_check'].append(name)
+    con.close()
+    return queries
+
+
+# The request mix: (route, form) pairs in a seeded random order.
+def request_mix(queries, count, seed):
+    rng = random.Random(seed)
+    routes = [route for route, share in ROUTES]
+    weights = [share for route, share in ROUTES]
+    positions = dict.fromkeys(routes, 0)
+    mix = []
+    for route in rng.choices(routes, weights, k=count):
+        mix.append((route, queries[route][positions[route] % len(queries[route])]))
+        positions[route] = positions[route] + 1
+    return mix
+
+
+def post(url, route, form):
+    session = getattr(local, 'session', None)
+    if session is None:
+        session = local.session = requests.Session()
+    st = time.perf_counter()
+    try:
+        response = session.post(url + '/' + route, data=form, timeout=120)
+        ok = response.status_code == 200
+    except requests.exceptions.RequestException:
+        ok = False
+    return route, time.perf_counter() - st, ok
+
+
+# Nearest-rank percentile of sorted values.
+def percentile(values, p):
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+
+
+# Run a request mix at concurrency; returns per route (and overall) throughput and latency percentiles in ms.
+def run(url, mix, concurrency, warmup=0):
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda item: post(url, item[0], item[1]), mix[:warmup]))
+        st = time.perf_counter()
+        results = list(pool.map(lambda item: post(url, item[0], item[1]), mix[warmup:]))
+        elapsed = time.perf_counter() - st
+    report = {}
+    for route in [route for route, share in ROUTES] + ['all']:
+        latencies = sorted(seconds for name, seconds, ok in results if route in (name, 'all'))
+        errors = sum(1 for name, seconds, ok in results if route in (name, 'all') and not ok)
+        if not latencies:
+            continue
+        report[route] = {'requests': len(latencies), 'errors': errors, 'rps': round(len(latencies) / elapsed, 2),
+                         'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2),
+                         'p50_ms': round(percentile(latencies, 50) * 1000, 2), 'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+                         'p99_ms': round(percentile(latencies, 99) * 1000, 2)}
+    return report
+
+
+# Switch the stub APIs up (online) or down (fallback).
+def set_mode(mode, controls=CONTROLS):
+    for control in controls:
+        requests.get(control, params={'outage': 1 if mode == 'fallback' else 0}, timeout=5).raise_for_status()
+
+
+def print_report(mode, report, baseline=None):
+    print("\n%-12s %9s %7s %9s %9s %9s %9s %9s" % (mode, 'requests', 'errors', 'req/s', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for route, stats in report.items():
+        line = "%-12s %9s %7s %9s %9s %9s %9s %9s" % (route, stats['requests'], stats['errors'], stats['rps'], stats['mean_ms'],
+                                                      stats['p50_ms'], stats['p95_ms'], stats['p99_ms'])
+        before = (baseline or {}).get(mode, {}).get(route)
+        if before:
+            line = line + "   p95 %+.1f%% vs baseline" % ((stats['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100)
+        print(line)
+
+
+# Drive every mode in turn; returns {mode: report}.
+def benchmark(url, db_path, modes, requests_count, concurrency, warmup, seed, controls=CONTROLS, baseline=None):
+    queries = workload(db_path, requests_count + warmup, seed)
+    results = {}
+    for mode in modes:
+        if controls:
+            set_mode(mode, controls)
+        results[mode] = run(url, request_mix(queries, requests_count + warmup, seed), concurrency, warmup)
+        print_report(mode, results[mode], baseline)
+    return results
+
+
+def load_baseline(path):
+    if not path:
+        return None
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Drive load against a running npi_app and report per-route latency percentiles.")
+    parser.add_argument('--url', default='http://127.0.0.1:8080', help="app base URL")
+    parser.add_argument('--db', default=os.path.join(BENCH_DIR, 'data', 'db', 'npi.db'), help="database the app serves (queries are sampled from it)")
+    parser.add_argument('--modes', nargs='+', default=['online', 'fallback'], choices=['online', 'fallback'])
+    parser.add_argument('--requests', type=int, default=500, help="measured requests per mode")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=20, help="requests sent (not measured) before each mode")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-control', action='store_true', help="do not switch the stub APIs between modes (e.g. against real APIs)")
+    parser.add_argument('--baseline', help="earlier --out file to compare p95 latencies with")
+    parser.add_argument('--out', help="write the results to this JSON file")
+    args = parser.parse_args()
+    results = benchmark(args.url, args.db, args.modes, args.requests, args.concurrency, args.warmup, args.seed,
+                        None if args.no_control else CONTROLS, load_baseline(args.baseline))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+        print("\nResults written to " + args.out)
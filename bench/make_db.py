@@ -0,0 +1,39 @@
+# Build a benchmark database from synthetic data with the real builders: writes the synthetic NPPES zip and PECOS CSV
+# (bench/synth.py), then runs npi_csv_file_get.py and npi_csv_pecos_get.py on them (--archive) against NPI_DB.
+#   python bench/make_db.py --providers 100000 --dir bench/data
+import os
+import sys
+import argparse
+import subprocess
+import synth
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+
+# Run one builder script with the database path set, stopping if it fails.
+def run_builder(script, archive, db_path, report):
+    env = dict(os.environ, NPI_DB=db_path)
+    command = [sys.executable, os.path.join(ROOT, script), '--archive', archive, '--report', report]
+    print("\n----------- " + " ".join(command[1:]) + " -----------")
+    if subprocess.call(command, cwd=ROOT, env=env) != 0:
+        sys.exit(script + " failed")
+
+
+def make_db(directory, providers, seed):
+    nppes_zip, pecos_csv = synth.write_files(directory, providers, seed)
+    db_path = os.path.join(directory, 'db', 'npi.db')
+    run_builder('npi_csv_file_get.py', nppes_zip, db_path, os.path.join(directory, 'build_report.json'))
+    run_builder('npi_csv_pecos_get.py', pecos_csv, db_path, os.path.join(directory, 'pecos_report.json'))
+    print("\nBenchmark database: " + db_path)
+    return db_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build a benchmark npi.db from synthetic NPPES/PECOS data.")
+    parser.add_argument('--providers', type=int, default=100000, help="number of NPIs")
+    parser.add_argument('--seed', type=int, default=1, help="random seed (same seed, same database)")
+    parser.add_argument('--dir', default=os.path.join(BENCH_DIR, 'data'), help="directory for the data files and db/npi.db")
+    args = parser.parse_args()
+    make_db(args.dir, args.providers, args.seed)
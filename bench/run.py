@@ -0,0 +1,91 @@
+# One-command, rerunnable benchmark: builds the synthetic database (once per --providers/--seed), starts the stub
+# NPPES/PECOS APIs and the app under waitress (as deployed), drives the online and fallback modes and writes the
+# results to bench/results/. Compare a change against an earlier run with --baseline.
+#   python bench/run.py --providers 100000 --requests 1000 --concurrency 8
+#   python bench/run.py --baseline bench/results/20241013-101500.json
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import requests
+import make_db
+import load
+from stub_servers import start_stubs
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+
+# Start the app under waitress against the benchmark database and stubs; returns the process once it answers.
+def start_app(db_path, port, threads, env_overrides, log_dir):
+    env = dict(os.environ, NPI_DB=db_path, NPPES_URL='http://127.0.0.1:8081/api/', PECOS_URL='http://127.0.0.1:8082/data',
+               NPI_LOG_FILE=os.path.join(log_dir, 'npi.log'))
+    env.update(env_overrides)
+    command = [sys.executable, '-m', 'waitress', '--listen=127.0.0.1:' + str(port), '--threads=' + str(threads), 'npi_app:npi_app']
+    app = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:' + str(port)
+    for i in range(100):
+        try:
+            requests.get(url + '/npi', timeout=1)
+            print("App listening on " + url)
+            return app, url
+        except requests.exceptions.ConnectionError:
+            if app.poll() is not None:
+                sys.exit("App exited with status " + str(app.returncode))
+            time.sleep(0.2)
+    app.terminate()
+    sys.exit("App did not start")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build, start and benchmark npi_app against local NPPES/PECOS stubs.")
+    parser.add_argument('--providers', type=int, default=100000, help="NPIs in the synthetic database")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=1000, help="measured requests per mode")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--modes', nargs='+', default=['online', 'fallback'], choices=['online', 'fallback'])
+    parser.add_argument('--latency', type=float, default=0.15, help="stub API latency (seconds)")
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--threads', type=int, default=8, help="waitress threads")
+    parser.add_argument('--no-cache', action='store_true', help="run the app without its NPPES/PECOS caches")
+    parser.add_argument('--env', nargs='*', default=[], help="extra NAME=value settings for the app, e.g. NPI_LOOKUP_WORKERS=32")
+    parser.add_argument('--baseline', help="earlier results file to compare p95 latencies with")
+    args = parser.parse_args()
+
+    data_dir = os.path.join(BENCH_DIR, 'data', '%s-%s' % (args.providers, args.seed))
+    db_path = os.path.join(data_dir, 'db', 'npi.db')
+    if not os.path.exists(db_path):
+        make_db.make_db(data_dir, args.providers, args.seed)
+
+    overrides = dict(setting.split('=', 1) for setting in args.env)
+    if args.no_cache:
+        overrides['NPI_CACHE_SIZE'] = '0'
+    # Short breaker cooldown so the app notices the stubs coming back between modes.
+    overrides.setdefault('NPI_BREAKER_COOLDOWN', '1')
+
+    stubs = start_stubs(db_path, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    app, url = start_app(db_path, args.port, args.threads, overrides, data_dir)
+    try:
+        results = {}
+        for mode in args.modes:
+            results.update(load.benchmark(url, db_path, [mode], args.requests, args.concurrency, args.warmup, args.seed,
+                                          baseline=load.load_baseline(args.baseline)))
+            # Let an open breaker cool down before the next mode.
+            time.sleep(1.5)
+    finally:
+        app.terminate()
+        app.wait()
+        for stub in stubs:
+            stub.shutdown()
+
+    os.makedirs(os.path.join(BENCH_DIR, 'results'), exist_ok=True)
+    out = os.path.join(BENCH_DIR, 'results', time.strftime('%Y%m%d-%H%M%S') + '.json')
+    with open(out, 'w') as f:
+        json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+    print("\nResults written to " + out)
@@ -0,0 +1,149 @@
+# Local stand-ins for the NPPES registry API and the PECOS data API, answering from a (benchmark) npi.db,
+# with configurable latency, error rate and outage. Point the app at them with
+#   NPPES_URL=http://127.0.0.1:8081/api/ PECOS_URL=http://127.0.0.1:8082/data
+# Settings can be changed while running: GET /_control?latency=0.2&jitter=0.05&error_rate=0.1&outage=1
+# (on either port; each server has its own) answers with the server's current settings.
+#   python bench/stub_servers.py --db bench/data/db/npi.db --latency 0.15
+import os
+import json
+import time
+import random
+import sqlite3
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qsl, quote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# One read-only connection per handler thread.
+local = threading.local()
+
+def query(db_path, sql, params=()):
+    con = getattr(local, 'con', None)
+    if con is None:
+        con = sqlite3.connect('file:' + quote(os.path.realpath(db_path)) + '?mode=ro', uri=True)
+        con.row_factory = sqlite3.Row
+        local.con = con
+    return con.execute(sql, params).fetchall()
+
+
+# NPPES registry API result for an npi_lookup row.
+def nppes_result(row):
+    def address(kind, purpose):
+        return {'address_purpose': purpose, 'address_type': 'DOM', 'country_code': 'US', 'country_name': 'United States',
+                'address_1': row[kind + '_address1'], 'address_2': row[kind + '_address2'], 'city': row[kind + '_city'],
+                'state': row[kind + '_state'], 'postal_code': row[kind + '_postal'],
+                'telephone_number': row[kind + '_phone'], 'fax_number': row[kind + '_fax']}
+    result = {'number': row['npi'], 'enumeration_type': 'NPI-1' if row['first_name'] else 'NPI-2',
+              'basic': {'first_name': row['first_name'], 'last_name': row['last_name'], 'middle_name': row['middle_name'],
+                        'credential': row['credential'], 'status': 'A'},
+              'addresses': [address('mail', 'MAILING'), address('practice', 'LOCATION')], 'taxonomies': []}
+    if not row['first_name']:
+        result['basic']['organization_name'] = row['organization_name']
+    if row['npi'] % 3 == 0:
+        result['endpoints'] = [{'endpointType': 'DIRECT', 'endpoint': str(row['npi']) + '@direct.example.org'}]
+    return result
+
+
+# NPPES registry API: ?number= lookups and last_name/first_name/state searches (limit, skip).
+def nppes_answer(db_path, path, params):
+    params = dict(params)
+    if params.get('number'):
+        rows = query(db_path, "select * from npi_lookup where npi=?", (params['number'],))
+    elif params.get('last_name'):
+        sql = "select * from npi_lookup where last_name=?"
+        args = [params['last_name'].upper()]
+        if params.get('first_name'):
+            sql = sql + " and first_name=?"
+            args.append(params['first_name'].upper())
+        if params.get('state'):
+            sql = sql + " and (mail_state=? or practice_state=?)"
+            args.extend([params['state'], params['state']])
+        rows = query(db_path, sql + " order by npi limit ? offset ?", args + [int(params.get('limit', 10)), int(params.get('skip', 0))])
+    else:
+        return {'Errors': [{'description': 'No valid search criteria provided'}]}
+    return {'result_count': len(rows), 'results': [nppes_result(row) for row in rows]}
+
+
+# PECOS data API: DME/NPI columns of the NPIs in the filter[NPI][condition][value][n] parameters.
+def pecos_answer(db_path, path, params):
+    npis = [int(value) for name, value in params if name.startswith('filter[NPI][condition][value]')]
+    if not npis:
+        return []
+    rows = query(db_path, "select [NPI], [DME] from pecos where [NPI] in (%s)" % ",".join("?" * len(npis)), npis)
+    return [{'NPI': str(row[0]), 'DME': row[1]} for row in rows]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real APIs (the app reuses pooled connections).
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qsl(url.query, keep_blank_values=True)
+        settings = self.server.settings
+        if url.path == '/_control':
+            for name, value in params:
+                if name in settings:
+                    settings[name] = float(value)
+            return self.send_json(200, settings)
+        self.server.requests = self.server.requests + 1
+        delay = settings['latency'] + random.uniform(-settings['jitter'], settings['jitter'])
+        if delay > 0:
+            time.sleep(delay)
+        if settings['outage']:
+            return self.send_json(503, {'error': self.server.name + ' stub outage'})
+        if random.random() < settings['error_rate']:
+            return self.send_json(500, {'error': self.server.name + ' stub error'})
+        self.send_json(200, self.server.answer(self.server.db_path, url.path, params))
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Start one stub server (in a daemon thread); returns the server.
+def start_stub(name, answer, port, db_path, latency=0.0, jitter=0.0, error_rate=0.0, outage=False):
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    server.name = name
+    server.answer = answer
+    server.db_path = db_path
+    server.requests = 0
+    server.settings = {'latency': latency, 'jitter': jitter, 'error_rate': error_rate, 'outage': 1.0 if outage else 0.0}
+    threading.Thread(target=server.serve_forever, name=name + '-stub', daemon=True).start()
+    print(name + " stub listening on http://127.0.0.1:" + str(server.server_address[1]) + " " + json.dumps(server.settings))
+    return server
+
+
+# Start the NPPES and PECOS stubs; returns both servers.
+def start_stubs(db_path, nppes_port=8081, pecos_port=8082, **settings):
+    return start_stub('NPPES', nppes_answer, nppes_port, db_path, **settings), start_stub('PECOS', pecos_answer, pecos_port, db_path, **settings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run local NPPES/PECOS API stubs for benchmarks.")
+    parser.add_argument('--db', default=os.path.join(BENCH_DIR, 'data', 'db', 'npi.db'), help="database to answer from (see make_db.py)")
+    parser.add_argument('--nppes-port', type=int, default=8081)
+    parser.add_argument('--pecos-port', type=int, default=8082)
+    parser.add_argument('--latency', type=float, default=0.15, help="seconds added to every answer")
+    parser.add_argument('--jitter', type=float, default=0.05, help="+/- seconds of random latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of calls answered with HTTP 500")
+    parser.add_argument('--outage', action='store_true', help="answer every call with HTTP 503")
+    args = parser.parse_args()
+    start_stubs(args.db, args.nppes_port, args.pecos_port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, outage=args.outage)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
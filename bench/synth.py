@@ -0,0 +1,337 @@
+# Synthetic NPPES/PECOS data files for benchmarks, laid out like the CMS downloads the builders read:
+# an NPPES dissemination zip (npidata_pfile + fileheader + pl_pfile CSVs), the PECOS Order and Referring CSV
+# and weekly update zips. The same seed always gives the same files.
+#   python bench/synth.py --providers 100000 --weeks 2 --dir bench/data
+import os
+import io
+import csv
+import random
+import itertools
+import argparse
+from datetime import date, timedelta
+from functools import lru_cache
+from zipfile import ZipFile, ZIP_DEFLATED
+
+
+# npidata_pfile columns, all 330 in the order of the real (V.2) file.
+NPPES_COLUMNS = [
+    'NPI', 'Entity Type Code', 'Replacement NPI', 'Employer Identification Number (EIN)',
+    'Provider Organization Name (Legal Business Name)', 'Provider Last Name (Legal Name)', 'Provider First Name',
+    'Provider Middle Name', 'Provider Name Prefix Text', 'Provider Name Suffix Text', 'Provider Credential Text',
+    'Provider Other Organization Name', 'Provider Other Organization Name Type Code', 'Provider Other Last Name',
+    'Provider Other First Name', 'Provider Other Middle Name', 'Provider Other Name Prefix Text',
+    'Provider Other Name Suffix Text', 'Provider Other Credential Text', 'Provider Other Last Name Type Code',
+    'Provider First Line Business Mailing Address', 'Provider Second Line Business Mailing Address',
+    'Provider Business Mailing Address City Name', 'Provider Business Mailing Address State Name',
+    'Provider Business Mailing Address Postal Code', 'Provider Business Mailing Address Country Code (If outside U.S.)',
+    'Provider Business Mailing Address Telephone Number', 'Provider Business Mailing Address Fax Number',
+    'Provider First Line Business Practice Location Address', 'Provider Second Line Business Practice Location Address',
+    'Provider Business Practice Location Address City Name', 'Provider Business Practice Location Address State Name',
+    'Provider Business Practice Location Address Postal Code',
+    'Provider Business Practice Location Address Country Code (If outside U.S.)',
+    'Provider Business Practice Location Address Telephone Number', 'Provider Business Practice Location Address Fax Number',
+    'Provider Enumeration Date', 'Last Update Date', 'NPI Deactivation Reason Code', 'NPI Deactivation Date',
+    'NPI Reactivation Date', 'Provider Gender Code', 'Authorized Official Last Name', 'Authorized Official First Name',
+    'Authorized Official Middle Name', 'Authorized Official Title or Position', 'Authorized Official Telephone Number',
+]
+for i in range(1, 16):
+    NPPES_COLUMNS.extend(['Healthcare Provider Taxonomy Code_%d' % i, 'Provider License Number_%d' % i,
+                          'Provider License Number State Code_%d' % i, 'Healthcare Provider Primary Taxonomy Switch_%d' % i])
+for i in range(1, 51):
+    NPPES_COLUMNS.extend(['Other Provider Identifier_%d' % i, 'Other Provider Identifier Type Code_%d' % i,
+                          'Other Provider Identifier State_%d' % i, 'Other Provider Identifier Issuer_%d' % i])
+NPPES_COLUMNS.extend(['Is Sole Proprietor', 'Is Organization Subpart', 'Parent Organization LBN', 'Parent Organization TIN',
+                      'Authorized Official Name Prefix Text', 'Authorized Official Name Suffix Text', 'Authorized Official Credential Text'])
+NPPES_COLUMNS.extend('Healthcare Provider Taxonomy Group_%d' % i for i in range(1, 16))
+NPPES_COLUMNS.append('Certification Date')
+
+# Position of each npidata_pfile column in a row.
+COLUMN = dict((column, i) for i, column in enumerate(NPPES_COLUMNS))
+
+# pl_pfile (secondary practice locations) columns.
+LOCATION_COLUMNS = [
+    'NPI', 'Provider Secondary Practice Location Address- Address Line 1',
+    'Provider Secondary Practice Location Address-  Address Line 2',
+    'Provider Secondary Practice Location Address - City Name', 'Provider Secondary Practice Location Address - State Name',
+    'Provider Secondary Practice Location Address - Postal Code',
+    'Provider Secondary Practice Location Address - Country Code (If outside U.S.)',
+    'Provider Secondary Practice Location Address - Telephone Number',
+    'Provider Secondary Practice Location Address - Telephone Extension', 'Provider Practice Location Address - Fax Number',
+]
+
+# PECOS Order and Referring columns.
+PECOS_COLUMNS = ['NPI', 'LAST_NAME', 'FIRST_NAME', 'PARTB', 'DME', 'HHA', 'PMD', 'HOSPICE']
+
+# Names, most common first: picks are skewed towards the front so common names (SMITH, JOHNSON) get many providers.
+LAST_NAMES = ('SMITH JOHNSON WILLIAMS BROWN JONES GARCIA MILLER DAVIS RODRIGUEZ MARTINEZ HERNANDEZ LOPEZ GONZALEZ WILSON '
+              'ANDERSON THOMAS TAYLOR MOORE JACKSON MARTIN LEE PEREZ THOMPSON WHITE HARRIS SANCHEZ CLARK RAMIREZ LEWIS '
+              'ROBINSON WALKER YOUNG ALLEN KING WRIGHT SCOTT TORRES NGUYEN HILL FLORES GREEN ADAMS NELSON BAKER HALL '
+              'RIVERA CAMPBELL MITCHELL CARTER ROBERTS PATEL SHAH KIM CHEN WANG SINGH KUMAR COHEN SCHWARTZ OBRIEN '
+              'MURPHY KELLY SULLIVAN BENNETT FOSTER GRAY JAMES REYES CRUZ HUGHES PRICE MYERS LONG ROSS MORALES '
+              'SCHMIDT MUELLER KOWALSKI NOWAK ROSSI RUSSO ESPOSITO OKAFOR ADEYEMI HASHEMI ABBASI TANAKA SATO').split()
+FIRST_NAMES = ('JAMES MARY JOHN PATRICIA ROBERT JENNIFER MICHAEL LINDA DAVID ELIZABETH WILLIAM BARBARA RICHARD SUSAN '
+               'JOSEPH JESSICA THOMAS SARAH CHARLES KAREN CHRISTOPHER LISA DANIEL NANCY MATTHEW BETTY ANTHONY MARGARET '
+               'MARK SANDRA STEVEN ASHLEY PAUL EMILY ANDREW DONNA JOSHUA MICHELLE KEVIN CAROL BRIAN AMANDA GEORGE '
+               'MELISSA EDWARD DEBORAH RAJ PRIYA WEI MEI AHMED FATIMA JUAN MARIA CARLOS ANA').split()
+MIDDLE_INITIALS = 'ABCDEFGHJKLMNPRSTW'
+CREDENTIALS = ['MD', 'M.D.', 'DO', 'NP', 'PA-C', 'RN', 'DDS', 'DPM', 'OD', 'PT', 'DC', 'MD, PHD', '']
+TAXONOMIES = ['207Q00000X', '207R00000X', '208D00000X', '363L00000X', '363A00000X', '1223G0001X', '213E00000X', '152W00000X']
+ORG_WORDS = ['HEALTH', 'MEDICAL', 'CARE', 'CLINIC', 'ASSOCIATES', 'PHARMACY', 'SUPPLY', 'HOME', 'REHAB', 'IMAGING']
+STREETS = ['MAIN ST', 'OAK AVE', 'MAPLE DR', 'PARK AVE', 'BROAD ST', 'MARKET ST', 'CENTER BLVD', 'RIVER RD', 'HILL ST', 'LAKE DR']
+
+# City, state, ZIP prefix and area codes.
+CITIES = [
+    ('PHILADELPHIA', 'PA', '191', ['215', '267']), ('PITTSBURGH', 'PA', '152', ['412']), ('NEW YORK', 'NY', '100', ['212', '646']),
+    ('BROOKLYN', 'NY', '112', ['718', '347']), ('LOS ANGELES', 'CA', '900', ['213', '310']), ('SAN DIEGO', 'CA', '921', ['619']),
+    ('HOUSTON', 'TX', '770', ['713', '281']), ('DALLAS', 'TX', '752', ['214', '972']), ('CHICAGO', 'IL', '606', ['312', '773']),
+    ('MIAMI', 'FL', '331', ['305', '786']), ('ORLANDO', 'FL', '328', ['407']), ('ATLANTA', 'GA', '303', ['404', '678']),
+    ('BOSTON', 'MA', '021', ['617']), ('SEATTLE', 'WA', '981', ['206']), ('DENVER', 'CO', '802', ['303', '720']),
+    ('PHOENIX', 'AZ', '850', ['602', '480']), ('DETROIT', 'MI', '482', ['313']), ('NEWARK', 'NJ', '071', ['973', '862']),
+]
+
+# Share of organizations, providers joining an existing group practice (same address and phone), deactivated NPIs,
+# providers with another (e.g. former) last name, with secondary practice locations, and individuals enrolled in PECOS.
+ORG_SHARE = 0.2
+GROUP_SHARE = 0.35
+DEACTIVATED_SHARE = 0.02
+OTHER_NAME_SHARE = 0.05
+LOCATION_SHARE = 0.1
+PECOS_SHARE = 0.4
+
+
+# Helper function for a random pick skewed towards the start of a list (Zipf-like weights 1/(rank+10)).
+@lru_cache(maxsize=None)
+def skew_weights(n):
+    return list(itertools.accumulate(1 / (i + 10) for i in range(n)))
+
+def skewed(rng, values):
+    return rng.choices(values, cum_weights=skew_weights(len(values)))[0]
+
+
+# Helper function for the check digit of a 9 digit NPI base (Luhn over the 80840 card issuer prefix, as CMS does).
+def npi_check_digit(base):
+    total = 24
+    for i, digit in enumerate(reversed(str(base))):
+        digit = int(digit)
+        if i % 2 == 0:
+            digit = digit * 2
+            if digit > 9:
+                digit = digit - 9
+        total = total + digit
+    return (10 - total % 10) % 10
+
+
+# Helper function for the ascending, valid NPIs of count providers.
+def npi_numbers(count, seed):
+    rng = random.Random(seed)
+    base = 100000000
+    npis = []
+    for i in range(count):
+        base = base + rng.randint(1, 40)
+        npis.append(base * 10 + npi_check_digit(base))
+    return npis
+
+
+def phone_number(rng, area_codes):
+    return rng.choice(area_codes) + str(rng.randint(200, 999)) + str(rng.randint(0, 9999)).zfill(4)
+
+
+def address(rng, city):
+    return [str(rng.randint(1, 9999)) + ' ' + rng.choice(STREETS), rng.choice(['', '', 'SUITE ' + str(rng.randint(100, 999))]),
+            city[0], city[1], city[2] + str(rng.randint(0, 99)).zfill(2) + str(rng.randint(0, 9999)).zfill(4), 'US']
+
+
+def us_date(rng, first_year, last_year):
+    return '%02d/%02d/%04d' % (rng.randint(1, 12), rng.randint(1, 28), rng.randint(first_year, last_year))
+
+
+# One provider: its npidata_pfile row (NPPES_COLUMNS order), pl_pfile rows and PECOS row (None if not enrolled).
+# practices collects group practices other providers can join.
+def provider(rng, npi, practices, first_year=2005, last_year=2024):
+    row = [''] * len(NPPES_COLUMNS)
+    def put(column, value):
+        row[COLUMN[column]] = value
+    put('NPI', str(npi))
+    enumerated = rng.randint(first_year, last_year - 1)
+    put('Provider Enumeration Date', us_date(rng, enumerated, enumerated))
+    put('Last Update Date', us_date(rng, enumerated + 1, last_year))
+    if rng.random() < DEACTIVATED_SHARE:
+        # NPPES publishes deactivated NPIs with everything but the NPI and dates blanked out.
+        put('NPI Deactivation Date', us_date(rng, enumerated + 1, last_year))
+        return row, [], None
+    if practices and rng.random() < GROUP_SHARE:
+        city, mail, practice, phone, fax = rng.choice(practices)
+    else:
+        city = skewed(rng, CITIES)
+        mail = address(rng, city)
+        practice = address(rng, city) if rng.random() < 0.5 else mail
+        phone = phone_number(rng, city[3])
+        fax = phone_number(rng, city[3]) if rng.random() < 0.7 else ''
+        practices.append((city, mail, practice, phone, fax))
+    pecos = None
+    if rng.random() < ORG_SHARE:
+        put('Entity Type Code', '2')
+        put('Provider Organization Name (Legal Business Name)', skewed(rng, LAST_NAMES) + ' ' + ' '.join(rng.sample(ORG_WORDS, 2)) + rng.choice([' LLC', ' INC', '']))
+        put('Employer Identification Number (EIN)', '<UNAVAIL>')
+        put('Authorized Official Last Name', skewed(rng, LAST_NAMES))
+        put('Authorized Official First Name', skewed(rng, FIRST_NAMES))
+        put('Authorized Official Title or Position', rng.choice(['OWNER', 'CEO', 'PRESIDENT', 'ADMINISTRATOR', 'OFFICE MANAGER']))
+        put('Authorized Official Telephone Number', phone)
+        put('Is Organization Subpart', 'Y' if rng.random() < 0.1 else 'N')
+    else:
+        put('Entity Type Code', '1')
+        put('Provider Last Name (Legal Name)', skewed(rng, LAST_NAMES))
+        put('Provider First Name', skewed(rng, FIRST_NAMES))
+        put('Provider Middle Name', rng.choice(MIDDLE_INITIALS) if rng.random() < 0.6 else '')
+        put('Provider Name Prefix Text', rng.choice(['DR.', '', '', '']))
+        put('Provider Credential Text', skewed(rng, CREDENTIALS))
+        put('Provider Gender Code', rng.choice('MF'))
+        put('Is Sole Proprietor', rng.choices(['N', 'Y', 'X'], [75, 15, 10])[0])
+        if rng.random() < OTHER_NAME_SHARE:
+            put('Provider Other Last Name', skewed(rng, LAST_NAMES))
+            put('Provider Other First Name', row[COLUMN['Provider First Name']])
+            put('Provider Other Last Name Type Code', '1')
+        if rng.random() < PECOS_SHARE:
+            pecos = [npi, row[COLUMN['Provider Last Name (Legal Name)']], row[COLUMN['Provider First Name']], 'Y',
+                     'Y' if rng.random() < 0.3 else 'N', rng.choice('YN'), rng.choice('YN'), rng.choice('NNY')]
+        # Other identifiers (Medicaid and payer IDs), most providers have none or a few.
+        for i in range(1, 1 + rng.choices([0, 1, 2, 3, 4], [55, 25, 10, 6, 4])[0]):
+            put('Other Provider Identifier_%d' % i, str(rng.randint(100000, 99999999)))
+            put('Other Provider Identifier Type Code_%d' % i, rng.choice(['05', '01', '01']))
+            put('Other Provider Identifier State_%d' % i, city[1])
+            put('Other Provider Identifier Issuer_%d' % i, rng.choice(['', 'BCBS', 'AETNA', 'CIGNA', 'UHC']))
+    for kind, values in (('Mailing', mail), ('Practice Location', practice)):
+        first_line = 'Provider First Line Business Mailing Address' if kind == 'Mailing' else 'Provider First Line Business Practice Location Address'
+        put(first_line, values[0])
+        put('Provider Second Line Business ' + kind + ' Address', values[1])
+        put('Provider Business ' + kind + ' Address City Name', values[2])
+        put('Provider Business ' + kind + ' Address State Name', values[3])
+        put('Provider Business ' + kind + ' Address Postal Code', values[4])
+        put('Provider Business ' + kind + ' Address Country Code (If outside U.S.)', values[5])
+        put('Provider Business ' + kind + ' Address Telephone Number', phone)
+        put('Provider Business ' + kind + ' Address Fax Number', fax)
+    # One to three taxonomies (the first one primary), each with a state license.
+    for i in range(1, 1 + rng.choices([1, 2, 3], [75, 18, 7])[0]):
+        put('Healthcare Provider Taxonomy Code_%d' % i, rng.choice(TAXONOMIES))
+        put('Healthcare Provider Primary Taxonomy Switch_%d' % i, 'Y' if i == 1 else 'N')
+        put('Provider License Number_%d' % i, rng.choice(['MD', 'RN', 'LIC', '']) + str(rng.randint(10000, 9999999)))
+        put('Provider License Number State Code_%d' % i, city[1])
+    if rng.random() < 0.6:
+        put('Certification Date', us_date(rng, enumerated, last_year))
+    locations = []
+    if rng.random() < LOCATION_SHARE:
+        for n in range(rng.randint(1, 3)):
+            other = skewed(rng, CITIES)
+            # Secondary location phones come formatted every which way.
+            number = phone_number(rng, other[3])
+            number = rng.choice([number, '(' + number[:3] + ') ' + number[3:6] + '-' + number[6:], '1-' + number[:3] + '-' + number[3:6] + '-' + number[6:]])
+            locations.append([npi] + address(rng, other) + [number, rng.choice(['', '', str(rng.randint(1, 999))]), ''])
+    return row, locations, pecos
+
+
+# npidata_pfile rows for count providers, generated as they are written; their pl_pfile and PECOS rows are
+# appended to locations and pecos.
+def nppes_rows(count, seed, locations, pecos):
+    rng = random.Random(seed)
+    practices = []
+    for npi in npi_numbers(count, seed):
+        row, provider_locations, enrollment = provider(rng, npi, practices)
+        locations.extend(provider_locations)
+        if enrollment is not None:
+            pecos.append(enrollment)
+        yield row
+
+
+# npidata_pfile rows of weekly update number week for the count providers of seed: changes rows, mostly updated
+# existing providers, some new NPIs and some deactivations. Their pl_pfile rows are appended to locations.
+def weekly_rows(count, seed, week, changes, locations):
+    rng = random.Random('%s-%s' % (seed, week))
+    npis = npi_numbers(count, seed)
+    practices = []
+    base = npis[-1] // 10 + week * changes * 40
+    rows = []
+    for npi in sorted(rng.sample(npis, min(len(npis), changes * 75 // 100))):
+        row, provider_locations, enrollment = provider(rng, npi, practices, 2024, 2025)
+        if rng.random() < 0.07:
+            row = [''] * len(NPPES_COLUMNS)
+            row[COLUMN['NPI']] = str(npi)
+            row[COLUMN['NPI Deactivation Date']] = us_date(rng, 2025, 2025)
+            row[COLUMN['Last Update Date']] = row[COLUMN['NPI Deactivation Date']]
+            provider_locations = []
+        rows.append(row)
+        locations.extend(provider_locations)
+    for i in range(changes - len(rows)):
+        base = base + rng.randint(1, 40)
+        row, provider_locations, enrollment = provider(rng, base * 10 + npi_check_digit(base), practices, 2024, 2025)
+        rows.append(row)
+        locations.extend(provider_locations)
+    return rows
+
+# Helper function to write CSV rows (with a header) as UTF-8 text into a binary stream.
+def write_csv(stream, header, rows):
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    writer = csv.writer(text, quoting=csv.QUOTE_ALL)
+    writer.writerow(header)
+    writer.writerows(rows)
+    text.flush()
+    text.detach()
+
+
+# Write an NPPES dissemination style zip of rows (npidata_pfile + its fileheader file, pl_pfile if there are locations).
+# rows may be a generator filling locations as it goes: the pl_pfile is written after it is exhausted.
+def write_nppes_zip(path, rows, locations, period='20050523-20241013'):
+    with ZipFile(path, 'w', ZIP_DEFLATED) as archive:
+        with archive.open('npidata_pfile_' + period + '.csv', 'w') as stream:
+            write_csv(stream, NPPES_COLUMNS, rows)
+        with archive.open('npidata_pfile_' + period + '_fileheader.csv', 'w') as stream:
+            write_csv(stream, NPPES_COLUMNS, [])
+        if locations:
+            with archive.open('pl_pfile_' + period + '.csv', 'w') as stream:
+                write_csv(stream, LOCATION_COLUMNS, locations)
+
+
+def write_pecos_csv(path, pecos):
+    with open(path, 'wb') as stream:
+        write_csv(stream, PECOS_COLUMNS, pecos)
+
+
+# Write the NPPES zip and PECOS CSV for count providers into directory; returns their paths.
+def write_files(directory, count, seed):
+    os.makedirs(directory, exist_ok=True)
+    locations = []
+    pecos = []
+    nppes_zip = os.path.join(directory, 'NPPES_Data_Dissemination_Synthetic.zip')
+    pecos_csv = os.path.join(directory, 'Order_and_Referring_Synthetic.csv')
+    write_nppes_zip(nppes_zip, nppes_rows(count, seed, locations, pecos), locations)
+    write_pecos_csv(pecos_csv, pecos)
+    print("Wrote " + str(count) + " NPIs (" + str(len(locations)) + " secondary locations) to " + nppes_zip)
+    print("Wrote " + str(len(pecos)) + " PECOS enrollments to " + pecos_csv)
+    return nppes_zip, pecos_csv
+
+
+# Write weekly update zips 1..weeks (changes rows each) for the count providers of seed; returns their paths, oldest first.
+# Files are named like the CMS weekly files (NPPES_Data_Dissemination_MMDDYY_MMDDYY_Weekly_V2.zip).
+def write_weekly_files(directory, count, seed, weeks, changes):
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for week in range(1, weeks + 1):
+        start = date(2024, 10, 14) + timedelta(days=7 * (week - 1))
+        period = start.strftime('%m%d%y') + '_' + (start + timedelta(days=6)).strftime('%m%d%y')
+        path = os.path.join(directory, 'NPPES_Data_Dissemination_' + period + '_Weekly_V2.zip')
+        locations = []
+        write_nppes_zip(path, weekly_rows(count, seed, week, changes, locations), locations, period)
+        print("Wrote " + str(changes) + " changed NPIs to " + path)
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write synthetic NPPES/PECOS data files.")
+    parser.add_argument('--providers', type=int, default=100000, help="number of NPIs")
+    parser.add_argument('--seed', type=int, default=1, help="random seed (same seed, same files)")
+    parser.add_argument('--weeks', type=int, default=0, help="also write this many weekly update files")
+    parser.add_argument('--changes', type=int, default=1000, help="NPIs changed per weekly update file")
+    parser.add_argument('--dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'), help="output directory")
+    args = parser.parse_args()
+    write_files(args.dir, args.providers, args.seed)
+    write_weekly_files(args.dir, args.providers, args.seed, args.weeks, args.changes)
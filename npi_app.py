@@ -1,25 +1,110 @@
 # App Description Here 👯‍♂️
-from datetime import datetime, date
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, g
 import time
-from npyi.npi import search
 import requests
 from requests.structures import CaseInsensitiveDict
 from flask_cors import CORS
 import re
 import logging
-import sqlite3
+import os
+import io
+import csv
+import json
+import base64
+import npi_db
+import npi_index
+import npi_metrics
+import npi_logging
+import npi_trace
+from npi_logging import log_payload
+from npi_metrics import REQUEST_SECONDS, REQUESTS, FALLBACKS, RESULT_RECORDS
+from npi_upstream import nppes_search, nppes_lookup, pecos_get, nppes_cache, pecos_cache
+from npi_cache import MISS
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+npi_logging.setup()
+logging.debug('Program initialized')
 
+# Bounded pool for the per-NPI NPPES/PECOS lookups of multi-row searches.
+LOOKUP_WORKERS = int(os.environ.get('NPI_LOOKUP_WORKERS', 16))
+lookup_pool = ThreadPoolExecutor(max_workers=LOOKUP_WORKERS, thread_name_prefix='npi-lookup')
 
-logging.basicConfig(filename='npi.log', level=logging.DEBUG)
-logging.debug('Program initialized')
+# How many NPIs are resolved per PECOS API call/local query.
+PECOS_BATCH = 100
+
+# Largest page of a paginated (/api/v1/doctors) name search, and the furthest NPPES API searches can skip.
+MAX_PAGE_SIZE = 200
+NPPES_MAX_SKIP = 1000
+
+# Largest possible NPI (10 digits), the bound on keyset (after) cursors.
+MAX_NPI = 9999999999
+
+# Batch lookups (/api/v1/batch): most NPIs + phones per request, how many are resolved per chunk,
+# and the (separate, so batches cannot starve interactive searches) pool for their optional upstream verification.
+BATCH_MAX = int(os.environ.get('NPI_BATCH_MAX', 10000))
+BATCH_CHUNK = 500
+BATCH_WORKERS = int(os.environ.get('NPI_BATCH_WORKERS', 4))
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='npi-batch')
 
-# Set database path.
-db = './db/npi.db'
+# Accepted values of the verify query parameter of CSV batches (JSON batches take a JSON boolean).
+BATCH_VERIFY_VALUES = {'1': True, 'true': True, 'yes': True, '0': False, 'false': False, 'no': False}
+
+# Most matches returned by a local (MODE=prefix/fuzzy) name search, same as the NPPES API search limit.
+NAME_SEARCH_LIMIT = 50
 
 npi_app = Flask(__name__)
 CORS(npi_app)
 
+# Route latency and status for /metrics. Streamed answers are timed until their last line has been sent
+# (the server closes the body), so the NPPES/PECOS lookups they run while streaming are included.
+@npi_app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+@npi_app.after_request
+def record_request(response):
+    if 'start' in g:
+        route = request.endpoint or 'unknown'
+        start = g.start
+        def observe():
+            REQUEST_SECONDS.observe(time.perf_counter() - start, route=route)
+            REQUESTS.inc(route=route, status=response.status_code)
+        if response.is_streamed:
+            response.call_on_close(observe)
+        else:
+            observe()
+    return response
+
+# Per-stage timings (npi_trace) of every request, tagged with the caller's X-Request-ID (or a new one):
+# sent back in a Server-Timing header, and with ?trace=1 added to JSON API answers and logged.
+# The Server-Timing header of a streamed answer can only cover the stages run before streaming started; its complete
+# trace is logged once the body is closed and (with ?trace=1) sent in its final {"done": true} line (see api_stream).
+@npi_app.before_request
+def start_trace():
+    npi_trace.start(request.headers.get('X-Request-ID'))
+
+@npi_app.after_request
+def finish_trace(response):
+    trace = npi_trace.finish()
+    if trace is None:
+        return response
+    response.headers['X-Request-ID'] = trace.request_id
+    response.headers['Server-Timing'] = trace.header(response.is_streamed)
+    if request.args.get('trace') == '1':
+        endpoint = request.endpoint
+        if response.is_streamed:
+            response.call_on_close(lambda: logging.info('trace %s %s', endpoint, trace.payload()))
+            return response
+        payload = trace.payload()
+        logging.info('trace %s %s', endpoint, payload)
+        if response.is_json:
+            data = response.get_json()
+            if isinstance(data, dict):
+                data['trace'] = payload
+                response.set_data(json.dumps(data))
+    return response
+
 # API to check for matching NPI number.
 @npi_app.route('/npi_check', methods=['POST'])
 def npi_check():
@@ -27,12 +112,10 @@ def npi_check():
     isLocal = 0
     x = 0
     rows = {}
-    today = date.today()
 
-    # Time stamps for logging/output.
+    # Start time for the Execution Time output.
     st = time.time()
-    current_time = get_time()
-    logging.debug('npi_check Begun %s %s' %(today,current_time))
+    logging.debug('npi_check Begun')
 
     # Headers for API calls.
     headers = set_headers()
@@ -43,163 +126,56 @@ def npi_check():
         npinumber = request.form['NPINUMBER']
 
         # Stripping everything that is not a letter.
-        npinumber = re.sub(r"[^0-9]", "",npinumber)
-        npinumber = re.sub(r'\s+', '', npinumber)
+        with npi_trace.stage('normalize'):
+            npinumber = re.sub(r"[^0-9]", "",npinumber)
+            npinumber = re.sub(r'\s+', '', npinumber)
 
         # NPI numbers are required to be exactly 10 digits.
         if len(npinumber) != 10:
-            logging.error('%s NPINUMBER was not 10 digits' %npinumber)
+            logging.error('%s NPINUMBER was not 10 digits', npinumber)
             return "NPI number must be exactly 10 digits"
 
+        # Deactivated NPIs are answered from the local deactivated list, without an upstream call.
+        if npi_db.is_deactivated(npinumber):
+            logging.debug('%s NPINUMBER is deactivated', npinumber)
+            return "NPI %s has been deactivated" %npinumber
+
         # try NPPES api call.
         try:
-            response = search(search_params={'number': npinumber})
+            response = nppes_lookup(npinumber)
 
         # NPPES API down, use local (SQL) data.
         except requests.exceptions.RequestException as e:
             print("[NPI] NPPES exception:",e)
+            FALLBACKS.inc(upstream='NPPES', site='npi_check')
             response = {}
             response['result_count'] = 0
             isLocal = 1
-            con = sqlite3.connect(db)
-            cur = con.cursor()
-            current_time = get_time()
-            logging.debug('NPPES NPI SQL Query start %s %s' %(today,current_time))
-            cur.execute("select * from npi where NPI=%s" %(npinumber))
-            current_time = get_time()
-            logging.debug('NPPES NPI SQL Query end %s %s' %(today,current_time))
-            rows = cur.fetchall()
-            con.close()
+            logging.debug('NPPES NPI SQL Query start')
+            rows = local_npi_rows(npinumber)
+            logging.debug('NPPES NPI SQL Query end')
 
         # No results
         if response['result_count'] == 0 and isLocal == 0 or (len(rows) == 0 and isLocal == 1):
             return "No results found for %s" %npinumber
 
-        # NPPES API working: Set PECOS API query to NPI# recieved from the NPPES API call.
-        if isLocal == 0:   
-            url = "https://data.cms.gov/data-api/v1/dataset/0824b6d0-14ad-47a0-94e2-f317a3658317/data?column=DME%2CNPI&keyword=" + str(response['results'][0]['number'])
+        # PECOS DME status (PECOS API, falling back to local PECOS data).
+        pecos = get_pecos_dme([npinumber], headers)
 
-        # NPPES API NOT working: Set PECOS API query to NPI# recieved from the local NPPES SQL data.
-        else: 
-            url = "https://data.cms.gov/data-api/v1/dataset/0824b6d0-14ad-47a0-94e2-f317a3658317/data?column=DME%2CNPI&keyword=" + str(rows[x][0])
+        # NPPES API functioning.
+        if isLocal == 0:
+            npireturns = resp_formatting(pecos, response, x)
 
-        # try PECOS API
-        try:
-            # PECOS api call.
-            pecosresponse = requests.get(url=url,headers=headers)
-            pecosdata = pecosresponse.json()
-
-            # NPPES API and PECOS API functioning.
-            if isLocal == 0:
-                npireturns = resp_formatting(pecosdata, response, x)
-
-            # ONLY NPPES API down.
-            else:
-                print("-- NPPES API DOWN --\n-- Using local NPPES data... --\n")
-                npireturns = rows_formatting(pecosdata,rows,x)
-            et = time.time()
-            elapsed_time = et - st
-            resp = jsonify('<table id=respTable><thead><tr id=sticky><th>NPI</th><th class=fitwidth>Name</th><th>Credential</th><th class=fitwidth>Practice #</th><th class=fitwidth>Mailing #</th><th class=fitwidth>Fax</th><th>Primary Practice</th><th>Mailing Address</th><th class=fitwidth>Other Practice</th><th>PECOS</th><th class=maxwidth>Email</th></tr></thead>' + npireturns + '</table><br><font color=red>Execution Time: ' + str(round(elapsed_time,2)) + ' seconds</font>')
-            current_time = get_time()
-            logging.debug('npi_check End %s %s' %(today,current_time))
-            #print("npi_check end")
-            return resp
-        # PECOS API down.
-        except requests.exceptions.RequestException as e:
-            print("[NPI] PECOS exception:",e)
-
-            # Only PECOS API down, use local (SQL) data.
-            if isLocal == 0:
-                print("-- PECOS API DOWN --\n-- Using local PECOS data... --\n")
-
-                # Grab PECOS data from local SQL DB.
-                con = sqlite3.connect(db)
-                cur = con.cursor()
-                logging.debug('NPI SQL Query start %s %s' %(today,current_time))
-                cur.execute("select * from pecos where [NPI]=%s" %(npinumber))
-                logging.debug('NPI SQL Query end %s %s' %(today,current_time))
-                pecosrows = cur.fetchall()
-
-                # Local PECOS SQL DB returned no rows, send DME of "NO" for current NPI hit from NPPES.
-                if len(pecosrows) == 0:
-                    pecos = {'DME': "NO", 'NPI': npinumber}
-                    npireturns = resp_formatting(pecos, response, x)
-                    et = time.time()
-                    elapsed_time = et - st
-                    resp = jsonify('<table id=respTable><thead><tr id=sticky><th>NPI</th><th class=fitwidth>Name</th><th>Credential</th><th class=fitwidth>Practice #</th><th class=fitwidth>Mailing #</th><th class=fitwidth>Fax</th><th>Primary Practice</th><th>Mailing Address</th><th class=fitwidth>Other Practice</th><th>PECOS</th><th class=maxwidth>Email</th></tr></thead>' + npireturns + '</table><br><font color=red>Execution Time: ' + str(round(elapsed_time,2)) + ' seconds</font>')
-                    current_time = get_time()
-                    logging.debug('npi_check End %s %s' %(today,current_time))
-
-                    return resp
-                # Local PECOS SQL DB returned rows, set appropriate key value pair based on returned data.
-                else:
-                    for row in pecosrows:
-                            # DME data is the 5th column, so element[4].
-                            PECOS = row[4]
-                            if PECOS == 'Y':
-                                pecos = {'DME': "YES", 'NPI': npinumber}
-                            else:
-                                pecos = {'DME': "NO", 'NPI': npinumber}
-                    npireturns = resp_formatting(pecos,response,x)
-                    et = time.time()
-                    elapsed_time = et - st
-                    resp = jsonify('<table id=respTable><thead><tr id=sticky><th>NPI</th><th class=fitwidth>Name</th><th>Credential</th><th class=fitwidth>Practice #</th><th class=fitwidth>Mailing #</th><th class=fitwidth>Fax</th><th>Primary Practice</th><th>Mailing Address</th><th class=fitwidth>Other Practice</th><th>PECOS</th><th class=maxwidth>Email</th></tr></thead>' + npireturns + '</table><br><font color=red>Execution Time: ' + str(round(elapsed_time,2)) + ' seconds</font>')
-                    current_time = get_time()
-                    logging.debug('npi_check End %s %s' %(today,current_time))
-
-                    return resp
-            # Both NPPES and PECOS api down, use local (SQL) data for both.
-            else:
-                print("-- NPPES AND PECOS API DOWN --\n-- Using local NPPPES & PECOS data... --\n")
-
-                # Grab NPPES and PECOS from local SQL DB.
-                con = sqlite3.connect(db)
-                cur = con.cursor()
-                current_time = get_time()
-                logging.debug('NPPES & PECOS NPI SQL Query start %s %s' %(today,current_time))
-                # NPPES data.
-                cur.execute("select * from npi where [NPI]=%s" %(npinumber))
-                npirows = cur.fetchall()
-                # PECOS data.
-                cur.execute("select * from pecos where [NPI]=%s" %(npinumber))
-                pecosrows = cur.fetchall()
-                current_time = get_time()
-                logging.debug('NPPES & PECOS NPI SQL Query end %s %s' %(today,current_time))
-
-                # Local NPPES SQL DB returned no rows, therefore no matching doctor by given NPI number.
-                if len(npirows) == 0:
-                    return "NO RESULTS FOUND FOR THAT NUMBER"
-                # Local NPPES SQL DB returned rows, check for PECOS data mathcing given NPI.
-                else:
-                    # No matching local PECOS data found for given NPI, set PECOS data as empty.
-                    if len(pecosrows) == 0:
-                        pecosdata = {}
-                        npireturns = rows_formatting(pecosdata, npirows, x)
-                        et = time.time()
-                        elapsed_time = et - st
-                        resp = jsonify('<table id=respTable><thead><tr id=sticky><th>NPI</th><th class=fitwidth>Name</th><th>Credential</th><th class=fitwidth>Practice #</th><th class=fitwidth>Mailing #</th><th class=fitwidth>Fax</th><th>Primary Practice</th><th>Mailing Address</th><th class=fitwidth>Other Practice</th><th>PECOS</th><th class=maxwidth>Email</th></tr></thead>' + npireturns + '</table><br><font color=red>Execution Time: ' + str(round(elapsed_time,2)) + ' seconds</font>')
-                        current_time = get_time()
-                        logging.debug('npi_check End %s %s' %(today,current_time))
-                        return resp
-                    # Local PECOS SQL DB returned rows, set appropriate key value pair based on returned data.
-                    else:
-                        for row in pecosrows:
-                            # DME data is the 5th column, so element[4].
-                            PECOS = row[4]
-                            if PECOS == 'Y':
-                                pecos = {'DME': "YES", 'NPI': npinumber}
-                            else:
-                                pecos = {'DME': "NO", 'NPI': npinumber}
-                        npireturns = rows_formatting(pecos,npirows,x)
-                        et = time.time()
-                        elapsed_time = et - st
-                        resp = jsonify('<table id=respTable><thead><tr id=sticky><th>NPI</th><th class=fitwidth>Name</th><th>Credential</th><th class=fitwidth>Practice #</th><th class=fitwidth>Mailing #</th><th class=fitwidth>Fax</th><th>Primary Practice</th><th>Mailing Address</th><th class=fitwidth>Other Practice</th><th>PECOS</th><th class=maxwidth>Email</th></tr></thead>' + npireturns + '</table><br><font color=red>Execution Time: ' + str(round(elapsed_time,2)) + ' seconds</font>')
-                        #resp = jsonify('<table>' + npireturns + '</table><br><font color=red>Elapsed Time: ' + str(elapsed_time) + ' seconds</font>')
-                        now = datetime.now()
-                        current_time = now.strftime("%H:%M:%S")
-                        logging.debug('npi_check End %s %s' %(today,current_time))
-
-                        return resp
+        # NPPES API down.
+        else:
+            print("-- NPPES API DOWN --\n-- Using local NPPES data... --\n")
+            npireturns = rows_formatting(pecos, rows, x)
+        et = time.time()
+        elapsed_time = et - st
+        RESULT_RECORDS.observe(1, route='npi_check')
+        resp = jsonify('<table id=respTable><thead><tr id=sticky><th>NPI</th><th class=fitwidth>Name</th><th>Credential</th><th class=fitwidth>Practice #</th><th class=fitwidth>Mailing #</th><th class=fitwidth>Fax</th><th>Primary Practice</th><th>Mailing Address</th><th class=fitwidth>Other Practice</th><th>PECOS</th><th class=maxwidth>Email</th></tr></thead>' + npireturns + '</table><br><font color=red>Execution Time: ' + str(round(elapsed_time,2)) + ' seconds</font>')
+        logging.debug('npi_check End')
+        return resp
     else:
         return "NPI number must be exactly 10 digits"
 
@@ -208,19 +184,12 @@ def npi_check():
 @npi_app.route('/phone_check', methods=['POST'])
 def phone_check():
     # Declare local variables.
-    isLocal = 0
-    nAPIdown = 0 # NPPES API is up = 0
-    pAPIdown = 0 # PECOS API is up = 0
-    x = 0
     count = 1
-    logcount = 1
     rows = {}
 
-    # Time stamps for logging/output.
+    # Start time for the Execution Time output.
     st = time.time()
-    today = date.today()
-    current_time = get_time()
-    logging.debug('phone_check Begun %s %s' %(today,current_time))
+    logging.debug('phone_check Begun')
 
     # Headers for API calls.
     headers = set_headers()
@@ -229,271 +198,36 @@ def phone_check():
     if "PHONENUMBER" in request.form:
         # User input -> Phone number stripped of anything but digits.
         phonenumber = request.form['PHONENUMBER']
-        phonenumber = re.sub(r"[^0-9]", '', phonenumber)
+        with npi_trace.stage('normalize'):
+            phonenumber = re.sub(r"[^0-9]", '', phonenumber)
 
-        # Adding dashes for error feedback/readability.
-        p = phonenumber
-        p = '-'.join([p[:3], p[3:6], p[6:]])
+            # Adding dashes for error feedback/readability.
+            p = phonenumber
+            p = '-'.join([p[:3], p[3:6], p[6:]])
 
         if len(phonenumber) != 10:
             return "%s is not a valid phone number." %p
              
-        npireturns_all = ""
-        con = sqlite3.connect(db)
-        cur = con.cursor()
-        current_time = get_time()
-        logging.debug('Phone# SQL Query start %s %s' %(today,current_time))
-        cur.execute("select * from npi where [Provider Business Mailing Address Telephone Number]=%s OR [Provider Business Practice Location Address Telephone Number]=%s" %(phonenumber,phonenumber))
-        rows = cur.fetchall()
-        con.close()
-        current_time = get_time()
-        con.close()
-        logging.debug('Phone# SQL Query end %s %s' %(today,current_time))
+        logging.debug('Phone# SQL Query start')
+        rows = local_phone_rows(phonenumber)
+        logging.debug('Phone# SQL Query end')
         if len(rows) == 0:
             return "NO RESULTS FOUND FOR %s" %p
 
         # For each entry that had a matching phone number.
+        lookups = []
         for row in rows:
-            npinumber = row[0]
-            #print(npinumber)
-            #print("Adding Healthcare Worker",count)
+            npinumber = row['npi']
             print("Adding Healthcare Worker [ID: "+str(npinumber)+"]",count)
             count=count+1
-            # try NPPES api call if it has NOT failed before.
-            if nAPIdown == 0:
-                try:
-                    response = search(search_params={'number': npinumber})
-                # NPPES API down, use local (SQL) data.
-                except requests.exceptions.RequestException as e:
-                    print("[PHONE] NPPES exception:",e)
-                    response = {}
-                    response['result_count'] = 0
-                    isLocal = 1
-                    nAPIdown = 1
-
-            # Prevent NPPES API call as it has already failed.
-            else:
-                response = {}
-                response['result_count'] = 0
-                nAPIdown = 1
-                isLocal = 1
-
-            # No results -- this should never happen, given that if a phone number is found, and NPI should exist.
-            # But if it does... Move on.
-            if response['result_count'] == 0 and isLocal == 0 or (len(rows) == 0 and isLocal == 1):
-                continue
-
-
-            # NPPES API working: Set PECOS API query to NPI# recieved from the NPPES API call.
-            if isLocal == 0:   
-                #print(len(response))
-                #print(response)
-                url = "https://data.cms.gov/data-api/v1/dataset/0824b6d0-14ad-47a0-94e2-f317a3658317/data?column=DME%2CNPI&keyword=" + str(response['results'][0]['number'])
-
-            # NPPES API NOT working: Set PECOS API query to NPI# recieved from the local NPPES SQL data.
-            else: 
-                url = "https://data.cms.gov/data-api/v1/dataset/0824b6d0-14ad-47a0-94e2-f317a3658317/data?column=DME%2CNPI&keyword=" + str(rows[x][0])
-
-            # try PECOS API if it has not already failed.
-            if pAPIdown == 0:
-                try:
-                    # PECOS api call.
-                    pecosresponse = requests.get(url=url,headers=headers)
-                    pecosdata = pecosresponse.json()
-
-                    # NPPES API and PECOS API functioning.
-                    if isLocal == 0:
-                        npireturns = resp_formatting(pecosdata, response, x)
-
-                    # ONLY NPPES API down.
-                    else:
-                        print("-- NPPES API DOWN --\n-- Using local NPPES data... --\n")
-                        npireturns = rows_formatting(pecosdata,rows,x)
-                        x = x + 1
-                    current_time = get_time()
-                    logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                    logcount = logcount+1
-                    npireturns_all = npireturns_all + npireturns
-
-                # PECOS API down.
-                except requests.exceptions.RequestException as e:
-                    print("[PHONE] PECOS exception:",e)
-                    pAPIdown = 1
-
-                    # Only PECOS API down, use local (SQL) data.
-                    if isLocal == 0:
-                        print("-- PECOS API DOWN --\n-- Using local PECOS data... --\n")
-
-                        # Grab PECOS data from local SQL DB.
-                        con = sqlite3.connect(db)
-                        cur = con.cursor()
-                        logging.debug('SQL Query start %s %s' %(today,current_time))
-                        cur.execute("select * from pecos where [NPI]=%s" %(npinumber))
-                        pecosrows = cur.fetchall()
-
-                        # Local PECOS SQL DB returned no rows, send DME of "NO" for current NPI hit from NPPES.
-                        if len(pecosrows) == 0:
-                            pecos = {'DME': "NO", 'NPI': npinumber}
-                            npireturns = resp_formatting(pecos, response, x)
-                            current_time = get_time()
-                            logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                            logcount = logcount+1
-                            npireturns_all = npireturns_all + npireturns
-
-                        # Local PECOS SQL DB returned rows, set appropriate key value pair based on returned data.
-                        else:
-                            for row in pecosrows:
-                                    # DME data is the 5th column, so element[4].
-                                    PECOS = row[4]
-                                    if PECOS == 'Y':
-                                        pecos = {'DME': "YES", 'NPI': npinumber}
-                                    else:
-                                        pecos = {'DME': "NO", 'NPI': npinumber}
-                            npireturns = resp_formatting(pecos,response,x)
-                            current_time = get_time()
-                            logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                            logcount = logcount+1
-                            npireturns_all = npireturns_all + npireturns
-                            
-
-                    # Both NPPES and PECOS api down, use local (SQL) data for both.
-                    else:
-                        print("-- NPPES AND PECOS API DOWN --\n-- Using local NPPPES & PECOS data... --\n")
-
-                        # Grab NPPES and PECOS from local SQL DB.
-                        con = sqlite3.connect(db)
-                        cur = con.cursor()
-                        logging.debug('SQL Query start')
-                        # NPPES data.
-                        npirows = rows
-                        # PECOS data.
-                        cur.execute("select * from pecos where [NPI]=%s" %(npinumber))
-                        pecosrows = cur.fetchall()
-                        logging.debug('SQL Query End')
-
-                        # Local NPPES SQL DB returned no rows, therefore no matching doctor by given NPI number.
-                        if len(npirows) == 0:
-                            return "NO RESULTS FOUND FOR %s" %p
-                        # Local NPPES SQL DB returned rows, check for PECOS data mathcing given NPI.
-                        else:
-                            # No matching local PECOS data found for given NPI, set PECOS data as empty.
-                            if len(pecosrows) == 0:
-                                pecosdata = {}
-                                npireturns = rows_formatting(pecosdata, npirows, x)
-                                x = x + 1
-                                current_time = get_time()
-                                logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                                logcount = logcount+1
-                                npireturns_all = npireturns_all + npireturns
-
-                            # Local PECOS SQL DB returned rows, set appropriate key value pair based on returned data.
-                            else:
-                                for row in pecosrows:
-                                    # DME data is the 5th column, so element[4].
-                                    PECOS = row[4]
-                                    if PECOS == 'Y':
-                                        pecos = {'DME': "YES", 'NPI': npinumber}
-                                    else:
-                                        pecos = {'DME': "NO", 'NPI': npinumber}
-
-                                npireturns = rows_formatting(pecos,npirows,x)
-                                x = x + 1
-                                npireturns_all = npireturns_all + npireturns
-
-            # pAPIdown = 1, prevent PECOS API call as it has already failed
-            else:
-                # Only PECOS API down, use local (SQL) data.
-                if isLocal == 0:
-                    print("-- PECOS API DOWN --\n-- Using local PECOS data... --\n")
-
-                    # Grab PECOS data from local SQL DB.
-                    con = sqlite3.connect(db)
-                    cur = con.cursor()
-                    now = datetime.now()
-                    current_time = now.strftime("%H:%M:%S")
-                    logging.debug('PECOS SQL Query start %s %s' %(today,current_time))
-                    cur.execute("select * from pecos where [NPI]=%s" %(npinumber))
-                    pecosrows = cur.fetchall()
-                    now = datetime.now()
-                    current_time = now.strftime("%H:%M:%S")
-                    logging.debug('PECOS SQL Query start %s %s' %(today,current_time))
-
-                    # Local PECOS SQL DB returned no rows, send DME of "NO" for current NPI hit from NPPES.
-                    if len(pecosrows) == 0:
-                        pecos = {'DME': "NO", 'NPI': npinumber}
-                        npireturns = resp_formatting(pecos, response, x)
-                        current_time = get_time()
-                        logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                        logcount = logcount+1
-                        npireturns_all = npireturns_all + npireturns
-
-                    # Local PECOS SQL DB returned rows, set appropriate key value pair based on returned data.
-                    else:
-                        for row in pecosrows:
-                                # DME data is the 5th column, so element[4].
-                                PECOS = row[4]
-                                if PECOS == 'Y':
-                                    pecos = {'DME': "YES", 'NPI': npinumber}
-                                else:
-                                    pecos = {'DME': "NO", 'NPI': npinumber}
-                        npireturns = resp_formatting(pecos,response,x)
-                        current_time = get_time()
-                        logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                        logcount = logcount+1
-                        npireturns_all = npireturns_all + npireturns
-
-                # Both NPPES and PECOS api down, use local (SQL) data for both.
-                else:
-                    print("-- NPPES AND PECOS API DOWN --\n-- Using local NPPPES & PECOS data... --\n")
-
-                    # Grab NPPES and PECOS from local SQL DB.
-                    con = sqlite3.connect(db)
-                    cur = con.cursor()
-                    now = datetime.now()
-                    current_time = now.strftime("%H:%M:%S")
-                    logging.debug('Local NPI & PECOS SQL Query start %s %s' %(today,current_time))
-                    # NPPES data.
-                    npirows = rows
-                    # PECOS data.
-                    cur.execute("select * from pecos where [NPI]=%s" %(npinumber))
-                    pecosrows = cur.fetchall()
-                    now = datetime.now()
-                    current_time = now.strftime("%H:%M:%S")
-                    logging.debug('Local NPI & PECOS SQL Query end %s %s' %(today,current_time))
-
-                    # Local NPPES SQL DB returned no rows, therefore no matching doctor by given NPI number.
-                    if len(npirows) == 0:
-                        return "NO RESULTS FOUND FOR %s" %p
-                    # Local NPPES SQL DB returned rows, check for PECOS data mathcing given NPI.
-                    else:
-                        # No matching local PECOS data found for given NPI, set PECOS data as empty.
-                        if len(pecosrows) == 0:
-                            pecosdata = {}
-                            npireturns = rows_formatting(pecosdata, npirows, x)
-                            x = x + 1
-                            npireturns_all = npireturns_all + npireturns
-
-                        # Local PECOS SQL DB returned rows, set appropriate key value pair based on returned data.
-                        else:
-                            for row in pecosrows:
-                                # DME data is the 5th column, so element[4].
-                                PECOS = row[4]
-                                if PECOS == 'Y':
-                                    pecos = {'DME': "YES", 'NPI': npinumber}
-                                else:
-                                    pecos = {'DME': "NO", 'NPI': npinumber}
-
-                            npireturns = rows_formatting(pecos,npirows,x)
-                            x = x + 1
-                            current_time = get_time()
-                            logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                            logcount = logcount+1
-                            npireturns_all = npireturns_all + npireturns
+            lookups.append((npinumber, row))
+
+        # Run the NPPES/PECOS lookups for every row concurrently, keeping row order.
+        npireturns_all = "".join(lookup_rows(lookups, headers))
 
         print("Data complete\nDisplaying",count-1,"healthcare workers.")
-        now = datetime.now()
-        current_time = now.strftime("%H:%M:%S")
-        logging.debug('phone_check End %s %s' %(today,current_time))
+        RESULT_RECORDS.observe(count-1, route='phone_check')
+        logging.debug('phone_check End')
         et = time.time()
         elapsed_time = et - st
         resp = jsonify('<table id="respTable"><thead><tr id=sticky><th>NPI</th><th class=fitwidth>Name</th><th>Credential</th><th class=fitwidth>Practice #</th><th class=fitwidth>Mailing #</th><th class=fitwidth>Fax</th><th>Primary Practice</th><th>Mailing Address</th><th class=fitwidth>Other Practice</th><th>PECOS</th><th class=maxwidth>Email</th></tr></thead>' + npireturns_all + '</table><br><font color=red>Execution Time: ' + str(round(elapsed_time,2)) + ' seconds</font>')
@@ -503,628 +237,310 @@ def phone_check():
 @npi_app.route('/doc_check', methods=['POST'])
 def doc_check():
     # Local variables
-    isLocal = 0
-    logcount = 1
-    rows = {}
-    nAPIdown = 0 # NPPES API is up = 0
-    pAPIdown = 0 # PECOS API is up = 0
     count = 1
-    x = 0
-    npireturns_all = ""
     DOCTOR_FIRSTNAME = ""
     DOCTOR_LASTNAME = ""
 
-    # Time stamps for logging/output.
+    # Start time for the Execution Time output.
     st = time.time()
-    today = date.today()
-    current_time = get_time()
-    logging.debug('doc_check Begun %s %s' %(today,current_time))
+    logging.debug('doc_check Begun')
 
     # Headers for API calls.
     headers = set_headers()
 
+    # Local search modes, answered from the local snapshot only (partial names welcome).
+    if request.form.get('MODE') in ('prefix', 'fuzzy') and "DOCTORNAME" in request.form and len(request.form['DOCTORNAME'].strip()) > 1:
+        return local_doc_check(request.form['MODE'], st)
+
     # Doctor name must be at least 3 letters.
     if "DOCTORNAME" in request.form and len(request.form['DOCTORNAME']) > 3:
-        if " " not in request.form['DOCTORNAME']:
-            DOCTOR_LASTNAME = re.sub(r"[^a-zA-Z0-9]", "",request.form["DOCTORNAME"].upper()) # Only last name given
-            if "STATE" in request.form and len(request.form['STATE']) > 1:
-                DOC_STATE = re.sub(r"[^a-zA-Z0-9]", "",request.form['STATE'].upper())
-                try:
-                    response = search(search_params={'last_name': DOCTOR_LASTNAME, 'state' : DOC_STATE},limit=50)
-                    logging.debug('DOCTOR NAME SEARCH WITH STATE RETURNED: %s ' %response)
-                except requests.exceptions.RequestException as e:
-                    print("[DOC] NPPES exception:",e)
-                    response = {}
-                    response['result_count'] = 0
-                    isLocal = 1
-                    nAPIdown = 1
-                    con = sqlite3.connect(db)
-                    cur = con.cursor()
-                    logging.debug('SQL Query start')
-                    cur.execute("select * from npi where [Provider Last Name (Legal Name)]='%s' AND ([Provider Business Mailing Address State Name]='%s' OR [Provider Business Practice Location Address State Name]='%s')" %(DOCTOR_LASTNAME, DOC_STATE, DOC_STATE))
-                    rows = cur.fetchall()
-                    con.close()
-            else:
-                try:
-                    response = search(search_params={'last_name': DOCTOR_LASTNAME},limit=50)
-                    logging.debug('DOCTOR NAME SEARCH WITH LAST NAME ONLY RETURNED: %s ' %response)
-                except requests.exceptions.RequestException as e:
-                    print("[DOC] NPPES exception:",e)
-                    response = {}
-                    response['result_count'] = 0
-                    isLocal = 1 
-                    nAPIdown = 1
-                    con = sqlite3.connect(db)
-                    cur = con.cursor()
-                    logging.debug('SQL Query start')
-                    cur.execute("select * from npi where [Provider Last Name (Legal Name)]='%s'" %(DOCTOR_LASTNAME))
-                    rows = cur.fetchall()
-                    con.close()
-        else:
-            DOCTORFULLNAME = request.form["DOCTORNAME"].split(" ")
-            DOCTOR_FIRSTNAME = re.sub(r"[^a-zA-Z0-9]", "",DOCTORFULLNAME[0].upper())
-            DOCTOR_LASTNAME = re.sub(r"[^a-zA-Z0-9]", "",DOCTORFULLNAME[1].upper())
-            if "STATE" in request.form and len(request.form['STATE']) > 1:
-                DOC_STATE = re.sub(r"[^a-zA-Z0-9]", "",request.form['STATE'].upper())
-                try:
-                    response = search(search_params={'first_name': DOCTOR_FIRSTNAME, 'last_name': DOCTOR_LASTNAME, 'state' : DOC_STATE},limit=50)
-                    logging.debug('DOCTOR NAME SEARCH WITH FIRST AND LAST NAME WITH STATE RETURNED: %s ' %response)
-                except requests.exceptions.RequestException as e:
-                    print("[DOC] NPPES exception:",e)
-                    response = {}
-                    response['result_count'] = 0
-                    isLocal = 1 
-                    nAPIdown = 1
-                    con = sqlite3.connect(db)
-                    cur = con.cursor()
-                    logging.debug('SQL Query start')
-                    cur.execute("select * from npi where [Provider Last Name (Legal Name)]='%s' AND [Provider First Name]='%s' AND ([Provider Business Mailing Address State Name]='%s' OR [Provider Business Practice Location Address State Name]='%s')" %(DOCTOR_LASTNAME,DOCTOR_FIRSTNAME, DOC_STATE, DOC_STATE))
-                    rows = cur.fetchall()
-                    con.close()
-            else:
-                try:
-                    response = search(search_params={'first_name': DOCTOR_FIRSTNAME, 'last_name': DOCTOR_LASTNAME},limit=50)
-                    logging.debug('DOCTOR NAME SEARCH WITH FIRST AND LAST NAME RETURNED: %s ' %response)
-                except requests.exceptions.RequestException as e:
-                    print("[DOC] NPPES exception:",e)
-                    response = {}
-                    response['result_count'] = 0
-                    isLocal = 1
-                    nAPIdown = 1
-                    con = sqlite3.connect(db)
-                    cur = con.cursor()
-                    logging.debug('SQL Query start')
-                    cur.execute("select * from npi where [Provider Last Name (Legal Name)] = '%s' AND [Provider First Name] = '%s'" %(DOCTOR_LASTNAME,DOCTOR_FIRSTNAME))
-                    rows = cur.fetchall()
-                    con.close()
-
-        if response['result_count'] == 0 and isLocal == 0 or (len(rows) == 0 and isLocal == 1):
+        DOCTOR_FIRSTNAME, DOCTOR_LASTNAME = split_name(request.form["DOCTORNAME"])
+        DOC_STATE = ""
+        if "STATE" in request.form and len(request.form['STATE']) > 1:
+            DOC_STATE = re.sub(r"[^a-zA-Z0-9]", "",request.form['STATE'].upper())
+
+        # NPPES API name search (local rows when it is down).
+        lookups, next_cursor, info = search_doctors(DOCTOR_FIRSTNAME, DOCTOR_LASTNAME, DOC_STATE)
+        if len(lookups) == 0:
             return "No doctor found by the name '%s %s'" %(DOCTOR_FIRSTNAME,DOCTOR_LASTNAME)
+        for npinumber, row in lookups:
+            print("Adding Healthcare Worker [ID: "+str(npinumber)+"]",count)
+            count=count+1
 
-        # NPPES API Down
-        else:
-            # NPPES API UP
-            if isLocal == 0:
-                # For each entry that had a matching phone number.
-                for results in response['results']:
-                    npinumber = results['number']
-                    #print("Adding Healthcare Worker",count)
-                    print("Adding Healthcare Worker [ID: "+str(npinumber)+"]",count)
-                    count=count+1
-                    # try NPPES api call if it has NOT failed before.
-                    if nAPIdown == 0:
-                        try:
-                            response = search(search_params={'number': npinumber})
-                        # NPPES API down, use local (SQL) data.
-                        except requests.exceptions.RequestException as e:
-                            print("[PHONE] NPPES exception:",e)
-                            response = {}
-                            response['result_count'] = 0
-                            isLocal = 1
-                            nAPIdown = 1
-
-                    # Prevent NPPES API call as it has already failed.
-                    else:
-                        response = {}
-                        response['result_count'] = 0
-                        nAPIdown = 1
-                        isLocal = 1
-
-                     # This should never happen if a phone number is found -- an NPI should exist...
-                     # However if for some reason it does... Move on.
-                    if response['result_count'] == 0 and isLocal == 0 or (len(rows) == 0 and isLocal == 1):
-                        continue
-
-                    # NPPES API working: Set PECOS API query to NPI# recieved from the NPPES API call.
-                    if isLocal == 0:   
-                        url = "https://data.cms.gov/data-api/v1/dataset/0824b6d0-14ad-47a0-94e2-f317a3658317/data?column=DME%2CNPI&keyword=" + str(response['results'][0]['number'])
-
-                    # NPPES API NOT working: Set PECOS API query to NPI# recieved from the local NPPES SQL data.
-                    else: 
-                        url = "https://data.cms.gov/data-api/v1/dataset/0824b6d0-14ad-47a0-94e2-f317a3658317/data?column=DME%2CNPI&keyword=" + str(rows[x][0])
-
-                    # try PECOS API if it has not already failed.
-                    if pAPIdown == 0:
-                        try:
-                            # PECOS api call.
-                            pecosresponse = requests.get(url=url,headers=headers)
-                            pecosdata = pecosresponse.json()
-
-                            # NPPES API and PECOS API functioning.
-                            if isLocal == 0:
-                                npireturns = resp_formatting(pecosdata, response, x)
-
-                            # ONLY NPPES API down.
-                            else:
-                                print("-- NPPES API DOWN --\n-- Using local NPPES data... --\n")
-                                npireturns = rows_formatting(pecosdata,rows,x)
-                                x = x + 1
-                            current_time = get_time()
-                            logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                            logcount = logcount+1
-                            npireturns_all = npireturns_all + npireturns
-
-                        # PECOS API down.
-                        except requests.exceptions.RequestException as e:
-                            print("[DOC] PECOS exception:",e)
-                            pAPIdown = 1
-
-                            # Only PECOS API down, use local (SQL) data.
-                            if isLocal == 0:
-                                print("-- PECOS API DOWN --\n-- Using local PECOS data... --\n")
-
-                                # Grab PECOS data from local SQL DB.
-                                con = sqlite3.connect(db)
-                                cur = con.cursor()
-                                logging.debug('SQL Query start %s %s' %(today,current_time))
-                                cur.execute("select * from pecos where [NPI]=%s" %(npinumber))
-                                pecosrows = cur.fetchall()
-
-                                # Local PECOS SQL DB returned no rows, send DME of "NO" for current NPI hit from NPPES.
-                                if len(pecosrows) == 0:
-                                    pecos = {'DME': "NO", 'NPI': npinumber}
-                                    npireturns = resp_formatting(pecos, response, x)
-                                    current_time = get_time()
-                                    logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                                    logcount = logcount+1
-                                    npireturns_all = npireturns_all + npireturns
-
-                                # Local PECOS SQL DB returned rows, set appropriate key value pair based on returned data.
-                                else:
-                                    for row in pecosrows:
-                                            # DME data is the 5th column, so element[4].
-                                            PECOS = row[4]
-                                            if PECOS == 'Y':
-                                                pecos = {'DME': "YES", 'NPI': npinumber}
-                                            else:
-                                                pecos = {'DME': "NO", 'NPI': npinumber}
-                                    npireturns = resp_formatting(pecos,response,x)
-                                    current_time = get_time()
-                                    logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                                    logcount = logcount+1
-                                    npireturns_all = npireturns_all + npireturns
-
-                            # Both NPPES and PECOS api down, use local (SQL) data for both.
-                            else:
-                                print("-- NPPES AND PECOS API DOWN --\n-- Using local NPPPES & PECOS data... --\n")
-
-                                # Grab NPPES and PECOS from local SQL DB.
-                                con = sqlite3.connect(db)
-                                cur = con.cursor()
-                                logging.debug('SQL Query start')
-                                # NPPES data.
-                                npirows = rows
-                                # PECOS data.
-                                cur.execute("select * from pecos where [NPI]=%s" %(npinumber))
-                                pecosrows = cur.fetchall()
-
-                                # Local NPPES SQL DB returned no rows, therefore no matching doctor by given NPI number.
-                                if len(npirows) == 0:
-                                    return "NO RESULTS FOUND FOR THAT NAME"
-                                # Local NPPES SQL DB returned rows, check for PECOS data mathcing given NPI.
-                                else:
-                                    # No matching local PECOS data found for given NPI, set PECOS data as empty.
-                                    if len(pecosrows) == 0:
-                                        pecosdata = {}
-                                        npireturns = rows_formatting(pecosdata, npirows, x)
-                                        x = x + 1
-                                        current_time = get_time()
-                                        logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                                        logcount = logcount+1
-                                        npireturns_all = npireturns_all + npireturns
-
-                                    # Local PECOS SQL DB returned rows, set appropriate key value pair based on returned data.
-                                    else:
-                                        for row in pecosrows:
-                                            # DME data is the 5th column, so element[4].
-                                            PECOS = row[4]
-                                            if PECOS == 'Y':
-                                                pecos = {'DME': "YES", 'NPI': npinumber}
-                                            else:
-                                                pecos = {'DME': "NO", 'NPI': npinumber}
-
-                                        npireturns = rows_formatting(pecos,npirows,x)
-                                        x = x + 1
-                                        npireturns_all = npireturns_all + npireturns
-
-                    # pAPIdown = 1, prevent PECOS API call as it has already failed
-                    else:
-                        # Only PECOS API down, use local (SQL) data.
-                        if isLocal == 0:
-                            print("-- PECOS API DOWN --\n-- Using local PECOS data... --\n")
-
-                            # Grab PECOS data from local SQL DB.
-                            con = sqlite3.connect(db)
-                            cur = con.cursor()
-                            now = datetime.now()
-                            current_time = now.strftime("%H:%M:%S")
-                            logging.debug('PECOS SQL Query start %s %s' %(today,current_time))
-                            cur.execute("select * from pecos where [NPI]=%s" %(npinumber))
-                            pecosrows = cur.fetchall()
-                            now = datetime.now()
-                            current_time = now.strftime("%H:%M:%S")
-                            logging.debug('PECOS SQL Query start %s %s' %(today,current_time))
-
-                            # Local PECOS SQL DB returned no rows, send DME of "NO" for current NPI hit from NPPES.
-                            if len(pecosrows) == 0:
-                                pecos = {'DME': "NO", 'NPI': npinumber}
-                                npireturns = resp_formatting(pecos, response, x)
-                                current_time = get_time()
-                                logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                                logcount = logcount+1
-                                npireturns_all = npireturns_all + npireturns
-
-                            # Local PECOS SQL DB returned rows, set appropriate key value pair based on returned data.
-                            else:
-                                for row in pecosrows:
-                                        # DME data is the 5th column, so element[4].
-                                        PECOS = row[4]
-                                        if PECOS == 'Y':
-                                            pecos = {'DME': "YES", 'NPI': npinumber}
-                                        else:
-                                            pecos = {'DME': "NO", 'NPI': npinumber}
-                                npireturns = resp_formatting(pecos,response,x)
-                                current_time = get_time()
-                                logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                                logcount = logcount+1
-                                npireturns_all = npireturns_all + npireturns
-
-                        # Both NPPES and PECOS api down, use local (SQL) data for both.
-                        else:
-                            print("-- NPPES AND PECOS API DOWN --\n-- Using local NPPPES & PECOS data... --\n")
-
-                            # Grab NPPES and PECOS from local SQL DB.
-                            con = sqlite3.connect(db)
-                            cur = con.cursor()
-                            now = datetime.now()
-                            current_time = now.strftime("%H:%M:%S")
-                            logging.debug('Local NPI & PECOS SQL Query start %s %s' %(today,current_time))
-                            # NPPES data.
-                            npirows = rows
-                            # PECOS data.
-                            cur.execute("select * from pecos where [NPI]=%s" %(npinumber))
-                            pecosrows = cur.fetchall()
-                            now = datetime.now()
-                            current_time = now.strftime("%H:%M:%S")
-                            logging.debug('Local NPI & PECOS SQL Query end %s %s' %(today,current_time))
-
-                            # Local NPPES SQL DB returned no rows, therefore no matching doctor by given NPI number.
-                            if len(npirows) == 0:
-                                return "NO RESULTS FOUND FOR THAT NAME"
-                            # Local NPPES SQL DB returned rows, check for PECOS data mathcing given NPI.
-                            else:
-                                # No matching local PECOS data found for given NPI, set PECOS data as empty.
-                                if len(pecosrows) == 0:
-                                    pecosdata = {}
-                                    npireturns = rows_formatting(pecosdata, npirows, x)
-                                    x = x + 1
-                                    npireturns_all = npireturns_all + npireturns
-
-                                # Local PECOS SQL DB returned rows, set appropriate key value pair based on returned data.
-                                else:
-                                    for row in pecosrows:
-                                        # DME data is the 5th column, so element[4].
-                                        PECOS = row[4]
-                                        if PECOS == 'Y':
-                                            pecos = {'DME': "YES", 'NPI': npinumber}
-                                        else:
-                                            pecos = {'DME': "NO", 'NPI': npinumber}
-
-                                    npireturns = rows_formatting(pecos,npirows,x)
-                                    x = x + 1
-                                    current_time = get_time()
-                                    logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                                    logcount = logcount+1
-                                    npireturns_all = npireturns_all + npireturns
-
-                print("Data complete\nDisplaying",count-1,"healthcare workers.")
-                now = datetime.now()
-                current_time = now.strftime("%H:%M:%S")
-                logging.debug('phone_check End %s %s' %(today,current_time))
-                et = time.time()
-                elapsed_time = et - st
-                resp = jsonify('<table id="respTable"><thead><tr id=sticky><th>NPI</th><th class=fitwidth>Name</th><th>Credential</th><th class=fitwidth>Practice #</th><th class=fitwidth>Mailing #</th><th class=fitwidth>Fax</th><th>Primary Practice</th><th>Mailing Address</th><th class=fitwidth>Other Practice</th><th>PECOS</th><th class=maxwidth>Email</th></tr></thead>' + npireturns_all + '</table><br><font color=red>Execution Time: ' + str(round(elapsed_time,2)) + ' seconds</font>')
-                return resp
+        # Run the NPPES/PECOS lookups for every match concurrently, keeping result order.
+        npireturns_all = "".join(lookup_rows(lookups, headers))
 
-            else:
-                # For each entry that had a matching name.
-                for row in rows:
-                    npinumber = row[0]
-                    #print("Adding Healthcare Worker",count)
-                    print("Adding Healthcare Worker [ID: "+str(npinumber)+"]",count)
-                    count=count+1
-                    # try NPPES api call if it has NOT failed before.
-                    if nAPIdown == 0:
-                        try:
-                            response = search(search_params={'number': npinumber})
-                        # NPPES API down, use local (SQL) data.
-                        except requests.exceptions.RequestException as e:
-                            print("[PHONE] NPPES exception:",e)
-                            response = {}
-                            response['result_count'] = 0
-                            isLocal = 1
-                            nAPIdown = 1
-
-                    # Prevent NPPES API call as it has already failed.
-                    else:
-                        response = {}
-                        response['result_count'] = 0
-                        nAPIdown = 1
-                        isLocal = 1
-
-                    # This should never happen if a phone number is found -- an NPI should exist.
-                    # However if it does happen... Move on.
-                    if response['result_count'] == 0 and isLocal == 0 or (len(rows) == 0 and isLocal == 1):
-                        continue
-
-                    # NPPES API working: Set PECOS API query to NPI# recieved from the NPPES API call.
-                    if isLocal == 0:   
-                        url = "https://data.cms.gov/data-api/v1/dataset/0824b6d0-14ad-47a0-94e2-f317a3658317/data?column=DME%2CNPI&keyword=" + str(response['results'][0]['number'])
-
-                    # NPPES API NOT working: Set PECOS API query to NPI# recieved from the local NPPES SQL data.
-                    else: 
-                        url = "https://data.cms.gov/data-api/v1/dataset/0824b6d0-14ad-47a0-94e2-f317a3658317/data?column=DME%2CNPI&keyword=" + str(rows[x][0])
-
-                    # try PECOS API if it has not already failed.
-                    if pAPIdown == 0:
-                        try:
-                            # PECOS api call.
-                            pecosresponse = requests.get(url=url,headers=headers)
-                            pecosdata = pecosresponse.json()
-
-                            # NPPES API and PECOS API functioning.
-                            if isLocal == 0:
-                                npireturns = resp_formatting(pecosdata, response, x)
-
-                            # ONLY NPPES API down.
-                            else:
-                                print("-- NPPES API DOWN --\n-- Using local NPPES data... --\n")
-                                npireturns = rows_formatting(pecosdata,rows,x)
-                                x = x + 1
-                            current_time = get_time()
-                            logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                            logcount = logcount+1
-                            npireturns_all = npireturns_all + npireturns
-
-                        # PECOS API down.
-                        except requests.exceptions.RequestException as e:
-                            print("[PHONE] PECOS exception:",e)
-                            pAPIdown = 1
-
-                            # Only PECOS API down, use local (SQL) data.
-                            if isLocal == 0:
-                                print("-- PECOS API DOWN --\n-- Using local PECOS data... --\n")
-
-                                # Grab PECOS data from local SQL DB.
-                                con = sqlite3.connect(db)
-                                cur = con.cursor()
-                                logging.debug('SQL Query start %s %s' %(today,current_time))
-                                cur.execute("select * from pecos where [NPI]=%s" %(npinumber))
-                                pecosrows = cur.fetchall()
-
-                                # Local PECOS SQL DB returned no rows, send DME of "NO" for current NPI hit from NPPES.
-                                if len(pecosrows) == 0:
-                                    pecos = {'DME': "NO", 'NPI': npinumber}
-                                    npireturns = resp_formatting(pecos, response, x)
-                                    current_time = get_time()
-                                    logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                                    logcount = logcount+1
-                                    npireturns_all = npireturns_all + npireturns
-
-                                # Local PECOS SQL DB returned rows, set appropriate key value pair based on returned data.
-                                else:
-                                    for row in pecosrows:
-                                            # DME data is the 5th column, so element[4].
-                                            PECOS = row[4]
-                                            if PECOS == 'Y':
-                                                pecos = {'DME': "YES", 'NPI': npinumber}
-                                            else:
-                                                pecos = {'DME': "NO", 'NPI': npinumber}
-                                    npireturns = resp_formatting(pecos,response,x)
-                                    current_time = get_time()
-                                    logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                                    logcount = logcount+1
-
-                            # Both NPPES and PECOS api down, use local (SQL) data for both.
-                            else:
-                                print("-- NPPES AND PECOS API DOWN --\n-- Using local NPPPES & PECOS data... --\n")
-
-                                # Grab NPPES and PECOS from local SQL DB.
-                                con = sqlite3.connect(db)
-                                cur = con.cursor()
-                                logging.debug('SQL Query start')
-                                # NPPES data.
-                                npirows = rows
-                                # PECOS data.
-                                cur.execute("select * from pecos where [NPI]=%s" %(npinumber))
-                                pecosrows = cur.fetchall()
-
-                                # Local NPPES SQL DB returned no rows, therefore no matching doctor by given NPI number.
-                                if len(npirows) == 0:
-                                    return "NO RESULTS FOUND FOR THAT NUMBER"
-                                # Local NPPES SQL DB returned rows, check for PECOS data mathcing given NPI.
-                                else:
-                                    # No matching local PECOS data found for given NPI, set PECOS data as empty.
-                                    if len(pecosrows) == 0:
-                                        pecosdata = {}
-                                        npireturns = rows_formatting(pecosdata, npirows, x)
-                                        x = x + 1
-                                        current_time = get_time()
-                                        logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                                        logcount = logcount+1
-                                        npireturns_all = npireturns_all + npireturns
-
-                                    # Local PECOS SQL DB returned rows, set appropriate key value pair based on returned data.
-                                    else:
-                                        for row in pecosrows:
-                                            # DME data is the 5th column, so element[4].
-                                            PECOS = row[4]
-                                            if PECOS == 'Y':
-                                                pecos = {'DME': "YES", 'NPI': npinumber}
-                                            else:
-                                                pecos = {'DME': "NO", 'NPI': npinumber}
-
-                                        npireturns = rows_formatting(pecos,npirows,x)
-                                        x = x + 1
-                                        npireturns_all = npireturns_all + npireturns
-
-                    # pAPIdown = 1, prevent PECOS API call as it has already failed
-                    else:
-                        # Only PECOS API down, use local (SQL) data.
-                        if isLocal == 0:
-                            print("-- PECOS API DOWN --\n-- Using local PECOS data... --\n")
-
-                            # Grab PECOS data from local SQL DB.
-                            con = sqlite3.connect(db)
-                            cur = con.cursor()
-                            now = datetime.now()
-                            current_time = now.strftime("%H:%M:%S")
-                            logging.debug('PECOS SQL Query start %s %s' %(today,current_time))
-                            cur.execute("select * from pecos where [NPI]=%s" %(npinumber))
-                            pecosrows = cur.fetchall()
-                            now = datetime.now()
-                            current_time = now.strftime("%H:%M:%S")
-                            logging.debug('PECOS SQL Query start %s %s' %(today,current_time))
-
-                            # Local PECOS SQL DB returned no rows, send DME of "NO" for current NPI hit from NPPES.
-                            if len(pecosrows) == 0:
-                                pecos = {'DME': "NO", 'NPI': npinumber}
-                                npireturns = resp_formatting(pecos, response, x)
-                                current_time = get_time()
-                                logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                                logcount = logcount+1
-                                npireturns_all = npireturns_all + npireturns
-
-                            # Local PECOS SQL DB returned rows, set appropriate key value pair based on returned data.
-                            else:
-                                for row in pecosrows:
-                                        # DME data is the 5th column, so element[4].
-                                        PECOS = row[4]
-                                        if PECOS == 'Y':
-                                            pecos = {'DME': "YES", 'NPI': npinumber}
-                                        else:
-                                            pecos = {'DME': "NO", 'NPI': npinumber}
-                                npireturns = resp_formatting(pecos,response,x)
-                                current_time = get_time()
-                                logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                                logcount = logcount+1
-                                npireturns_all = npireturns_all + npireturns
-
-                        # Both NPPES and PECOS api down, use local (SQL) data for both.
-                        else:
-                            print("-- NPPES AND PECOS API DOWN --\n-- Using local NPPPES & PECOS data... --\n")
-
-                            # Grab NPPES and PECOS from local SQL DB.
-                            con = sqlite3.connect(db)
-                            cur = con.cursor()
-                            now = datetime.now()
-                            current_time = now.strftime("%H:%M:%S")
-                            logging.debug('Local NPI & PECOS SQL Query start %s %s' %(today,current_time))
-                            # NPPES data.
-                            npirows = rows
-                            # PECOS data.
-                            cur.execute("select * from pecos where [NPI]=%s" %(npinumber))
-                            pecosrows = cur.fetchall()
-                            now = datetime.now()
-                            current_time = now.strftime("%H:%M:%S")
-                            logging.debug('Local NPI & PECOS SQL Query end %s %s' %(today,current_time))
-
-                            # Local NPPES SQL DB returned no rows, therefore no matching doctor by given NPI number.
-                            if len(npirows) == 0:
-                                return "NO RESULTS FOUND FOR THAT NUMBER"
-                            # Local NPPES SQL DB returned rows, check for PECOS data mathcing given NPI.
-                            else:
-                                # No matching local PECOS data found for given NPI, set PECOS data as empty.
-                                if len(pecosrows) == 0:
-                                    pecosdata = {}
-                                    npireturns = rows_formatting(pecosdata, npirows, x)
-                                    x = x + 1
-                                    npireturns_all = npireturns_all + npireturns
-
-                                # Local PECOS SQL DB returned rows, set appropriate key value pair based on returned data.
-                                else:
-                                    for row in pecosrows:
-                                        # DME data is the 5th column, so element[4].
-                                        PECOS = row[4]
-                                        if PECOS == 'Y':
-                                            pecos = {'DME': "YES", 'NPI': npinumber}
-                                        else:
-                                            pecos = {'DME': "NO", 'NPI': npinumber}
-
-                                    npireturns = rows_formatting(pecos,npirows,x)
-                                    x = x + 1
-                                    current_time = get_time()
-                                    logging.debug('Appending data... [%s] %s %s' %(logcount,today,current_time))
-                                    logcount = logcount+1
-                                    npireturns_all = npireturns_all + npireturns
-
-                print("Data complete\nDisplaying",count-1,"healthcare workers.")
-                now = datetime.now()
-                current_time = now.strftime("%H:%M:%S")
-                logging.debug('phone_check End %s %s' %(today,current_time))
-                et = time.time()
-                elapsed_time = et - st
-                resp = jsonify('<table id="respTable"><thead><tr id=sticky><th>NPI</th><th class=fitwidth>Name</th><th>Credential</th><th class=fitwidth>Practice #</th><th class=fitwidth>Mailing #</th><th class=fitwidth>Fax</th><th>Primary Practice</th><th>Mailing Address</th><th class=fitwidth>Other Practice</th><th>PECOS</th><th class=maxwidth>Email</th></tr></thead>' + npireturns_all + '</table><br><font color=red>Execution Time: ' + str(round(elapsed_time,2)) + ' seconds</font>')
-                return resp
+        print("Data complete\nDisplaying",count-1,"healthcare workers.")
+        RESULT_RECORDS.observe(count-1, route='doc_check')
+        logging.debug('doc_check End')
+        et = time.time()
+        elapsed_time = et - st
+        resp = jsonify('<table id="respTable"><thead><tr id=sticky><th>NPI</th><th class=fitwidth>Name</th><th>Credential</th><th class=fitwidth>Practice #</th><th class=fitwidth>Mailing #</th><th class=fitwidth>Fax</th><th>Primary Practice</th><th>Mailing Address</th><th class=fitwidth>Other Practice</th><th>PECOS</th><th class=maxwidth>Email</th></tr></thead>' + npireturns_all + '</table><br><font color=red>Execution Time: ' + str(round(elapsed_time,2)) + ' seconds</font>')
+        return resp
     # Doctor name was less than 3 letters.
     else:
         return "Doctor Name must be at least 3 letters"
 
+# Local doctor name search, no NPPES/PECOS API calls. MODE=prefix uses the FTS name index:
+# "SMI" matches last (or organization) names starting with SMI, "JO SMI" also needs a first name starting with JO.
+# MODE=fuzzy uses the phonetic index: "JON SMYTH" finds JOHN SMITH, closest spellings first.
+def local_doc_check(MODE, st):
+    logging.debug('doc_check %s search Begun', MODE)
+    DOCTOR_FIRSTNAME, DOCTOR_LASTNAME = split_name(request.form["DOCTORNAME"])
+    if DOCTOR_LASTNAME == "":
+        return "Doctor Name must be at least 2 letters"
+    DOC_STATE = ""
+    if "STATE" in request.form and len(request.form['STATE']) > 1:
+        DOC_STATE = re.sub(r"[^a-zA-Z0-9]", "",request.form['STATE'].upper())
+
+    rows, next_cursor, info = search_local_doctors(MODE, DOCTOR_FIRSTNAME, DOCTOR_LASTNAME, DOC_STATE)
+    logging.debug('doc_check %s search returned %s rows', MODE, len(rows))
+    if len(rows) == 0:
+        return "No doctor found matching '%s %s'" %(DOCTOR_FIRSTNAME,DOCTOR_LASTNAME)
+
+    npireturns_all = "".join(local_rows(rows))
+    RESULT_RECORDS.observe(len(rows), route='doc_check')
+    # Fuzzy search with more matches than it ranks.
+    truncated = ""
+    if info.get('truncated'):
+        truncated = '<br><font color=red>Only the closest matches are shown, add a first name or state to narrow the search.</font>'
+    et = time.time()
+    elapsed_time = et - st
+    resp = jsonify('<table id="respTable"><thead><tr id=sticky><th>NPI</th><th class=fitwidth>Name</th><th>Credential</th><th class=fitwidth>Practice #</th><th class=fitwidth>Mailing #</th><th class=fitwidth>Fax</th><th>Primary Practice</th><th>Mailing Address</th><th class=fitwidth>Other Practice</th><th>PECOS</th><th class=maxwidth>Email</th></tr></thead>' + npireturns_all + '</table><br><font color=red>Execution Time: ' + str(round(elapsed_time,2)) + ' seconds</font>' + truncated)
+    return resp
+
+# Helper function to split a doctor name into (first, last): "SMITH" is a last name, "JOHN SMITH" first and last.
+def split_name(DOCTORNAME):
+    with npi_trace.stage('normalize'):
+        DOCTORFULLNAME = [re.sub(r"[^a-zA-Z0-9]", "",name.upper()) for name in DOCTORNAME.split(" ")]
+        DOCTORFULLNAME = [name for name in DOCTORFULLNAME if name]
+    if len(DOCTORFULLNAME) == 0:
+        return "", ""
+    if len(DOCTORFULLNAME) == 1:
+        return "", DOCTORFULLNAME[0]
+    return DOCTORFULLNAME[0], DOCTORFULLNAME[1]
+
+# Helper function for the NPPES API doctor name search (first name and state optional), one page at a time.
+# Returns (npinumber, local row or None) lookups -- the local npi_lookup rows matching the name when NPPES is down --,
+# the cursor of the next page (None on the last page) and extra answer fields: {'truncated': True} when NPPES has more
+# matches than its skip limit lets us page through, {'restarted': True} when NPPES went down part way through the
+# pages and the search started over from the first local page (local pages are in a different order).
+# cursor (see decode_cursor) is None for the first page: NPPES pages map to its skip parameter, local pages to
+# NPI keyset pagination (npi > last NPI of the previous page).
+def search_doctors(DOCTOR_FIRSTNAME, DOCTOR_LASTNAME, DOC_STATE, page_size=NAME_SEARCH_LIMIT, cursor=None):
+    search_params = {'last_name': DOCTOR_LASTNAME}
+    sql = "select * from npi_lookup where last_name=?"
+    params = [DOCTOR_LASTNAME]
+    if DOCTOR_FIRSTNAME:
+        search_params['first_name'] = DOCTOR_FIRSTNAME
+        sql = sql + " AND first_name=?"
+        params.append(DOCTOR_FIRSTNAME)
+    if DOC_STATE:
+        search_params['state'] = DOC_STATE
+        sql = sql + " AND (mail_state=? OR practice_state=?)"
+        params.extend([DOC_STATE, DOC_STATE])
+    info = {}
+    if cursor is None or cursor['s'] == 'api':
+        skip = cursor['skip'] if cursor else 0
+        try:
+            response = nppes_search(search_params=search_params,limit=page_size,skip=skip or None)
+            log_payload('DOCTOR NAME SEARCH %s RETURNED: %s', search_params, response)
+            next_cursor = None
+            if len(response['results']) == page_size:
+                if skip + page_size <= NPPES_MAX_SKIP:
+                    next_cursor = {'s': 'api', 'skip': skip + page_size}
+                else:
+                    info['truncated'] = True
+            return [(results['number'], None) for results in response['results']], next_cursor, info
+        except requests.exceptions.RequestException as e:
+            print("[DOC] NPPES exception:",e)
+            FALLBACKS.inc(upstream='NPPES', site='doc_search')
+            if skip:
+                info['restarted'] = True
+    logging.debug('SQL Query start')
+    after = cursor['after'] if cursor is not None and cursor['s'] == 'local' else 0
+    rows = npi_db.query(sql + " AND npi>? ORDER BY npi LIMIT ?", params + [after, page_size + 1])
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = {'s': 'local', 'after': rows[-1]['npi']}
+    return [(row['npi'], row) for row in rows], next_cursor, info
+
+# Helper function for the local name search modes (prefix: FTS name index, fuzzy: phonetic index), one page at a time.
+# Returns the npi_lookup rows, the cursor of the next page (None on the last page) and extra answer fields
+# ({'truncated': True} when a fuzzy search had more matches than it can page through); cursor is None for the first page.
+def search_local_doctors(MODE, DOCTOR_FIRSTNAME, DOCTOR_LASTNAME, DOC_STATE, page_size=NAME_SEARCH_LIMIT, cursor=None):
+    info = {}
+    if MODE == 'fuzzy':
+        offset = cursor['offset'] if cursor else 0
+        rows, truncated = npi_db.search_phonetic(DOCTOR_LASTNAME, DOCTOR_FIRSTNAME, DOC_STATE, page_size + 1, offset)
+        if truncated:
+            info['truncated'] = True
+        next_cursor = {'s': 'fuzzy', 'offset': offset + page_size}
+    else:
+        rows = npi_db.search_names(DOCTOR_LASTNAME, DOCTOR_FIRSTNAME, DOC_STATE, page_size + 1, (cursor['rank'], cursor['after']) if cursor else None)
+        next_cursor = {'s': 'prefix', 'rank': rows[page_size - 1]['name_rank'], 'after': rows[page_size - 1]['npi']} if len(rows) > page_size else None
+    if len(rows) <= page_size:
+        return rows, None, info
+    return rows[:page_size], next_cursor, info
+
+# Helper functions for the opaque pagination cursors handed to API clients (URL-safe base64 JSON).
+def encode_cursor(cursor):
+    if cursor is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode().rstrip('=')
+
+# Returns the cursor, or raises ValueError for one this app did not hand out.
+def decode_cursor(text):
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(text + '=' * (-len(text) % 4)))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    # Every cursor value is an integer from 0 up to its largest possible value (skip/offset: matches skipped, up to
+    # what the search can page through; after: last NPI of the previous page; rank: its name rank tier).
+    expected = {'api': {'skip': NPPES_MAX_SKIP}, 'local': {'after': MAX_NPI},
+                'prefix': {'rank': npi_db.NAME_RANKS - 1, 'after': MAX_NPI}, 'fuzzy': {'offset': npi_db.FUZZY_CANDIDATES}}
+    if not isinstance(cursor, dict) or cursor.get('s') not in expected:
+        raise ValueError("Invalid cursor")
+    for key, largest in expected[cursor['s']].items():
+        if not isinstance(cursor.get(key), int) or isinstance(cursor[key], bool) or not 0 <= cursor[key] <= largest:
+            raise ValueError("Invalid cursor")
+    return cursor
+
+# Helper function for the local npi_lookup row(s) of an NPI (mapped index, SQLite without one).
+def local_npi_rows(npinumber):
+    rows = npi_index.npi_rows(npinumber)
+    if rows is None:
+        rows = npi_db.query("select * from npi_lookup where npi=?", (npinumber,))
+    return rows
+
+# Helper function for the local npi_lookup rows of every NPI with a (10 digit) phone/fax number.
+def local_phone_rows(phonenumber):
+    rows = npi_index.phone_rows(int(phonenumber))
+    if rows is None:
+        rows = npi_db.query("select * from npi_lookup where npi in (select npi from npi_phone where phone=?)", (int(phonenumber),))
+    return rows
+
+# Helper function to build table rows (or records) straight from local rows, PECOS status from local PECOS data;
+# deactivated NPIs dropped.
+def local_rows(rows, records=False):
+    rows = [row for row in rows if not npi_db.is_deactivated(row['npi'])]
+    pecos = get_local_pecos_dme([int(row['npi']) for row in rows])
+    with npi_trace.stage('format'):
+        if records:
+            return [row_record(pecos, row) for row in rows]
+        return [rows_formatting(pecos, rows, x) for x in range(len(rows))]
+
+# Helper function to run the per-NPI NPPES lookups of a multi-row search on the lookup pool.
+# lookups is a list of (npinumber, local row or None); results come back in the same order, deactivated NPIs dropped.
+# Results are HTML table rows, or provider records (see resp_record) with records=True.
+def lookup_rows(lookups, headers, records=False):
+    lookups = [lookup for lookup in lookups if not npi_db.is_deactivated(lookup[0])]
+    # PECOS DME status for the whole result set in one batch.
+    pecos = get_pecos_dme([lookup[0] for lookup in lookups], headers)
+    npireturns = lookup_pool.map(npi_trace.bind(lambda lookup: lookup_row(lookup[0], lookup[1], pecos, records)), lookups)
+    return [npireturn for npireturn in npireturns if npireturn]
+
+# Helper function to build the table row for one NPI.
+# Uses the NPPES API, falling back to the local row (straight away while the NPPES breaker is open).
+def lookup_row(npinumber, row, pecos, records=False):
+    isLocal = 0
+
+    # try NPPES api call (or cached NPPES record).
+    try:
+        response = nppes_lookup(npinumber)
+    # NPPES API down, use local (SQL) data.
+    except requests.exceptions.RequestException as e:
+        print("[LOOKUP] NPPES exception:",e)
+        FALLBACKS.inc(upstream='NPPES', site='lookup')
+        isLocal = 1
+
+    # No results -- this should never happen, given that the NPI came from a search.
+    # But if it does (or there is no local row to fall back on)... Move on.
+    if (isLocal == 0 and response['result_count'] == 0) or (isLocal == 1 and row is None):
+        return ""
+
+    logging.debug('Appending data... [%s]', npinumber)
+    with npi_trace.stage('format'):
+        # NPPES API working.
+        if isLocal == 0:
+            if records:
+                return resp_record(pecos, response['results'][0])
+            return resp_formatting(pecos, response, 0)
+        # NPPES API down, use the local row.
+        else:
+            if records:
+                return row_record(pecos, row)
+            return rows_formatting(pecos, [row], 0)
+
+# Helper function to resolve PECOS DME status for a list of NPIs.
+# Returns a {NPI: "YES"/"NO"} map; cached NPIs skip the PECOS API, NPIs it could not resolve are looked up locally.
+def get_pecos_dme(npis, headers):
+    npis = list(dict.fromkeys(int(npi) for npi in npis))
+    pecos = {}
+    for npi in npis:
+        dme = pecos_cache.get(npi)
+        if dme is not MISS:
+            pecos[npi] = dme
+    npis = [npi for npi in npis if npi not in pecos]
+    pecos.update(dict.fromkeys(npis, "NO"))
+    unresolved = []
+
+    # PECOS API, PECOS_BATCH NPIs per call.
+    for i in range(0, len(npis), PECOS_BATCH):
+        batch = npis[i:i + PECOS_BATCH]
+        if unresolved:
+            # PECOS API already failed for this request, don't wait on it again.
+            unresolved.extend(batch)
+            continue
+        params = [('column', 'DME,NPI'), ('size', len(batch)), ('filter[NPI][condition][path]', 'NPI'), ('filter[NPI][condition][operator]', 'IN')]
+        params.extend(('filter[NPI][condition][value][' + str(n + 1) + ']', npi) for n, npi in enumerate(batch))
+        try:
+            for pecosdata in pecos_get(params, headers):
+                if pecosdata.get('DME') in ("Y", "YES") and int(pecosdata['NPI']) in pecos:
+                    pecos[int(pecosdata['NPI'])] = "YES"
+            for npi in batch:
+                pecos_cache.set(npi, pecos[npi])
+        # PECOS API down (or answered with something that is not PECOS rows, see npi_upstream.UpstreamError).
+        except requests.exceptions.RequestException as e:
+            print("[PECOS] PECOS exception:",e)
+            FALLBACKS.inc(upstream='PECOS', site='pecos')
+            unresolved.extend(batch)
+
+    # PECOS API down, use local (SQL) data.
+    if unresolved:
+        print("-- PECOS API DOWN --\n-- Using local PECOS data... --\n")
+        pecos.update(get_local_pecos_dme(unresolved))
+    return pecos
+
 # Helper function for formatting SQL returns (NPPES API down).
-def rows_formatting(pecosdata, rows, x):
-    PECOS = "NO"
-    # PECOS API returns a list of a single dictionary for some reason (??)
-    if isinstance (pecosdata, list) and pecosdata:
-        pecosdata = pecosdata[0]
-    # Dictionary from local PECOS SQL return (PECOS API down).
-    if isinstance (pecosdata, dict) and pecosdata:
-        for key in pecosdata:
-            if "DME" in key:
-                #print(".get DME:",pecosdata.get('DME'))
-                PECOS = pecosdata.get('DME')
-                if PECOS == "Y":
-                    PECOS = "YES"
+def rows_formatting(pecos, rows, x):
+    # PECOS DME status from the NPI -> DME map, NO if unknown.
+    PECOS = pecos.get(int(rows[x]['npi']), "NO")
 
     # Set approprite data.
-    npi_number = str(rows[x][0])
-    first_name = rows[x][6]
-    middle_name = rows[x][7]
-    last_name = rows[x][5]
-    telephone_number = rows[x][26]
-    telephone_numberp = rows[x][34]
-    fax_numberp = rows[x][35]
-    fax_numberm = rows[x][27]
-    maddress1 = rows[x][20]
-    maddress2 = rows[x][21]
-    mcity = rows[x][22]
-    mstate = rows[x][23]
-    mpostal = rows[x][24]
-    paddress1 = rows[x][28]
-    paddress2 = rows[x][29]
-    pcity = rows[x][30]
-    pstate = rows[x][31]
-    ppostal = rows[x][32]
-    credential = rows[x][10]
+    npi_number = str(rows[x]['npi'])
+    first_name = rows[x]['first_name']
+    middle_name = rows[x]['middle_name']
+    last_name = rows[x]['last_name']
+    # Organizations have no first/last name.
+    if last_name == "":
+        last_name = organization_name(rows[x])
+    telephone_number = rows[x]['mail_phone']
+    telephone_numberp = rows[x]['practice_phone']
+    fax_numberp = rows[x]['practice_fax']
+    fax_numberm = rows[x]['mail_fax']
+    maddress1 = rows[x]['mail_address1']
+    maddress2 = rows[x]['mail_address2']
+    mcity = rows[x]['mail_city']
+    mstate = rows[x]['mail_state']
+    mpostal = rows[x]['mail_postal']
+    paddress1 = rows[x]['practice_address1']
+    paddress2 = rows[x]['practice_address2']
+    pcity = rows[x]['practice_city']
+    pstate = rows[x]['practice_state']
+    ppostal = rows[x]['practice_postal']
+    credential = rows[x]['credential']
     primaryPractice = ""
     endpoint = ""
     
@@ -1139,23 +555,9 @@ def rows_formatting(pecosdata, rows, x):
     return npireturns
 
 # Response formatting helper function (NPPES API up).
-def resp_formatting(pecosdata, response, x):
-    # Set default DME value of NO
-    PECOS = {"DME" : "NO"}
-    # PECOS API returns a list of a single dictionary for some reason (??)
-    if isinstance (pecosdata, list) and pecosdata:
-        pecosdata = pecosdata[0]
-    # Dictionary from local PECOS SQL return (PECOS API down).
-    if isinstance (pecosdata, dict) and pecosdata:
-        for key in pecosdata:
-            if "DME" in key:
-                PECOS = pecosdata.get('DME')
-                #print(pecosdata.get('DME'))
-                if PECOS == "Y" or PECOS == "YES":
-                    pecosdata = {"DME" : "YES"}
-    # If it is not a dict/list with >=1 element, it is empty, therefore use default value set above.
-    else:
-        pecosdata = PECOS
+def resp_formatting(pecos, response, x):
+    # PECOS DME status from the NPI -> DME map, NO if unknown.
+    PECOS = pecos.get(int(response['results'][x]['number']), "NO")
 
     # Set appropriate data.
     if "endpoints" in response['results'][x]:
@@ -1209,22 +611,65 @@ def resp_formatting(pecosdata, response, x):
     " " + response['results'][x]['addresses'][0]['state'] + " " + response['results'][x]['addresses'][0]['postal_code'] + "</td>" + \
     "<td>" + response['results'][x]['addresses'][1]['address_1'] + " " + response['results'][x]['addresses'][1]['address_2'] + " " + response['results'][x]['addresses'][1]['city'] + \
     " " + response['results'][x]['addresses'][1]['state'] + " " + response['results'][x]['addresses'][1]['postal_code'] + "</td>" + "<td>" + primaryPractice + "</td>" + \
-    "<td class=pecos>" + pecosdata.get('DME') + "</td>" + "<td class=maxwidth>" + endpoint + "</td>" + "</tr>"
+    "<td class=pecos>" + PECOS + "</td>" + "<td class=maxwidth>" + endpoint + "</td>" + "</tr>"
     return npireturns
 
+# Provider record (JSON API) for an NPPES API result.
+def resp_record(pecos, result):
+    basic = result.get('basic', {})
+    addresses = dict((address.get('address_purpose'), address) for address in result.get('addresses', []))
+    mailing = addresses.get('MAILING', {})
+    practice = addresses.get('LOCATION', {})
+    endpoints = result.get('endpoints', [])
+    return {'npi': int(result['number']), 'first_name': basic.get('first_name', ''), 'middle_name': basic.get('middle_name', ''),
+            'last_name': basic.get('last_name', ''), 'organization_name': basic.get('organization_name', ''), 'credential': basic.get('credential', ''),
+            'mail_phone': mailing.get('telephone_number', ''), 'mail_fax': mailing.get('fax_number', ''),
+            'practice_phone': practice.get('telephone_number', ''), 'practice_fax': practice.get('fax_number', ''),
+            'mail_address': address_record(mailing), 'practice_address': address_record(practice),
+            'other_practices': [address_record(location) for location in result.get('practiceLocations', [])],
+            'endpoint': endpoints[0].get('endpoint', '') if endpoints else '',
+            'dme': pecos.get(int(result['number']), "NO") == "YES", 'source': 'api'}
+
+# Provider record (JSON API) for a local npi_lookup row.
+def row_record(pecos, row):
+    return {'npi': int(row['npi']), 'first_name': row['first_name'], 'middle_name': row['middle_name'],
+            'last_name': row['last_name'], 'organization_name': organization_name(row), 'credential': row['credential'],
+            'mail_phone': row['mail_phone'], 'mail_fax': row['mail_fax'],
+            'practice_phone': row['practice_phone'], 'practice_fax': row['practice_fax'],
+            'mail_address': {'address_1': row['mail_address1'], 'address_2': row['mail_address2'], 'city': row['mail_city'],
+                             'state': row['mail_state'], 'postal_code': row['mail_postal']},
+            'practice_address': {'address_1': row['practice_address1'], 'address_2': row['practice_address2'], 'city': row['practice_city'],
+                                 'state': row['practice_state'], 'postal_code': row['practice_postal']},
+            'other_practices': [], 'endpoint': '',
+            'dme': pecos.get(int(row['npi']), "NO") == "YES", 'source': 'local'}
+
+# Organization name of a local npi_lookup row ('' for individuals, and for snapshots built before npi_lookup had it).
+def organization_name(row):
+    if 'organization_name' not in row.keys():
+        return ''
+    return row['organization_name'] or ''
+
+# Address part of a provider record.
+def address_record(address):
+    return {'address_1': address.get('address_1', ''), 'address_2': address.get('address_2', ''), 'city': address.get('city', ''),
+            'state': address.get('state', ''), 'postal_code': address.get('postal_code', '')}
+
 # Helper function to get local NPPES data
 def get_local_nppes_data():
     print(".")
 
 # Helper function to get local PECOS data
-def get_local_pecos_data():
-    print(".")
-
-# Helper function for current time.
-def get_time():
-    now = datetime.now()
-    current_time = now.strftime("%H:%M:%S")
-    return current_time
+# Returns a {NPI: "YES"/"NO"} map for the given NPIs, one query per PECOS_BATCH NPIs.
+def get_local_pecos_dme(npis):
+    pecos = dict.fromkeys(npis, "NO")
+    logging.debug('PECOS SQL Query start')
+    for i in range(0, len(npis), PECOS_BATCH):
+        batch = npis[i:i + PECOS_BATCH]
+        for npi, dme in npi_db.query("select [NPI], [DME] from pecos where [NPI] in (%s)" %(",".join("?" * len(batch))), batch):
+            if dme == 'Y':
+                pecos[int(npi)] = "YES"
+    logging.debug('PECOS SQL Query end')
+    return pecos
 
 # Header helper function.
 def set_headers():
@@ -1234,6 +679,256 @@ def set_headers():
     headers["Access-Control-Allow-Methods"] = "DELETE, POST, GET, OPTIONS"
     return headers
 
+# JSON API v1: the same searches as the routes above, answered with provider records
+# ({'count': n, 'results': [record, ...], 'elapsed': seconds}) or {'error': message} with a 4xx status.
+
+# Provider record for an NPI.
+@npi_app.route('/api/v1/npi/<npinumber>', methods=['GET'])
+def api_npi(npinumber):
+    st = time.time()
+    with npi_trace.stage('normalize'):
+        npinumber = re.sub(r"[^0-9]", "", npinumber)
+    if len(npinumber) != 10:
+        return api_error("NPI number must be exactly 10 digits", 400)
+    if npi_db.is_deactivated(npinumber):
+        return api_error("NPI %s has been deactivated" %npinumber, 410)
+    try:
+        response = nppes_lookup(npinumber)
+        lookups = [(npinumber, None)] if response['result_count'] > 0 else []
+    # NPPES API down, use local (SQL) data.
+    except requests.exceptions.RequestException as e:
+        print("[API] NPPES exception:",e)
+        FALLBACKS.inc(upstream='NPPES', site='api_npi')
+        lookups = [(npinumber, row) for row in local_npi_rows(npinumber)]
+    return api_records(lookup_rows(lookups, set_headers(), records=True), st, "No results found for %s" %npinumber)
+
+# Provider records for every NPI with a phone/fax number.
+@npi_app.route('/api/v1/phone/<phonenumber>', methods=['GET'])
+def api_phone(phonenumber):
+    st = time.time()
+    with npi_trace.stage('normalize'):
+        phonenumber = re.sub(r"[^0-9]", "", phonenumber)
+    if len(phonenumber) != 10:
+        return api_error("%s is not a valid phone number." %phonenumber, 400)
+    lookups = [(row['npi'], row) for row in local_phone_rows(phonenumber)]
+    if request.args.get('stream') == '1':
+        return api_stream(completed_records(lookups, set_headers()), st, "No results found for %s" %phonenumber)
+    return api_records(lookup_rows(lookups, set_headers(), records=True), st, "No results found for %s" %phonenumber)
+
+# Provider records for a doctor name: ?name=[first ]last&state=PA&mode=prefix|fuzzy (mode optional: NPPES search).
+# Paginated: page_size (default 50, at most MAX_PAGE_SIZE) results per page; pass the answer's next_cursor as cursor
+# for the next page (next_cursor is null on the last one). "truncated": true means there were more matches than can be
+# paged through (NPPES searches skip at most NPPES_MAX_SKIP matches, fuzzy searches page through the closest
+# NPI_FUZZY_CANDIDATES): narrow the search to see them. "restarted": true means NPPES went down part way through the
+# pages, and this is the first page of the same search answered from local data: start over from it.
+@npi_app.route('/api/v1/doctors', methods=['GET'])
+def api_doctors():
+    st = time.time()
+    MODE = request.args.get('mode', '')
+    DOCTOR_FIRSTNAME, DOCTOR_LASTNAME = split_name(request.args.get('name', ''))
+    DOC_STATE = re.sub(r"[^a-zA-Z0-9]", "", request.args.get('state', '').upper())
+    try:
+        page_size = int(request.args.get('page_size', NAME_SEARCH_LIMIT))
+    except ValueError:
+        return api_error("page_size must be a number", 400)
+    try:
+        cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError:
+        return api_error("Invalid cursor", 400)
+    if page_size < 1 or page_size > MAX_PAGE_SIZE:
+        return api_error("page_size must be between 1 and %s" %MAX_PAGE_SIZE, 400)
+    if MODE in ('prefix', 'fuzzy'):
+        if len(DOCTOR_LASTNAME) < 2:
+            return api_error("Doctor Name must be at least 2 letters", 400)
+        if cursor is not None and cursor['s'] != MODE:
+            return api_error("Invalid cursor", 400)
+        rows, next_cursor, info = search_local_doctors(MODE, DOCTOR_FIRSTNAME, DOCTOR_LASTNAME, DOC_STATE, page_size, cursor)
+        records = local_rows(rows, records=True)
+        if request.args.get('stream') == '1':
+            return api_stream(records, st, "No doctor found matching '%s %s'" %(DOCTOR_FIRSTNAME,DOCTOR_LASTNAME), dict(info, next_cursor=encode_cursor(next_cursor)))
+    else:
+        if len(DOCTOR_FIRSTNAME + DOCTOR_LASTNAME) < 3:
+            return api_error("Doctor Name must be at least 3 letters", 400)
+        if cursor is not None and cursor['s'] not in ('api', 'local'):
+            return api_error("Invalid cursor", 400)
+        lookups, next_cursor, info = search_doctors(DOCTOR_FIRSTNAME, DOCTOR_LASTNAME, DOC_STATE, page_size, cursor)
+        if request.args.get('stream') == '1':
+            return api_stream(completed_records(lookups, set_headers()), st, "No doctor found by the name '%s %s'" %(DOCTOR_FIRSTNAME,DOCTOR_LASTNAME), dict(info, next_cursor=encode_cursor(next_cursor)))
+        records = lookup_rows(lookups, set_headers(), records=True)
+    return api_records(records, st, "No doctor found by the name '%s %s'" %(DOCTOR_FIRSTNAME,DOCTOR_LASTNAME), dict(info, next_cursor=encode_cursor(next_cursor)))
+
+# Batch lookup of NPIs and phone numbers, resolved against the local snapshot (and verified upstream with verify:
+# NPIs not in the snapshot are then looked up in NPPES too; phones can only be found locally, NPPES has no phone search).
+# Takes JSON ({"npis": [...], "phones": [...], "verify": false}) or a CSV (upload field "file", or the request body)
+# with npi and/or phone columns, verify=1 as a query parameter (see BATCH_VERIFY_VALUES). Duplicates are looked up once.
+# Streams NDJSON: one {"type": "npi"|"phone", "query": ..., "results": [record, ...]} line per distinct NPI/phone
+# (with "deactivated" or "error" where that applies), then a {"done": true, ...} summary line.
+@npi_app.route('/api/v1/batch', methods=['POST'])
+def api_batch():
+    st = time.time()
+    if request.is_json:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return api_error("Batch must be a JSON object with npis and/or phones lists", 400)
+        npis = data.get('npis', [])
+        phones = data.get('phones', [])
+        if not isinstance(npis, list) or not isinstance(phones, list) or not all(isinstance(query, (str, int)) and not isinstance(query, bool) for query in npis + phones):
+            return api_error("npis and phones must be lists of strings or numbers", 400)
+        npis = [str(npi) for npi in npis]
+        phones = [str(phone) for phone in phones]
+        verify = data.get('verify', False)
+        if not isinstance(verify, bool):
+            return api_error("verify must be true or false", 400)
+    else:
+        if 'file' in request.files:
+            text = request.files['file'].read().decode('utf-8-sig', 'replace')
+        else:
+            text = request.get_data(as_text=True)
+        reader = csv.DictReader(io.StringIO(text))
+        columns = dict((column.strip().lower(), column) for column in reader.fieldnames or [])
+        if 'npi' not in columns and 'phone' not in columns:
+            return api_error("Batch CSV needs an npi and/or phone column", 400)
+        npis = []
+        phones = []
+        for row in reader:
+            if 'npi' in columns and row.get(columns['npi']):
+                npis.append(row[columns['npi']])
+            if 'phone' in columns and row.get(columns['phone']):
+                phones.append(row[columns['phone']])
+        verify = request.args.get('verify', '0').strip().lower()
+        if verify not in BATCH_VERIFY_VALUES:
+            return api_error("verify must be 1/true/yes or 0/false/no", 400)
+        verify = BATCH_VERIFY_VALUES[verify]
+    # De-duplicate on the digits, keeping first-seen order.
+    npis = list(dict.fromkeys(re.sub(r"[^0-9]", "", npi) for npi in npis))
+    phones = list(dict.fromkeys(re.sub(r"[^0-9]", "", phone) for phone in phones))
+    if len(npis) + len(phones) > BATCH_MAX:
+        return api_error("Batch has %s NPIs/phones, at most %s allowed" %(len(npis) + len(phones), BATCH_MAX), 413)
+    logging.debug('batch Begun: %s NPIs, %s phones, verify=%s', len(npis), len(phones), verify)
+    headers = set_headers()
+
+    def generate():
+        found = 0
+        for kind, queries in (('npi', npis), ('phone', phones)):
+            for i in range(0, len(queries), BATCH_CHUNK):
+                for line in batch_chunk(kind, queries[i:i + BATCH_CHUNK], verify, headers):
+                    if line.get('results'):
+                        found = found + 1
+                    yield json.dumps(line) + "\n"
+        yield json.dumps({'done': True, 'npis': len(npis), 'phones': len(phones), 'found': found, 'elapsed': round(time.time() - st, 3)}) + "\n"
+    return Response(npi_trace.bind_stream(generate()), mimetype='application/x-ndjson')
+
+# Helper function resolving one chunk of a batch; returns its result lines in query order.
+def batch_chunk(kind, queries, verify, headers):
+    lines = []
+    lookups = []
+    for query in queries:
+        line = {'type': kind, 'query': query, 'results': []}
+        lines.append(line)
+        if len(query) != 10:
+            line['error'] = "NPI number must be exactly 10 digits" if kind == 'npi' else "%s is not a valid phone number." %query
+        elif kind == 'npi' and npi_db.is_deactivated(query):
+            line['deactivated'] = True
+        else:
+            rows = local_npi_rows(query) if kind == 'npi' else local_phone_rows(query)
+            for row in rows:
+                if not npi_db.is_deactivated(row['npi']):
+                    lookups.append((line, int(row['npi']), row))
+            # Not in the snapshot (e.g. enumerated since it was built): NPPES may still have it.
+            if verify and kind == 'npi' and not rows:
+                lookups.append((line, int(query), None))
+    # PECOS DME status for the whole chunk: local data, or the PECOS API (falling back to local data) when verifying.
+    npis = [npi for line, npi, row in lookups]
+    pecos = get_pecos_dme(npis, headers) if verify else get_local_pecos_dme(list(dict.fromkeys(npis)))
+    if verify:
+        # Upstream NPPES verification (cached, local row if NPPES is down) at bounded concurrency.
+        records = batch_pool.map(npi_trace.bind(lambda lookup: lookup_row(lookup[1], lookup[2], pecos, True)), lookups)
+    else:
+        records = [row_record(pecos, row) for line, npi, row in lookups]
+    for (line, npi, row), record in zip(lookups, records):
+        if record:
+            line['results'].append(record)
+    return lines
+
+# Helper function for a JSON API answer: the records (plus any extra fields), or a 404 error when there are none.
+def api_records(records, st, not_found, extra=None):
+    RESULT_RECORDS.observe(len(records), route=request.endpoint)
+    if len(records) == 0:
+        return api_error(not_found, 404)
+    answer = {'count': len(records), 'results': records, 'elapsed': round(time.time() - st, 3)}
+    answer.update(extra or {})
+    return jsonify(answer)
+
+# Helper function for a streamed (?stream=1) JSON API answer: NDJSON, one record per line as it becomes available,
+# then a {"done": true, "count": n, "elapsed": seconds} line (plus any extra fields, with "error" when nothing was found,
+# and the request's complete trace with ?trace=1).
+def api_stream(records, st, not_found, extra=None):
+    route = request.endpoint
+    show_trace = request.args.get('trace') == '1'
+    def generate():
+        count = 0
+        for record in records:
+            # Records, and any other lines (e.g. completed_records' DME flags) passed through as they are.
+            if 'npi' in record:
+                count = count + 1
+            yield json.dumps(record) + "\n"
+        done = {'done': True, 'count': count, 'elapsed': round(time.time() - st, 3)}
+        done.update(extra or {})
+        RESULT_RECORDS.observe(count, route=route)
+        if count == 0:
+            done['error'] = not_found
+        if show_trace and npi_trace.current() is not None:
+            done['trace'] = npi_trace.current().payload()
+        yield json.dumps(done) + "\n"
+    return Response(npi_trace.bind_stream(generate()), mimetype='application/x-ndjson')
+
+# Helper function yielding the provider records of lookups (see lookup_rows) in the order their lookups complete.
+# The PECOS batch runs alongside the NPPES lookups, so it does not hold back the first records: records finished
+# before it carry "dme": null, and once it resolves their flags follow in one {"dme": {npi: true/false, ...}} line.
+def completed_records(lookups, headers):
+    lookups = [lookup for lookup in lookups if not npi_db.is_deactivated(lookup[0])]
+    pecos_future = lookup_pool.submit(npi_trace.bind(get_pecos_dme), [lookup[0] for lookup in lookups], headers)
+    futures = [lookup_pool.submit(npi_trace.bind(lookup_row), lookup[0], lookup[1], {}, True) for lookup in lookups]
+    pecos = None
+    pending = []
+    for future in as_completed(futures + [pecos_future]):
+        if future is pecos_future:
+            try:
+                pecos = future.result()
+            except Exception:
+                logging.exception('PECOS lookup failed')
+                pecos = {}
+            if pending:
+                yield {'dme': dict((str(npi), pecos.get(npi, "NO") == "YES") for npi in pending)}
+            continue
+        try:
+            record = future.result()
+        except Exception:
+            # One bad record should not end the stream.
+            logging.exception('Provider lookup failed')
+            continue
+        if record:
+            if pecos is None:
+                record['dme'] = None
+                pending.append(record['npi'])
+            else:
+                record['dme'] = pecos.get(record['npi'], "NO") == "YES"
+            yield record
+
+# Helper function for a JSON API error.
+def api_error(message, status):
+    return jsonify({'error': message}), status
+
+# NPPES/PECOS cache hit/miss counters.
+@npi_app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify({'nppes': nppes_cache.stats(), 'pecos': pecos_cache.stats()})
+
+# Route latencies, NPPES/PECOS call latencies and errors, local fallbacks and SQLite query times (Prometheus text format).
+@npi_app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(npi_metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # Post landing page.
 @npi_app.route('/npi', methods=['POST', 'GET'])
 def npi():
@@ -0,0 +1,511 @@
+# Shared helpers for the database builders (npi_csv_file_get.py, npi_csv_pecos_get.py).
+# Builders never touch the live database: they build a new snapshot file, validate it and then swap it in.
+import os
+import io
+import re
+import csv
+import sys
+import glob
+import json
+import time
+import fcntl
+import struct
+import itertools
+import sqlite3
+import tempfile
+from urllib.request import urlopen
+from zipfile import ZipFile, is_zipfile
+from array import array
+from npi_db import DB_PATH, LOOKUP_COLUMNS
+from npi_index import INDEX_MAGIC, RECORD_SUFFIX, NPI_INDEX_SUFFIX, PHONE_INDEX_SUFFIX, FIELD_SEP, ROW_SEP
+from npi_phonetic import soundex
+
+
+# Snapshots kept on disk: the live one plus the previous one(s) to roll back to.
+KEEP_SNAPSHOTS = int(os.environ.get('NPI_KEEP_SNAPSHOTS', 2))
+
+
+# Downloads are copied DOWNLOAD_CHUNK bytes at a time into a temp file that stays in memory up to SPOOL_MAX bytes
+# and rolls over to disk (in NPI_BUILD_TMP, default the system temp dir) past that.
+DOWNLOAD_CHUNK = 1024 * 1024
+SPOOL_MAX = int(os.environ.get('NPI_SPOOL_MAX', 64 * 1024 * 1024))
+BUILD_TMP = os.environ.get('NPI_BUILD_TMP') or None
+
+
+# Rows per executemany() batch (one transaction each), and page cache (KiB) for building.
+LOAD_BATCH = int(os.environ.get('NPI_LOAD_BATCH', 50000))
+BUILD_CACHE_KB = int(os.environ.get('NPI_BUILD_CACHE_KB', 1024 * 1024))
+
+# NPPES/PECOS CSV fields can be long (e.g. lists of other identifiers).
+csv.field_size_limit(min(sys.maxsize, 2 ** 31 - 1))
+
+
+# Columns of the npi_name_fts full-text name index and the NPPES column(s) each one is built from.
+NAME_INDEX_COLUMNS = [
+    ('first_name', "[Provider First Name]"),
+    ('last_name', "[Provider Last Name (Legal Name)]"),
+    ('other_first_name', "[Provider Other First Name]"),
+    ('other_last_name', "[Provider Other Last Name]"),
+    ('org_name', "[Provider Organization Name (Legal Business Name)] || ' ' || [Provider Other Organization Name]"),
+]
+
+
+# Period (YYYYMMDD-YYYYMMDD) in the name of an NPPES archive's npidata file, e.g. npidata_pfile_20050523-20241013.csv.
+NPIDATA_PERIOD = re.compile(r'npidata_pfile_(\d{8})-(\d{8})', re.IGNORECASE)
+
+
+# Phone/fax columns of the npidata file indexed in npi_phone, by kind.
+PHONE_COLUMNS = [
+    ('mail_phone', 'Provider Business Mailing Address Telephone Number'),
+    ('mail_fax', 'Provider Business Mailing Address Fax Number'),
+    ('practice_phone', 'Provider Business Practice Location Address Telephone Number'),
+    ('practice_fax', 'Provider Business Practice Location Address Fax Number'),
+]
+
+
+# Raised when a freshly built snapshot fails validation; the live snapshot is left in place.
+class SnapshotError(Exception):
+    pass
+
+
+# Build lock held by this builder process (see lock_builds).
+build_lock = None
+
+
+# Take the build lock (DB_PATH + '.lock') for the rest of the process, waiting for a running builder to finish.
+# Every builder copies or replaces the live snapshot and then publishes its own, so they run one at a time.
+def lock_builds():
+    global build_lock
+    if build_lock is not None:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(DB_PATH)), exist_ok=True)
+    lock = open(DB_PATH + '.lock', 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print("Another build is running, waiting for it to finish...")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    build_lock = lock
+
+
+# Helper function to create a new (versioned) snapshot file next to the live database; returns its path.
+# Named by start time (to the microsecond) and process ID, and created exclusively, so it is never an existing file.
+def new_snapshot():
+    db_dir = os.path.dirname(os.path.abspath(DB_PATH))
+    os.makedirs(db_dir, exist_ok=True)
+    while True:
+        now = time.time()
+        path = os.path.join(db_dir, 'npi-' + time.strftime('%Y%m%d%H%M%S', time.localtime(now)) + '%06d' % ((now % 1) * 1000000) + '-' + str(os.getpid()) + '.db')
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+            return path
+        except FileExistsError:
+            continue
+
+
+# Helper function for the snapshot file the live database currently is, None before the first build.
+def live_snapshot():
+    if os.path.exists(DB_PATH):
+        return os.path.realpath(DB_PATH)
+    return None
+
+
+# Download an archive in chunks into a spooled temp file; returns the file positioned at the start.
+def download_archive(url):
+    http_response = urlopen(url)
+    archive = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX, dir=BUILD_TMP)
+    downloaded = 0
+    report = 100 * DOWNLOAD_CHUNK
+    while True:
+        chunk = http_response.read(DOWNLOAD_CHUNK)
+        if not chunk:
+            break
+        archive.write(chunk)
+        downloaded = downloaded + len(chunk)
+        if downloaded >= report:
+            print("Downloaded " + str(downloaded // DOWNLOAD_CHUNK) + " MB...")
+            report = report + 100 * DOWNLOAD_CHUNK
+    archive.seek(0)
+    print("Download complete: " + str(round(downloaded / DOWNLOAD_CHUNK, 1)) + " MB.")
+    return archive
+
+
+# Binary stream wrapper counting the bytes read through it, so loaders can report progress from the byte offset.
+class CountingReader(io.RawIOBase):
+    def __init__(self, raw, size):
+        self.raw = raw
+        self.size = size
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.raw.read(len(buffer))
+        buffer[:len(data)] = data
+        self.bytes_read = self.bytes_read + len(data)
+        return len(data)
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+# Open the CSV inside an archive as a text stream without extracting it to disk.
+# The first zip member whose name contains pattern (header-only files skipped) is streamed; a plain CSV is read as is.
+# For an optional file (required=False) None is returned when the archive (or a plain CSV) does not have it.
+def open_csv(archive, pattern, required=True):
+    if not is_zipfile(archive):
+        if not required:
+            return None
+        size = archive.seek(0, io.SEEK_END)
+        archive.seek(0)
+        return text_stream(archive, size)
+    archive.seek(0)
+    zipfile = ZipFile(archive)
+    for info in zipfile.infolist():
+        if pattern.lower() in info.filename.lower() and 'fileheader' not in info.filename.lower():
+            print("Streaming " + info.filename + " from archive.")
+            return text_stream(zipfile.open(info), info.file_size)
+    if not required:
+        return None
+    raise FileNotFoundError("No " + pattern + " file in archive")
+
+
+# Helper function to wrap a binary stream of size bytes as counted, buffered UTF-8 text.
+def text_stream(raw, size):
+    return io.TextIOWrapper(io.BufferedReader(CountingReader(raw, size), DOWNLOAD_CHUNK), encoding='utf-8', errors='replace', newline='')
+
+
+# Build-time pragmas: a snapshot is a private new file until it is published,
+# so journaling and fsyncs buy nothing (a failed build is simply deleted).
+def build_pragmas(conn):
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('PRAGMA locking_mode=EXCLUSIVE')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-%d' % BUILD_CACHE_KB)
+
+
+# Load a CSV text stream (from open_csv) into a new table with one prepared INSERT,
+# LOAD_BATCH rows per executemany() and transaction. Columns are TEXT except integer_columns.
+# Returns the load's throughput report.
+def bulk_load(conn, table, csv_text, integer_columns=('NPI',)):
+    st = time.time()
+    counter = csv_text.buffer.raw
+    reader = csv.reader(csv_text)
+    header = next(reader)
+    width = len(header)
+    conn.execute("DROP TABLE IF EXISTS [" + table + "]")
+    conn.execute("CREATE TABLE [" + table + "] (" + ", ".join("[" + column + "] " + ("INTEGER" if column in integer_columns else "TEXT") for column in header) + ")")
+    insert = "INSERT INTO [" + table + "] VALUES (" + ",".join("?" * width) + ")"
+    rows = 0
+    while True:
+        batch = list(itertools.islice(reader, LOAD_BATCH))
+        if not batch:
+            break
+        for i, row in enumerate(batch):
+            # Ragged line: pad/truncate to the header.
+            if len(row) != width:
+                batch[i] = (row + [''] * width)[:width]
+        conn.execute("BEGIN")
+        conn.executemany(insert, batch)
+        conn.execute("COMMIT")
+        rows = rows + len(batch)
+        et = time.time() - st
+        pct = counter.bytes_read / counter.size if counter.size else 0
+        print(table + ": " + str(rows) + " rows, " + str(round(pct * 100, 2)) + "% complete, " + str(round(rows / et)) + " rows/s after", round(et, 2), "seconds.")
+    et = time.time() - st
+    report = {'rows': rows, 'bytes': counter.bytes_read, 'seconds': round(et, 2),
+              'rows_per_second': round(rows / et) if et else 0, 'mb_per_second': round(counter.bytes_read / 1024 ** 2 / et, 2) if et else 0}
+    print(table + " load complete: " + str(report['rows']) + " rows, " + str(round(report['bytes'] / 1024 ** 2, 1)) + " MB in " + str(report['seconds']) + " seconds (" + str(report['rows_per_second']) + " rows/s, " + str(report['mb_per_second']) + " MB/s).")
+    return report
+
+
+# Create an index, printing and recording (in report['indexes']) how long it took.
+def create_index(conn, report, name, sql):
+    it = time.time()
+    conn.execute(sql)
+    et = time.time() - it
+    report['indexes'][name] = round(et, 2)
+    print(name + " creation complete after", round(et, 2), "seconds.")
+
+
+# Run a derived table/index build step (update_name_index(conn, ...), write_index_files(path), ...), adding how long
+# it took to report['indexes'][name] (summed when a step runs once per weekly file). Returns what the step returns.
+def timed_index(report, name, step, *args):
+    it = time.time()
+    result = step(*args)
+    report['indexes'][name] = round(report['indexes'].get(name, 0) + time.time() - it, 2)
+    return result
+
+
+# Write a build's throughput report as JSON (when the builder was given --report).
+def write_report(report, path):
+    if path:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Build report written to " + path + ".")
+
+
+# Replace the rows of table whose key appears in staging (a table bulk loaded from a delta file) with the staging rows.
+# Only columns both tables have are copied; indexes are updated in place. Returns the number of rows upserted.
+def upsert_rows(conn, table, staging, key):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info([" + staging + "])")]
+    existing = set(row[1] for row in conn.execute("PRAGMA table_info([" + table + "])"))
+    columns = ", ".join("[" + column + "]" for column in columns if column in existing)
+    conn.execute("DELETE FROM [" + table + "] WHERE [" + key + "] IN (SELECT [" + key + "] FROM [" + staging + "])")
+    cur = conn.execute("INSERT INTO [" + table + "] (" + columns + ") SELECT " + columns + " FROM [" + staging + "]")
+    conn.commit()
+    return cur.rowcount
+
+
+# Add the LOOKUP_COLUMNS an older npi_lookup table (copied from the live snapshot) does not have yet, filled from npi.
+def add_lookup_columns(conn):
+    existing = set(row[1] for row in conn.execute("PRAGMA table_info(npi_lookup)"))
+    for name, column in LOOKUP_COLUMNS:
+        if name not in existing:
+            it = time.time()
+            conn.execute("ALTER TABLE npi_lookup ADD COLUMN " + name + " TEXT")
+            conn.execute("UPDATE npi_lookup SET " + name + " = (SELECT [" + column + "] FROM npi WHERE npi.[NPI] = npi_lookup.npi)")
+            conn.commit()
+            print("npi_lookup: added " + name + " after", round(time.time() - it, 2), "seconds.")
+
+
+# Refresh npi_deactivated (NPI -> deactivation date) from the NPPES rows in source (npi, or a weekly staging table).
+# An NPI is deactivated if it has a deactivation date and was not reactivated after it (dates are MM/DD/YYYY).
+def update_deactivated(conn, source):
+    it = time.time()
+    conn.execute("CREATE TABLE IF NOT EXISTS npi_deactivated (npi INTEGER PRIMARY KEY, deactivated TEXT)")
+    conn.execute("DELETE FROM npi_deactivated WHERE npi IN (SELECT [NPI] FROM [" + source + "])")
+    cur = conn.execute("INSERT INTO npi_deactivated SELECT [NPI], [NPI Deactivation Date] FROM [" + source + "] WHERE [NPI Deactivation Date] != '' "
+                       "AND (substr([NPI Deactivation Date],7,4)||substr([NPI Deactivation Date],1,2)||substr([NPI Deactivation Date],4,2)) > "
+                       "(substr([NPI Reactivation Date],7,4)||substr([NPI Reactivation Date],1,2)||substr([NPI Reactivation Date],4,2))")
+    conn.commit()
+    print("npi_deactivated: " + str(cur.rowcount) + " deactivated NPIs from " + source + " after", round(time.time() - it, 2), "seconds.")
+    return cur.rowcount
+
+
+# Refresh the npi_name_fts FTS5 index (rowid = NPI) from the NPPES rows in source (npi, or a weekly staging table).
+# Prefixes of 2 and 3 characters are indexed so short partial names are answered from the index.
+def update_name_index(conn, source):
+    it = time.time()
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS npi_name_fts USING fts5(" + ", ".join(name for name, expr in NAME_INDEX_COLUMNS) + ", prefix='2 3')")
+    conn.execute("DELETE FROM npi_name_fts WHERE rowid IN (SELECT [NPI] FROM [" + source + "])")
+    cur = conn.execute("INSERT INTO npi_name_fts (rowid, " + ", ".join(name for name, expr in NAME_INDEX_COLUMNS) + ") SELECT [NPI], "
+                       + ", ".join(expr for name, expr in NAME_INDEX_COLUMNS) + " FROM [" + source + "]")
+    conn.commit()
+    print("npi_name_fts: " + str(cur.rowcount) + " names indexed from " + source + " after", round(time.time() - it, 2), "seconds.")
+    return cur.rowcount
+
+
+# Refresh npi_phonetic (Soundex keys of last and first name -> NPI) from the NPPES rows in source (npi, or a weekly staging table).
+# Keyed (last_key, first_key, npi) so a fuzzy search reads one key range instead of scanning names.
+def update_phonetic_index(conn, source):
+    it = time.time()
+    conn.create_function('soundex', 1, soundex, deterministic=True)
+    conn.execute("CREATE TABLE IF NOT EXISTS npi_phonetic (last_key TEXT, first_key TEXT, npi INTEGER, PRIMARY KEY (last_key, first_key, npi)) WITHOUT ROWID")
+    conn.execute("DELETE FROM npi_phonetic WHERE npi IN (SELECT [NPI] FROM [" + source + "])")
+    cur = conn.execute("INSERT INTO npi_phonetic SELECT soundex([Provider Last Name (Legal Name)]), soundex([Provider First Name]), [NPI] FROM [" + source + "] "
+                       "WHERE [Provider Last Name (Legal Name)] != ''")
+    conn.commit()
+    print("npi_phonetic: " + str(cur.rowcount) + " phonetic keys from " + source + " after", round(time.time() - it, 2), "seconds.")
+    return cur.rowcount
+
+
+# Normalize a phone number to its 10 digits as an integer (country code 1 and extensions dropped), None if it is not one.
+def phone_digits(phone):
+    digits = re.sub(r"[^0-9]", "", phone or "")
+    if len(digits) == 11 and digits.startswith('1'):
+        digits = digits[1:]
+    if len(digits) < 10:
+        return None
+    return int(digits[:10])
+
+
+# Refresh npi_phone (normalized phone -> NPI, kind) from the NPPES rows in source (npi, or a weekly staging table)
+# and, if given, the secondary practice locations loaded from a pl_pfile into locations.
+# Keyed (phone, npi, kind) so a phone lookup is a single index probe.
+def update_phone_index(conn, source, locations=None):
+    it = time.time()
+    conn.create_function('phone_digits', 1, phone_digits, deterministic=True)
+    conn.execute("CREATE TABLE IF NOT EXISTS npi_phone (phone INTEGER, npi INTEGER, kind TEXT, PRIMARY KEY (phone, npi, kind)) WITHOUT ROWID")
+    conn.execute("DELETE FROM npi_phone WHERE kind NOT LIKE 'location%' AND npi IN (SELECT [NPI] FROM [" + source + "])")
+    phones = [(kind, "[" + column + "]", source) for kind, column in PHONE_COLUMNS]
+    if locations is not None:
+        conn.execute("DELETE FROM npi_phone WHERE kind LIKE 'location%' AND npi IN (SELECT [NPI] FROM [" + locations + "])")
+        # pl_pfile phone/fax column names have changed between releases, so they are found by name.
+        for column in [row[1] for row in conn.execute("PRAGMA table_info([" + locations + "])")]:
+            if 'Telephone Number' in column:
+                phones.append(('location_phone', "[" + column + "]", locations))
+            elif 'Fax Number' in column:
+                phones.append(('location_fax', "[" + column + "]", locations))
+    rows = 0
+    for kind, column, table in phones:
+        cur = conn.execute("INSERT OR IGNORE INTO npi_phone SELECT phone, npi, ? FROM (SELECT phone_digits(" + column + ") AS phone, [NPI] AS npi FROM [" + table + "]) WHERE phone IS NOT NULL", (kind,))
+        rows = rows + cur.rowcount
+    conn.commit()
+    print("npi_phone: " + str(rows) + " phone numbers from " + ", ".join(dict.fromkeys(table for kind, column, table in phones)) + " after", round(time.time() - it, 2), "seconds.")
+    return rows
+
+
+# Helper function for the last day (YYYY-MM-DD) of NPPES data in an archive, read from the name of its npidata file
+# (npidata_pfile_20050523-20241013.csv); None if the archive does not say.
+def archive_coverage(archive):
+    if not is_zipfile(archive):
+        return None
+    archive.seek(0)
+    for name in ZipFile(archive).namelist():
+        match = NPIDATA_PERIOD.search(name)
+        if match:
+            return match.group(2)[:4] + '-' + match.group(2)[4:6] + '-' + match.group(2)[6:]
+    return None
+
+
+# Record a data file (full or delta) as applied to the snapshot being built, with the last day of data it covers
+# (YYYY-MM-DD, None if unknown).
+def record_update(conn, name, kind, rows, covered_to=None):
+    conn.execute("CREATE TABLE IF NOT EXISTS npi_updates (file TEXT PRIMARY KEY, kind TEXT, rows INTEGER, applied TEXT, covered_to TEXT)")
+    # Snapshots built before covered_to was recorded.
+    if 'covered_to' not in [row[1] for row in conn.execute("PRAGMA table_info(npi_updates)")]:
+        conn.execute("ALTER TABLE npi_updates ADD COLUMN covered_to TEXT")
+    conn.execute("INSERT OR REPLACE INTO npi_updates (file, kind, rows, applied, covered_to) VALUES (?, ?, ?, ?, ?)",
+                 (name, kind, rows, time.strftime('%Y-%m-%d %H:%M:%S'), covered_to))
+    conn.commit()
+
+
+# Helper function for the data files already applied to a snapshot (empty for snapshots older than npi_updates).
+def applied_updates(path):
+    conn = sqlite3.connect(path)
+    try:
+        return set(row[0] for row in conn.execute("SELECT file FROM npi_updates"))
+    except sqlite3.OperationalError:
+        return set()
+    finally:
+        conn.close()
+
+
+# Helper function for the last day (YYYY-MM-DD) the full file a snapshot was built from covers, None if unknown.
+def full_coverage(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT max(covered_to) FROM npi_updates WHERE kind='full'").fetchone()[0]
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+
+
+# Copy tables (with their indexes) a build does not produce itself from the live snapshot into conn.
+def copy_tables(conn, tables):
+    source = live_snapshot()
+    if source is None:
+        print("No live database to copy " + ", ".join(tables) + " from.")
+        return
+    conn.commit()
+    conn.execute("ATTACH DATABASE ? AS live", (source,))
+    for table in tables:
+        schema = conn.execute("SELECT type, sql FROM live.sqlite_master WHERE tbl_name=? AND sql IS NOT NULL ORDER BY type DESC", (table,)).fetchall()
+        if not schema:
+            print("Live database has no " + table + " table, skipping.")
+            continue
+        ct = time.time()
+        conn.execute("DROP TABLE IF EXISTS main.[" + table + "]")
+        # ORDER BY type DESC puts the table before its indexes, which are created once the rows are in.
+        conn.execute(schema[0][1])
+        conn.execute("INSERT INTO main.[" + table + "] SELECT * FROM live.[" + table + "]")
+        for kind, sql in schema[1:]:
+            conn.execute(sql)
+        conn.commit()
+        print("Copied " + table + " from live database after", round(time.time() - ct, 2), "seconds.")
+    conn.execute("DETACH DATABASE live")
+
+
+# Check a built snapshot has rows in every table and every index before it may go live.
+# tables maps table name -> minimum row count.
+def validate_snapshot(path, tables, indexes):
+    conn = sqlite3.connect(path)
+    try:
+        for table, minimum in tables.items():
+            try:
+                rows = conn.execute("SELECT count(*) FROM [" + table + "]").fetchone()[0]
+            except sqlite3.OperationalError as e:
+                raise SnapshotError(table + ": " + str(e))
+            if rows < minimum:
+                raise SnapshotError(table + " has " + str(rows) + " rows, expected at least " + str(minimum))
+            print("Validated " + table + ": " + str(rows) + " rows.")
+        present = set(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index'"))
+        missing = [index for index in indexes if index not in present]
+        if missing:
+            raise SnapshotError("missing index(es) " + ", ".join(missing))
+        print("Validated indexes: " + ", ".join(indexes) + ".")
+    finally:
+        conn.close()
+
+
+# Write the memory-mapped index files the app reads instead of SQLite for NPI and phone lookups (see npi_index).
+def write_index_files(path):
+    it = time.time()
+    conn = sqlite3.connect(path)
+    try:
+        npis = array('q')
+        offsets = array('q')
+        offset = 0
+        with open(path + RECORD_SUFFIX, 'wb') as rec:
+            for row in conn.execute("SELECT " + ", ".join(name for name, column in LOOKUP_COLUMNS) + " FROM npi_lookup ORDER BY npi"):
+                data = (FIELD_SEP.join(re.sub(r"[\x1f\r\n]", " ", str(value)) if value is not None else "" for value in row) + ROW_SEP).encode('utf-8')
+                rec.write(data)
+                npis.append(row[0])
+                offsets.append(offset)
+                offset = offset + len(data)
+        write_index(path + NPI_INDEX_SUFFIX, npis, offsets)
+        phones = array('q')
+        phone_npis = array('q')
+        for phone, npi in conn.execute("SELECT DISTINCT phone, npi FROM npi_phone ORDER BY phone, npi"):
+            phones.append(phone)
+            phone_npis.append(npi)
+        write_index(path + PHONE_INDEX_SUFFIX, phones, phone_npis)
+    except sqlite3.OperationalError as e:
+        # Snapshot without npi_lookup/npi_phone yet (e.g. a PECOS-only database): the app uses SQLite for it.
+        print("No index files written (" + str(e) + ").")
+        for suffix in (RECORD_SUFFIX, NPI_INDEX_SUFFIX, PHONE_INDEX_SUFFIX):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        return
+    finally:
+        conn.close()
+    print("Index files written (" + str(len(npis)) + " NPIs, " + str(len(phones)) + " phones) after", round(time.time() - it, 2), "seconds.")
+
+
+# Write one .idx file: magic, entry count, sorted keys, values.
+def write_index(path, keys, values):
+    with open(path, 'wb') as f:
+        f.write(INDEX_MAGIC)
+        f.write(struct.pack('<q', len(keys)))
+        keys.tofile(f)
+        values.tofile(f)
+
+
+# Atomically point the live database path at a validated snapshot, then remove old snapshots.
+# Running apps pick the new snapshot up on their next query (see npi_db.current_snapshot).
+def publish_snapshot(path):
+    link = DB_PATH + '.tmp'
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(path), link)
+    os.replace(link, DB_PATH)
+    print("Published " + path + " as " + DB_PATH + ".")
+    prune_snapshots(path)
+
+
+# Remove all but the newest KEEP_SNAPSHOTS snapshot files (never the live one).
+def prune_snapshots(live):
+    db_dir = os.path.dirname(os.path.abspath(DB_PATH))
+    snapshots = sorted(glob.glob(os.path.join(db_dir, 'npi-*.db')), reverse=True)
+    for old in snapshots[KEEP_SNAPSHOTS:]:
+        if os.path.realpath(old) != os.path.realpath(live):
+            os.remove(old)
+            for suffix in (RECORD_SUFFIX, NPI_INDEX_SUFFIX, PHONE_INDEX_SUFFIX):
+                if os.path.exists(old + suffix):
+                    os.remove(old + suffix)
+            print("Removed old snapshot " + old + ".")
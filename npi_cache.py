@@ -0,0 +1,157 @@
+# In-process NPPES/PECOS response cache, optionally backed by a cache database shared between app processes.
+import os
+import time
+import json
+import queue
+import atexit
+import threading
+import logging
+import sqlite3
+from collections import OrderedDict
+
+
+# Shared cache database (e.g. /tmp/npi_cache.db); unset keeps the cache per process.
+SHARED_CACHE_DB = os.environ.get('NPI_SHARED_CACHE_DB', '')
+
+# Shared cache writes waiting for the writer thread (more are dropped), and most written per transaction.
+SHARED_WRITE_QUEUE = int(os.environ.get('NPI_SHARED_WRITE_QUEUE', 10000))
+SHARED_WRITE_BATCH = 500
+
+# Returned by TTLCache.get() when a key is not cached (None is a valid cached value).
+MISS = object()
+
+
+# Bounded LRU cache whose entries expire ttl seconds after they were stored.
+class TTLCache:
+    def __init__(self, name, maxsize, ttl, backend=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits = self.hits + 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+        # Not in this process, try the shared backend.
+        if self.backend is not None:
+            entry = self.backend.get(self.name, key, now)
+            if entry is not None:
+                with self.lock:
+                    self.store(key, entry[1], entry[0])
+                    self.hits = self.hits + 1
+                return entry[1]
+        with self.lock:
+            self.misses = self.misses + 1
+        return MISS
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl
+        with self.lock:
+            self.store(key, value, expires)
+        if self.backend is not None:
+            self.backend.set(self.name, key, value, expires)
+
+    # Store an entry and evict the least recently used ones over maxsize (lock held).
+    def store(self, key, value, expires):
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'maxsize': self.maxsize, 'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0, 'shared': self.backend is not None}
+
+
+# Cache entries kept in a SQLite database file so every app process on the box shares them.
+# Best effort: a busy or broken cache database only costs a cache miss.
+# Request threads only queue their writes; a background thread writes them in batches, one transaction each.
+class SharedCacheBackend:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        con = self.connection()
+        con.execute("CREATE TABLE IF NOT EXISTS cache (name TEXT, key TEXT, value TEXT, expires REAL, PRIMARY KEY (name, key)) WITHOUT ROWID")
+        con.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+        con.commit()
+        self.writes = queue.Queue(maxsize=SHARED_WRITE_QUEUE)
+        self.writer = threading.Thread(target=self.write_loop, name='npi-cache-writer', daemon=True)
+        self.writer.start()
+        # Write out what is still queued when the app exits.
+        atexit.register(self.stop)
+
+    def connection(self):
+        con = getattr(self.local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=0.5)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=OFF')
+            self.local.con = con
+        return con
+
+    def get(self, name, key, now):
+        try:
+            row = self.connection().execute("SELECT expires, value FROM cache WHERE name=? AND key=? AND expires > ?", (name, str(key), now)).fetchone()
+        except sqlite3.Error as e:
+            logging.warning('Shared cache read failed: %s', e)
+            return None
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def set(self, name, key, value, expires):
+        try:
+            self.writes.put_nowait((name, str(key), json.dumps(value), expires))
+        except queue.Full:
+            logging.warning('Shared cache write queue full, entry dropped')
+
+    # Writer thread: waits for a queued write, then writes it with whatever else is queued (up to SHARED_WRITE_BATCH).
+    def write_loop(self):
+        while True:
+            entry = self.writes.get()
+            if entry is None:
+                return
+            batch = [entry]
+            while len(batch) < SHARED_WRITE_BATCH:
+                try:
+                    entry = self.writes.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    self.write(batch)
+                    return
+                batch.append(entry)
+            self.write(batch)
+
+    def write(self, batch):
+        try:
+            con = self.connection()
+            con.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", batch)
+            con.commit()
+        except sqlite3.Error as e:
+            logging.warning('Shared cache write of %s entries failed: %s', len(batch), e)
+
+    # Stop the writer thread once the writes queued so far are written.
+    def stop(self):
+        self.writes.put(None)
+        self.writer.join(5)
+
+
+shared_backend = SharedCacheBackend(SHARED_CACHE_DB) if SHARED_CACHE_DB else None
@@ -1,27 +1,28 @@
-from urllib.request import urlopen
-from io import BytesIO
-from zipfile import ZipFile
 from datetime import datetime
-import glob, os
+import os
 import sqlite3
-import shutil
+import argparse
 import urllib.request, urllib.error
 from dateutil.relativedelta import relativedelta
-import pandas as pd
 import time
 import math
+import sys
+from npi_db import LOOKUP_COLUMNS
+from npi_build import download_archive, open_csv, lock_builds, new_snapshot, build_pragmas, bulk_load, create_index, timed_index, write_report, update_deactivated, update_name_index, update_phonetic_index, update_phone_index, record_update, archive_coverage, copy_tables, validate_snapshot, write_index_files, publish_snapshot, SnapshotError
 
 # https://download.cms.gov/nppes/NPI_Files.html
 
-# Function to download monthly NPPES data.
-def download_and_unzip(url,mon,year, extract_to='.'):
+parser = argparse.ArgumentParser(description="Build a new local NPPES database snapshot.")
+parser.add_argument('--archive', help="local NPPES dissemination zip to load instead of downloading this month's")
+parser.add_argument('--report', help="write the build's throughput report (rows/s, MB/s, index times) to this JSON file")
+args = parser.parse_args()
+
+# Function to download monthly NPPES data (to a spooled temp file, nothing is extracted).
+def download(url,mon,year):
     try:
-        http_response = urlopen(url)
+        archive = download_archive(url)
         print(mon + "-" + year + " fetch successful.")
-        print("Preparing extraction...")
-        zipfile = ZipFile(BytesIO(http_response.read()))
-        print("Extracting...")
-        zipfile.extractall(path=extract_to)
+        return archive, os.path.basename(url)
     except urllib.error.HTTPError as e:
         # Return code error (e.g. 404, 501, ...)
         # If the above try failed, attempt to grab previous months data.
@@ -30,122 +31,124 @@ def download_and_unzip(url,mon,year, extract_to='.'):
         previousDate = datetime.now() - relativedelta(months=1)
         prevMonth = previousDate.strftime("%B")
         prevYear = previousDate.strftime("%Y")
+        if prevMonth == mon:
+            return None, None
         print("Attempting to fetch previous month (" + prevMonth+"-"+prevYear+")")
-        download_and_unzip("https://download.cms.gov/nppes/NPPES_Data_Dissemination_" + prevMonth + "_" + prevYear  + ".zip",prevMonth,prevYear,"npidata") # Download file for the month
+        return download("https://download.cms.gov/nppes/NPPES_Data_Dissemination_" + prevMonth + "_" + prevYear  + ".zip",prevMonth,prevYear) # Download file for the month
     except urllib.error.URLError as e:
         # Not an HTTP-specific error (e.g. connection refused)
         print('URLError: {}'.format(e.reason))
+        return None, None
 
 
-# Get current (full) month and 4 digit year
-nowDate = datetime.now()
-nowMonth = nowDate.strftime("%B")
-nowYear = nowDate.strftime("%Y")
-# Fetch current (month/year) data.
 print("----------- Fetching Data -----------")
-download_and_unzip("https://download.cms.gov/nppes/NPPES_Data_Dissemination_" + nowMonth + "_" + nowYear  + ".zip",nowMonth,nowYear,"npidata") # Download file for the month
-
-# Manage downloaded/extracted files.
-print("Extraction complete.\nManaging files...")
-files = glob.glob('./npidata/*FileHeader*')
-for file in files:
-    if os.path.exists(file):
-        os.remove(file)
-
-files = glob.glob('./npidata/*npidata*')
-for file in files:
-    if os.path.exists(file):
-        shutil.move(file,"./npi.csv")
-
-files = glob.glob('./npidata/*')
-for file in files:
-    if os.path.exists(file):
-        os.remove(file)
-print("File management complete.")
-
-# Rebuild database.
+if args.archive:
+    print("Using local archive " + args.archive)
+    archive = open(args.archive, 'rb')
+    archive_name = os.path.basename(args.archive)
+else:
+    # Get current (full) month and 4 digit year
+    nowDate = datetime.now()
+    nowMonth = nowDate.strftime("%B")
+    nowYear = nowDate.strftime("%Y")
+    # Fetch current (month/year) data.
+    archive, archive_name = download("https://download.cms.gov/nppes/NPPES_Data_Dissemination_" + nowMonth + "_" + nowYear  + ".zip",nowMonth,nowYear) # Download file for the month
+    if archive is None:
+        print("No NPPES data fetched, live database left in place.")
+        sys.exit(1)
+
+# Last day of data in the file; weekly files up to it are already in it.
+covered_to = archive_coverage(archive)
+print("NPPES data through " + str(covered_to) + ".")
+
+# Stream the npidata CSV straight out of the archive.
+npi_csv = open_csv(archive, 'npidata_pfile')
+
+# Rebuild database into a new snapshot; the live database keeps serving until it is swapped in.
 print("\n----------- Updating database -----------")
+lock_builds()
 st = time.time()
-conn = sqlite3.connect('./db/npi.db')
+snapshot = new_snapshot()
+conn = sqlite3.connect(snapshot)
+build_pragmas(conn)
 et = time.time() - st
-print("Connetion to DB complete after", round(et,2), "seconds.")
-print("Dropping table...")
+print("Connetion to new snapshot " + snapshot + " complete after", round(et,2), "seconds.")
 cur = conn.cursor()
-cur.execute("DROP TABLE IF EXISTS npi")
-et = time.time() - st
-print("Drop table complete after",round(et,2),"seconds.")
-chunkn = 1
-file = glob.glob('./npi.csv')
-
-# Grab row count for CSV -> SQLite print feedback
-def row_count(file):
-    with open(file, 'rb') as f:
-        for i, l in enumerate(f):
-            pass
-    return i
-print("Preparing CSV -> SQLite...")
-
-# Grab row count for print feedback.
-rows = row_count('./npi.csv')
-chunks = 30000
-totalchunks = math.ceil(rows/chunks)
+report = {'snapshot': snapshot, 'tables': {}, 'indexes': {}}
 
 print("\n----------- CSV -> SQLite -----------")
-# Add CSV to SQLite database
-for npi_data in pd.read_csv('npi.csv',chunksize=chunks, low_memory=False,keep_default_na=False):
-    ct = time.time()
-    npi_data.to_sql("npi", conn, if_exists='append', index=False)
-    et = time.time() - ct
-    pct = chunkn/totalchunks
-    print("Chunk ("+str(chunkn)+"/"+str(totalchunks)+") "+str(round(pct*100,2))+"% complete:",round(et,2),"seconds.")
-    #print("Chunk ("+str(chunkn)+"/"+str(totalchunks)+") "+str(round(pct*100,2))+"% complete.")
-    chunkn = chunkn+1
+# Bulk load the CSV, streamed from the archive.
+report['tables']['npi'] = bulk_load(conn, "npi", npi_csv)
+npi_csv.close()
+# Secondary practice locations, only kept for their phone numbers (npi_phone).
+pl_csv = open_csv(archive, 'pl_pfile', required=False)
+if pl_csv is not None:
+    report['tables']['npi_pl'] = bulk_load(conn, "npi_pl", pl_csv)
+    pl_csv.close()
+else:
+    print("No pl_pfile in archive, secondary practice location phones skipped.")
+archive.close()
 et = time.time() - st
 print("CSV -> SQLite complete after",round(et,2),"seconds.")
 
 # Create indexes on newly built database
 print("\n----------- Creating Index(s) -----------")
 ist = time.time()
-cur.execute("Create INDEX Idx1 ON npi([Provider Business Mailing Address Telephone Number])")
-et = time.time() - ist
-print("Idx1 creation complete after",round(et,2),"seconds.")
-it = time.time()
-cur.execute("Create INDEX Idx2 ON npi([Provider Business Practice Location Address Telephone Number])")
-et = time.time() - it
-print("Idx2 creation complete after",round(et,2),"seconds.")
-it = time.time()
-cur.execute("Create INDEX Idx3 ON npi([NPI])")
-et = time.time() - it
-print("Idx3 creation complete after",round(et,2),"seconds.")
-it = time.time()
-cur.execute("Create INDEX Idx4 ON npi([Provider First Name])")
-et = time.time() - it
-print("Idx4 creation complete after",round(et,2),"seconds.")
-it = time.time()
-cur.execute("Create INDEX Idx5 ON npi([Provider Last Name (Legal Name)])")
-et = time.time() - it
-print("Idx5 creation complete after",round(et,2),"seconds.")
-it = time.time()
-cur.execute("Create INDEX Idx6 ON npi([Provider Business Mailing Address State Name])")
-et = time.time() - it
-print("Idx6 creation complete after",round(et,2),"seconds.")
+create_index(conn, report, "Idx3", "Create INDEX Idx3 ON npi([NPI])")
+
+# Build the compact lookup table the app queries: only the columns it renders, keyed by NPI.
+print("\n----------- Building lookup table -----------")
 it = time.time()
-cur.execute("Create INDEX Idx7 ON npi([Provider Business Practice Location Address State Name])")
+cur.execute("DROP TABLE IF EXISTS npi_lookup")
+cur.execute("CREATE TABLE npi_lookup (" + ", ".join(name + (" INTEGER PRIMARY KEY" if name == 'npi' else " TEXT") for name, column in LOOKUP_COLUMNS) + ")")
+cur.execute("INSERT INTO npi_lookup SELECT " + ", ".join("[" + column + "]" for name, column in LOOKUP_COLUMNS) + " FROM npi")
+conn.commit()
 et = time.time() - it
-print("Idx7 creation complete after",round(et,2),"seconds.")
-conn.close()
+report['tables']['npi_lookup'] = {'seconds': round(et, 2)}
+print("npi_lookup build complete after",round(et,2),"seconds.")
+create_index(conn, report, "LookupIdx3", "Create INDEX LookupIdx3 ON npi_lookup(last_name, first_name)")
+
+# Normalized phone/fax -> NPI table phone_check probes, from npi and the secondary practice locations.
+print("\n----------- Building phone index -----------")
+timed_index(report, "npi_phone", update_phone_index, conn, "npi", "npi_pl" if pl_csv is not None else None)
+cur.execute("DROP TABLE IF EXISTS npi_pl")
+
+# Deactivated NPIs, so every route can drop them without asking NPPES.
+print("\n----------- Building deactivated NPI list -----------")
+timed_index(report, "npi_deactivated", update_deactivated, conn, "npi")
+
+# Full-text name index for prefix/partial name searches.
+print("\n----------- Building name index -----------")
+timed_index(report, "npi_name_fts", update_name_index, conn, "npi")
+
+# Phonetic name keys for fuzzy (misspelled) name searches.
+print("\n----------- Building phonetic index -----------")
+timed_index(report, "npi_phonetic", update_phonetic_index, conn, "npi")
 et = time.time() - ist
 print("Index creation complete after",round(et,2),"seconds.")
 
-# Remove unused CSV files.
-print("\nRemoving CSV files...")
-files = glob.glob('./*.csv')
-for file in files:
-    if os.path.exists(file):
-        os.remove(file)
-print("Removal finihsed.")
+# Weekly files (npi_csv_weekly_get.py) covering later days are applied on top of this full file from now on.
+record_update(conn, archive_name, 'full', report['tables']['npi']['rows'], covered_to)
+
+# Carry the PECOS data over from the live database.
+print("\n----------- Copying PECOS data -----------")
+copy_tables(conn, ['pecos'])
+conn.close()
+
+# Validate the new snapshot, then swap it in.
+print("\n----------- Publishing snapshot -----------")
+try:
+    validate_snapshot(snapshot, {'npi': 1, 'npi_lookup': 1, 'npi_deactivated': 0, 'npi_name_fts': 1, 'npi_phonetic': 1, 'npi_phone': 1}, ['Idx3', 'LookupIdx3'])
+except SnapshotError as e:
+    print("Snapshot validation FAILED (" + str(e) + "), live database left in place.")
+    os.remove(snapshot)
+    sys.exit(1)
+timed_index(report, "index_files", write_index_files, snapshot)
+publish_snapshot(snapshot)
 
 # Script complete
 et = time.time() - st
+report['seconds'] = round(et, 2)
+write_report(report, args.report)
 minutes, seconds = divmod(et, 60)
 print("\nBuild complete after "+str(math.floor(minutes))+"m "+str(math.floor(seconds))+"s.")
\ No newline at end of file
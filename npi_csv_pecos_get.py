@@ -1,110 +1,94 @@
-from urllib.request import urlopen
-from io import BytesIO
-from zipfile import ZipFile
-import glob, os
+import os
 import sqlite3
 import shutil
+import argparse
 import urllib.request, urllib.error
-import pandas as pd
 import time
 import math
+import sys
+from npi_build import download_archive, open_csv, lock_builds, new_snapshot, live_snapshot, build_pragmas, bulk_load, create_index, timed_index, write_report, validate_snapshot, write_index_files, publish_snapshot, SnapshotError
 
 # https://data.cms.gov/data-api/v1/dataset/0824b6d0-14ad-47a0-94e2-f317a3658317/data-viewer?_format=csv
 
-# Function to download PECOS data.
-def download_and_unzip(url, extract_to='.'):
+parser = argparse.ArgumentParser(description="Rebuild the PECOS table into a new local database snapshot.")
+parser.add_argument('--archive', help="local PECOS order and referring CSV (or zip) to load instead of downloading it")
+parser.add_argument('--report', help="write the build's throughput report (rows/s, MB/s, index times) to this JSON file")
+args = parser.parse_args()
+
+# Function to download PECOS data (to a spooled temp file, nothing is extracted).
+def download(url):
     try:
-        http_response = urlopen(url)
+        archive = download_archive(url)
         print("PECOS fetch successful.")
-        print("Preparing extraction...")
-        zipfile = ZipFile(BytesIO(http_response.read()))
-        print("Extracting...")
-        zipfile.extractall(path=extract_to)
+        return archive
     except urllib.error.HTTPError as e:
         # Return code error (e.g. 404, 501, ...)
         print('HTTPError: {}'.format(e.code))
     except urllib.error.URLError as e:
         # Not an HTTP-specific error (e.g. connection refused)
         print('URLError: {}'.format(e.reason))
-        return
+    return None
 
 # Fetch currently available data.
 print("----------- Fetching Data -----------")
-download_and_unzip("https://data.cms.gov/data-api/v1/dataset/0824b6d0-14ad-47a0-94e2-f317a3658317/data-viewer?_format=csv","npidata") # Download file for the month
+if args.archive:
+    print("Using local archive " + args.archive)
+    archive = open(args.archive, 'rb')
+else:
+    archive = download("https://data.cms.gov/data-api/v1/dataset/0824b6d0-14ad-47a0-94e2-f317a3658317/data-viewer?_format=csv")
+    if archive is None:
+        print("No PECOS data fetched, live database left in place.")
+        sys.exit(1)
 
-# Manage downloaded/extracted files.
-print("Extraction complete.\nManaging files...")
-files = glob.glob('./npidata/*Order*')
-for file in files:
-    if os.path.exists(file):
-        shutil.move(file,"./pecos.csv")
-        
-print("File management complete.")
+# Stream the Order and Referring CSV straight out of the download.
+pecos_csv = open_csv(archive, 'Order')
 
-# Rebuild database.
+# Rebuild database into a new snapshot (a copy of the live one); the live database keeps serving until it is swapped in.
 print("\n----------- Updating database -----------")
+lock_builds()
 st = time.time()
-conn = sqlite3.connect('./db/npi.db')
-et = time.time() - st
-print("Connetion to DB complete after", round(et,2), "seconds.")
-print("Dropping table...")
-cur = conn.cursor()
-cur.execute("DROP TABLE IF EXISTS pecos")
+snapshot = new_snapshot()
+if live_snapshot() is not None:
+    print("Copying live database...")
+    shutil.copyfile(live_snapshot(), snapshot)
+conn = sqlite3.connect(snapshot)
+build_pragmas(conn)
 et = time.time() - st
-print("Drop table complete after",round(et,2),"seconds.")
-chunkn = 1
-file = glob.glob('./pecos.csv')
-
-# Grab row count for CSV -> SQLite print feedback
-def row_count(file):
-    with open(file, 'rb') as f:
-        for i, l in enumerate(f):
-            pass
-    return i
-print("Preparing CSV -> SQLite...")
-
-# Grab row count for print feedback.
-rows = row_count('./pecos.csv')
-chunks = 20000
-totalchunks = math.ceil(rows/chunks)
+print("Connetion to new snapshot " + snapshot + " complete after", round(et,2), "seconds.")
+report = {'snapshot': snapshot, 'tables': {}, 'indexes': {}}
 
 print("\n----------- CSV -> SQLite -----------")
-# Add CSV to SQLite database
-for npi_data in pd.read_csv('pecos.csv',chunksize=chunks, low_memory=False,keep_default_na=False):
-    ct = time.time()
-    npi_data.to_sql("pecos", conn, if_exists='append', index=False)
-    et = time.time() - ct
-    pct = chunkn/totalchunks
-    print("Chunk ("+str(chunkn)+"/"+str(totalchunks)+") "+str(round(pct*100,2))+"% complete:",round(et,2),"seconds.")
-    #print("Chunk ("+str(chunkn)+"/"+str(totalchunks)+") "+str(round(pct*100,2))+"% complete.")
-    chunkn = chunkn+1
+# Bulk load the CSV (replacing the copied pecos table), streamed from the download.
+report['tables']['pecos'] = bulk_load(conn, "pecos", pecos_csv)
+pecos_csv.close()
+archive.close()
 et = time.time() - st
 print("CSV -> SQLite complete after",round(et,2),"seconds.")
 
 # Create indexes on newly built database
 print("\n----------- Creating Index(s) -----------")
 ist = time.time()
-cur.execute("Create INDEX PecosIdx1 ON pecos([NPI])")
-et = time.time() - ist
-print("Idx1 creation complete after",round(et,2),"seconds.")
-it = time.time()
-cur.execute("Create INDEX PecosIdx2 ON pecos([DME])")
-et = time.time() - it
-print("Idx2 creation complete after",round(et,2),"seconds.")
+create_index(conn, report, "PecosIdx1", "Create INDEX PecosIdx1 ON pecos([NPI])")
+create_index(conn, report, "PecosIdx2", "Create INDEX PecosIdx2 ON pecos([DME])")
 
 conn.close()
 et = time.time() - ist
 print("Index creation complete after",round(et,2),"seconds.")
 
-# Remove unused CSV files
-print("\nRemoving CSV files...")
-files = glob.glob('./*.csv')
-for file in files:
-    if os.path.exists(file):
-        os.remove(file)
-print("Removal finished.")
+# Validate the new snapshot, then swap it in.
+print("\n----------- Publishing snapshot -----------")
+try:
+    validate_snapshot(snapshot, {'pecos': 1}, ['PecosIdx1', 'PecosIdx2'])
+except SnapshotError as e:
+    print("Snapshot validation FAILED (" + str(e) + "), live database left in place.")
+    os.remove(snapshot)
+    sys.exit(1)
+timed_index(report, "index_files", write_index_files, snapshot)
+publish_snapshot(snapshot)
 
 # Script complete
 et = time.time() - st
+report['seconds'] = round(et, 2)
+write_report(report, args.report)
 minutes, seconds = divmod(et, 60)
 print("\nBuild complete after "+str(math.floor(minutes))+"m "+str(math.floor(seconds))+"s.")
\ No newline at end of file
@@ -0,0 +1,158 @@
+from datetime import datetime
+import os
+import re
+import sqlite3
+import shutil
+import argparse
+import urllib.request, urllib.error
+import time
+import math
+import sys
+from npi_db import LOOKUP_COLUMNS
+from npi_build import download_archive, open_csv, lock_builds, new_snapshot, live_snapshot, build_pragmas, bulk_load, timed_index, upsert_rows, add_lookup_columns, update_deactivated, update_name_index, update_phonetic_index, update_phone_index, record_update, applied_updates, full_coverage, write_report, validate_snapshot, write_index_files, publish_snapshot, SnapshotError
+
+# https://download.cms.gov/nppes/NPI_Files.html
+
+NPPES_FILES = "https://download.cms.gov/nppes/"
+
+# Weekly incremental files, e.g. NPPES_Data_Dissemination_100724_101324_Weekly_V2.zip (MMDDYY_MMDDYY).
+WEEKLY_FILE = re.compile(r'NPPES_Data_Dissemination_(\d{6})_(\d{6})_Weekly(?:_V\d+)?\.zip')
+
+parser = argparse.ArgumentParser(description="Apply new weekly NPPES files to the live database as a new snapshot.")
+parser.add_argument('--archive', nargs='+', help="local weekly NPPES zip(s) to apply (oldest first, by the dates in their names) instead of downloading the ones listed by CMS")
+parser.add_argument('--report', help="write the update's throughput report (rows/s, MB/s) to this JSON file")
+args = parser.parse_args()
+
+# Function to list the weekly files CMS currently publishes, oldest first.
+def weekly_files():
+    try:
+        page = urllib.request.urlopen(NPPES_FILES + "NPI_Files.html").read().decode('utf-8', 'replace')
+    except urllib.error.URLError as e:
+        print('URLError: {}'.format(e.reason))
+        return None
+    names = set(match.group(0) for match in WEEKLY_FILE.finditer(page))
+    return sorted(names, key=end_date)
+
+# Function for the last day (YYYY-MM-DD) a weekly file covers, from its name; None if the name has no dates.
+def end_date(name):
+    match = WEEKLY_FILE.search(name)
+    if match is None:
+        return None
+    return datetime.strptime(match.group(2), '%m%d%y').strftime('%Y-%m-%d')
+
+# Function to download one weekly file (to a spooled temp file, nothing is extracted).
+def download(name):
+    try:
+        archive = download_archive(NPPES_FILES + name)
+        print(name + " fetch successful.")
+        return archive
+    except urllib.error.HTTPError as e:
+        # Return code error (e.g. 404, 501, ...)
+        print('HTTPError: {}'.format(e.code))
+    except urllib.error.URLError as e:
+        # Not an HTTP-specific error (e.g. connection refused)
+        print('URLError: {}'.format(e.reason))
+    return None
+
+
+print("----------- Checking for updates -----------")
+lock_builds()
+live = live_snapshot()
+if live is None:
+    print("No live database to update, run npi_csv_file_get.py first.")
+    sys.exit(1)
+if args.archive:
+    available = [os.path.basename(path) for path in args.archive]
+    paths = dict(zip(available, args.archive))
+else:
+    available = weekly_files()
+    if available is None:
+        print("Could not list weekly files, live database left in place.")
+        sys.exit(1)
+applied = applied_updates(live)
+pending = [name for name in available if name not in applied]
+# Weekly files ending on or before the last day of the full file the live snapshot was built from are already in it:
+# applying them again would roll NPIs back to older data.
+covered_to = full_coverage(live)
+if covered_to is not None:
+    for name in [name for name in pending if end_date(name) is not None and end_date(name) <= covered_to]:
+        print(name + " is covered by the full file (data through " + covered_to + "), skipped.")
+        pending.remove(name)
+else:
+    print("Full file coverage unknown, every weekly file not applied yet is applied.")
+# Oldest first, whatever order they were listed or given in (files without dates in their name last, as given).
+pending.sort(key=lambda name: (end_date(name) is None, end_date(name) or ''))
+if not pending:
+    print("No new weekly files, live database is up to date.")
+    sys.exit(0)
+print("Weekly files to apply: " + ", ".join(pending))
+
+# Apply the weekly files to a copy of the live snapshot; the live database keeps serving until it is swapped in.
+print("\n----------- Updating database -----------")
+st = time.time()
+snapshot = new_snapshot()
+print("Copying live database...")
+shutil.copyfile(live, snapshot)
+conn = sqlite3.connect(snapshot)
+build_pragmas(conn)
+et = time.time() - st
+print("Connetion to new snapshot " + snapshot + " complete after", round(et,2), "seconds.")
+cur = conn.cursor()
+report = {'snapshot': snapshot, 'tables': {}, 'indexes': {}}
+add_lookup_columns(conn)
+
+# Apply in order, stopping at the first file that cannot be fetched so none is ever skipped.
+for name in pending:
+    print("\n----------- Applying " + name + " -----------")
+    if args.archive:
+        archive = open(paths[name], 'rb')
+    else:
+        archive = download(name)
+        if archive is None:
+            print(name + " fetch FAILED, later files held back.")
+            break
+    npi_csv = open_csv(archive, 'npidata_pfile')
+    report['tables'][name] = bulk_load(conn, "npi_delta", npi_csv)
+    npi_csv.close()
+    pl_csv = open_csv(archive, 'pl_pfile', required=False)
+    if pl_csv is not None:
+        bulk_load(conn, "npi_pl_delta", pl_csv)
+        pl_csv.close()
+    archive.close()
+    ut = time.time()
+    rows = upsert_rows(conn, "npi", "npi_delta", "NPI")
+    cur.execute("INSERT OR REPLACE INTO npi_lookup (" + ", ".join(name for name, column in LOOKUP_COLUMNS) + ") SELECT " + ", ".join("[" + column + "]" for name, column in LOOKUP_COLUMNS) + " FROM npi_delta")
+    timed_index(report, "npi_deactivated", update_deactivated, conn, "npi_delta")
+    timed_index(report, "npi_name_fts", update_name_index, conn, "npi_delta")
+    timed_index(report, "npi_phonetic", update_phonetic_index, conn, "npi_delta")
+    timed_index(report, "npi_phone", update_phone_index, conn, "npi_delta", "npi_pl_delta" if pl_csv is not None else None)
+    cur.execute("DROP TABLE IF EXISTS npi_pl_delta")
+    cur.execute("DROP TABLE npi_delta")
+    record_update(conn, name, 'weekly', rows, end_date(name))
+    et = time.time() - ut
+    report['tables'][name]['upsert_seconds'] = round(et, 2)
+    print(str(rows) + " NPIs upserted after", round(et,2), "seconds.")
+conn.close()
+
+if not report['tables']:
+    print("No weekly files applied, live database left in place.")
+    os.remove(snapshot)
+    sys.exit(1)
+
+# Validate the new snapshot, then swap it in.
+print("\n----------- Publishing snapshot -----------")
+try:
+    validate_snapshot(snapshot, {'npi': 1, 'npi_lookup': 1, 'npi_deactivated': 0, 'npi_name_fts': 1, 'npi_phonetic': 1, 'npi_phone': 1}, ['Idx3', 'LookupIdx3'])
+except SnapshotError as e:
+    print("Snapshot validation FAILED (" + str(e) + "), live database left in place.")
+    os.remove(snapshot)
+    sys.exit(1)
+timed_index(report, "index_files", write_index_files, snapshot)
+publish_snapshot(snapshot)
+
+# Script complete
+et = time.time() - st
+report['seconds'] = round(et, 2)
+write_report(report, args.report)
+minutes, seconds = divmod(et, 60)
+print("\nUpdate complete after "+str(math.floor(minutes))+"m "+str(math.floor(seconds))+"s.")
@@ -0,0 +1,218 @@
+# Local NPPES/PECOS SQLite data access shared by every route.
+import os
+import time
+import bisect
+import threading
+import logging
+import sqlite3
+import functools
+from array import array
+from urllib.parse import quote
+from npi_phonetic import soundex, levenshtein
+from npi_metrics import DB_QUERY_SECONDS, DB_ROWS
+import npi_trace
+
+
+# Set database path. The builders write each rebuild to a new versioned snapshot file next to it
+# (npi-YYYYmmddHHMMSSffffff-<pid>.db) and atomically repoint DB_PATH (a symlink) at the new file once it is validated.
+DB_PATH = os.environ.get('NPI_DB', './db/npi.db')
+
+# Seconds between checks for a newly published snapshot.
+SNAPSHOT_CHECK = float(os.environ.get('NPI_SNAPSHOT_CHECK', 5))
+
+# The app never writes to the database, so it is opened read-only and (by default) immutable,
+# which lets SQLite skip file locking and change detection on every query. Immutable is only safe for a published
+# snapshot (DB_PATH a symlink, see npi_build.publish_snapshot): a plain database file may still be rewritten in place.
+DB_IMMUTABLE = os.environ.get('NPI_DB_IMMUTABLE', '1') == '1'
+
+# Memory-mapped I/O size (bytes), page cache size (KiB) and prepared statements kept per connection.
+MMAP_SIZE = int(os.environ.get('NPI_DB_MMAP_SIZE', 2 * 1024 ** 3))
+CACHE_SIZE = int(os.environ.get('NPI_DB_CACHE_KB', 64 * 1024))
+CACHED_STATEMENTS = int(os.environ.get('NPI_DB_CACHED_STATEMENTS', 256))
+
+# Most (closest) matches a fuzzy name search pages through; answers past it are flagged as truncated.
+FUZZY_CANDIDATES = int(os.environ.get('NPI_FUZZY_CANDIDATES', 2000))
+
+# Columns of the compact npi_lookup table (built by npi_csv_file_get.py) and the NPPES column each one comes from.
+LOOKUP_COLUMNS = [
+    ('npi', 'NPI'),
+    ('last_name', 'Provider Last Name (Legal Name)'),
+    ('first_name', 'Provider First Name'),
+    ('middle_name', 'Provider Middle Name'),
+    ('credential', 'Provider Credential Text'),
+    ('mail_address1', 'Provider First Line Business Mailing Address'),
+    ('mail_address2', 'Provider Second Line Business Mailing Address'),
+    ('mail_city', 'Provider Business Mailing Address City Name'),
+    ('mail_state', 'Provider Business Mailing Address State Name'),
+    ('mail_postal', 'Provider Business Mailing Address Postal Code'),
+    ('mail_phone', 'Provider Business Mailing Address Telephone Number'),
+    ('mail_fax', 'Provider Business Mailing Address Fax Number'),
+    ('practice_address1', 'Provider First Line Business Practice Location Address'),
+    ('practice_address2', 'Provider Second Line Business Practice Location Address'),
+    ('practice_city', 'Provider Business Practice Location Address City Name'),
+    ('practice_state', 'Provider Business Practice Location Address State Name'),
+    ('practice_postal', 'Provider Business Practice Location Address Postal Code'),
+    ('practice_phone', 'Provider Business Practice Location Address Telephone Number'),
+    ('practice_fax', 'Provider Business Practice Location Address Fax Number'),
+    ('organization_name', 'Provider Organization Name (Legal Business Name)'),
+]
+
+# One connection per worker thread, kept open for the life of the thread (or until a new snapshot is published).
+local = threading.local()
+
+# Snapshot file DB_PATH currently points at, and when that was last checked.
+snapshot = {'path': None, 'checked': 0}
+snapshot_lock = threading.Lock()
+
+# Deactivated NPIs of the current snapshot (npi_deactivated) as a sorted array, reloaded when a new snapshot is published.
+deactivated = {'path': None, 'npis': array('q')}
+deactivated_lock = threading.Lock()
+
+
+# Edit distances by name pair: the matches of a phonetic key share a handful of spellings (SMITH, SMYTH, SMITT...).
+cached_levenshtein = functools.lru_cache(maxsize=65536)(levenshtein)
+
+
+# Helper function to open a tuned read-only connection to the database.
+def connect(path):
+    uri = 'file:' + quote(os.path.abspath(path)) + '?mode=ro'
+    if DB_IMMUTABLE and os.path.islink(DB_PATH):
+        uri = uri + '&immutable=1'
+    con = sqlite3.connect(uri, uri=True, cached_statements=CACHED_STATEMENTS)
+    # Rows can be read by column name (row['npi']) as well as by position.
+    con.row_factory = sqlite3.Row
+    # Fuzzy name searches rank their matches by edit distance in SQL (see search_phonetic).
+    con.create_function('levenshtein', 2, cached_levenshtein, deterministic=True)
+    con.execute('PRAGMA mmap_size=%d' % MMAP_SIZE)
+    con.execute('PRAGMA cache_size=-%d' % CACHE_SIZE)
+    con.execute('PRAGMA temp_store=MEMORY')
+    logging.debug('Opened %s for thread %s', path, threading.current_thread().name)
+    return con
+
+
+# Helper function returning the snapshot file the database path currently resolves to.
+# Re-resolved at most every SNAPSHOT_CHECK seconds.
+def current_snapshot():
+    now = time.time()
+    if snapshot['path'] is None or now - snapshot['checked'] >= SNAPSHOT_CHECK:
+        with snapshot_lock:
+            path = os.path.realpath(DB_PATH)
+            if path != snapshot['path']:
+                if snapshot['path'] is not None:
+                    print("-- New database snapshot: " + path + " --")
+                logging.info('Database snapshot is %s', path)
+                snapshot['path'] = path
+            snapshot['checked'] = now
+    return snapshot['path']
+
+
+# Helper function returning this thread's connection, opening it on first use
+# and moving it to the new snapshot when one has been published.
+def get_connection():
+    con = getattr(local, 'con', None)
+    path = current_snapshot()
+    if con is not None and local.path != path:
+        con.close()
+        con = None
+    if con is None:
+        con = connect(path)
+        local.con = con
+        local.path = path
+    return con
+
+
+# Helper function to run a (parameterized) query on this thread's connection and fetch every row.
+# Query time and row count go to the /metrics histograms (and the time to the request's sqlite trace stage).
+def query(sql, params=()):
+    con = get_connection()
+    st = time.perf_counter()
+    rows = con.execute(sql, params).fetchall()
+    elapsed = time.perf_counter() - st
+    DB_QUERY_SECONDS.observe(elapsed)
+    npi_trace.add('sqlite', elapsed)
+    DB_ROWS.observe(len(rows))
+    return rows
+
+
+# Helper function returning True if npi is deactivated in the current snapshot (binary search, no query).
+def is_deactivated(npi):
+    path = current_snapshot()
+    if deactivated['path'] != path:
+        with deactivated_lock:
+            if deactivated['path'] != path:
+                try:
+                    npis = array('q', (row[0] for row in get_connection().execute("select npi from npi_deactivated order by npi")))
+                except sqlite3.Error as e:
+                    # Snapshot built before npi_deactivated existed (or no database yet).
+                    logging.warning('No deactivated NPI list: %s', e)
+                    npis = array('q')
+                logging.info('Loaded %s deactivated NPIs from %s', len(npis), path)
+                deactivated['npis'] = npis
+                deactivated['path'] = path
+    npis = deactivated['npis']
+    npi = int(npi)
+    i = bisect.bisect_left(npis, npi)
+    return i < len(npis) and npis[i] == npi
+
+
+# Rank tiers of a prefix name search, best first: the last/organization name is the name searched for, starts with
+# it, or only contains a word (or has an other last name) starting with it.
+NAME_RANKS = 3
+
+
+# Prefix search of provider/organization names in the npi_name_fts index, exact names first (see NAME_RANKS), each
+# rank tier in NPI order. last_name matches last, other last or organization names; first_name (optional) matches
+# first or other first names. Rows carry their tier as name_rank; pass (name_rank, npi) of the last row of a page as
+# after for the next page (keyset pagination on the tier and the index rowid, so a page reads only its own matches
+# instead of ranking every match of a short prefix).
+def search_names(last_name, first_name='', state='', limit=50, after=None):
+    last_name = last_name.replace('"', '').upper()
+    names = "ifnull(upper(l.last_name), '')", "ifnull(upper(l.organization_name), '')"
+    exact = "(" + " or ".join(name + " = ?" for name in names) + ")"
+    starts = "(" + " or ".join("substr(" + name + ", 1, ?) = ?" for name in names) + ")"
+    tiers = [('"' + last_name + '"', exact, [last_name, last_name]),
+             ('"' + last_name + '"*', starts + " and not " + exact, [len(last_name), last_name] * 2 + [last_name, last_name]),
+             ('"' + last_name + '"*', "not " + starts, [len(last_name), last_name] * 2)]
+    rank, npi = after if after is not None else (0, None)
+    rows = []
+    while rank < NAME_RANKS and len(rows) < limit:
+        term, condition, params = tiers[rank]
+        match = '{last_name other_last_name org_name} : ' + term
+        if first_name:
+            match = match + ' AND {first_name other_first_name} : "' + first_name.replace('"', '') + '"*'
+        sql = "select l.*, " + str(rank) + " as name_rank from npi_name_fts join npi_lookup l on l.npi = npi_name_fts.rowid where npi_name_fts match ? and " + condition
+        params = [match] + params
+        if state:
+            sql = sql + " and (l.mail_state=? or l.practice_state=?)"
+            params.extend([state, state])
+        if npi is not None:
+            sql = sql + " and npi_name_fts.rowid > ?"
+            params.append(npi)
+        rows.extend(query(sql + " order by npi_name_fts.rowid limit ?", params + [limit - len(rows)]))
+        rank, npi = rank + 1, None
+    return rows
+
+
+# Fuzzy search for a (possibly misspelled) name: matches sharing the Soundex key(s) of the name (npi_phonetic),
+# ranked in SQL by edit distance to the name given (then NPI); offset skips the first matches.
+# Only the closest FUZZY_CANDIDATES matches can be paged through. Returns the rows and whether matches
+# past that limit were cut off (truncated).
+def search_phonetic(last_name, first_name='', state='', limit=50, offset=0):
+    if offset >= FUZZY_CANDIDATES:
+        return [], True
+    distance = "levenshtein(?, upper(l.last_name))"
+    params = [last_name]
+    if first_name:
+        distance = distance + " + levenshtein(?, upper(l.first_name))"
+        params.append(first_name)
+    sql = "select l.*, " + distance + " as distance from npi_phonetic p join npi_lookup l on l.npi = p.npi where p.last_key=?"
+    params.append(soundex(last_name))
+    if first_name:
+        sql = sql + " and p.first_key=?"
+        params.append(soundex(first_name))
+    if state:
+        sql = sql + " and (l.mail_state=? or l.practice_state=?)"
+        params.extend([state, state])
+    take = min(limit, FUZZY_CANDIDATES - offset)
+    rows = query(sql + " order by distance, l.npi limit ? offset ?", params + [take + 1, offset])
+    return rows[:take], take < limit and len(rows) > take
@@ -0,0 +1,113 @@
+# Memory-mapped NPI and phone index files written next to each snapshot by the builders (npi_build.write_index_files).
+# Hot local lookups binary-search them instead of querying SQLite; every app process shares the mapped pages.
+#   <snapshot>.rec        npi_lookup rows, one per line, fields (LOOKUP_COLUMNS order) separated by \x1f
+#   <snapshot>.npi.idx    sorted NPIs -> offset of their row in .rec
+#   <snapshot>.phone.idx  sorted normalized phones (npi_phone) -> NPI
+# An .idx file is INDEX_MAGIC, the entry count (int64), then the sorted int64 keys followed by their int64 values.
+import mmap
+import struct
+import bisect
+import logging
+import threading
+import npi_db
+import npi_trace
+from npi_db import LOOKUP_COLUMNS
+
+
+INDEX_MAGIC = b'NPIIDX1\0'
+RECORD_SUFFIX = '.rec'
+NPI_INDEX_SUFFIX = '.npi.idx'
+PHONE_INDEX_SUFFIX = '.phone.idx'
+
+# Field and row separators of the .rec file.
+FIELD_SEP = '\x1f'
+ROW_SEP = '\n'
+
+# Index files of the current snapshot (None while it has none), reopened when a new snapshot is published.
+index = {'path': None, 'files': None}
+index_lock = threading.Lock()
+
+
+# Sorted int64 key -> int64 value array in a memory-mapped .idx file.
+class IndexFile:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:8] != INDEX_MAGIC:
+            raise ValueError(path + " is not an index file")
+        count = struct.unpack_from('<q', self.map, 8)[0]
+        view = memoryview(self.map)
+        self.keys = view[16:16 + 8 * count].cast('q')
+        self.values = view[16 + 8 * count:16 + 16 * count].cast('q')
+
+    # Values of every entry with key (keys may repeat), binary search.
+    def find(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        values = []
+        while i < len(self.keys) and self.keys[i] == key:
+            values.append(self.values[i])
+            i = i + 1
+        return values
+
+
+# The three mapped files of one snapshot.
+class SnapshotIndex:
+    def __init__(self, path):
+        self.npis = IndexFile(path + NPI_INDEX_SUFFIX)
+        self.phones = IndexFile(path + PHONE_INDEX_SUFFIX)
+        with open(path + RECORD_SUFFIX, 'rb') as f:
+            self.records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # npi_lookup row (as a dict keyed like sqlite3.Row) stored at offset in the .rec file.
+    def record(self, offset):
+        end = self.records.find(ROW_SEP.encode(), offset)
+        fields = self.records[offset:end].decode('utf-8').split(FIELD_SEP)
+        # Files written before a column was added to LOOKUP_COLUMNS lack its (last) field.
+        row = dict(zip([name for name, column in LOOKUP_COLUMNS], fields + [''] * (len(LOOKUP_COLUMNS) - len(fields))))
+        row['npi'] = int(row['npi'])
+        return row
+
+    def npi_rows(self, npi):
+        return [self.record(offset) for offset in self.npis.find(int(npi))]
+
+    def phone_rows(self, phone):
+        rows = []
+        for npi in self.phones.find(int(phone)):
+            rows.extend(self.npi_rows(npi))
+        return rows
+
+
+# Helper function returning the current snapshot's index, None if it has no index files (callers then use SQLite).
+def current():
+    path = npi_db.current_snapshot()
+    if index['path'] != path:
+        with index_lock:
+            if index['path'] != path:
+                try:
+                    files = SnapshotIndex(path)
+                    logging.info('Mapped index files of %s', path)
+                except (OSError, ValueError) as e:
+                    logging.warning('No index files for %s, using SQLite: %s', path, e)
+                    files = None
+                # Views into a previous snapshot's maps may still be in use, so those are left to be garbage collected.
+                index['files'] = files
+                index['path'] = path
+    return index['files']
+
+
+# npi_lookup rows for an NPI from the mapped index, None if there is no index.
+def npi_rows(npi):
+    files = current()
+    if files is None:
+        return None
+    with npi_trace.stage('index'):
+        return files.npi_rows(npi)
+
+
+# npi_lookup rows for every NPI with a (normalized, 10 digit) phone number from the mapped index, None if there is no index.
+def phone_rows(phone):
+    files = current()
+    if files is None:
+        return None
+    with npi_trace.stage('index'):
+        return files.phone_rows(phone)
@@ -0,0 +1,67 @@
+# Non-blocking app logging: request threads only put records on a queue; a background thread formats them
+# as JSON lines and writes them to a size-rotated log file.
+import os
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from datetime import datetime
+
+
+# Log file, level, size (bytes) at which it is rotated and rotated files kept.
+LOG_FILE = os.environ.get('NPI_LOG_FILE', 'npi.log')
+LOG_LEVEL = os.environ.get('NPI_LOG_LEVEL', 'DEBUG').upper()
+LOG_MAX_BYTES = int(os.environ.get('NPI_LOG_MAX_BYTES', 50 * 1024 ** 2))
+LOG_BACKUPS = int(os.environ.get('NPI_LOG_BACKUPS', 5))
+
+# Fraction of verbose payload logs (log_payload, e.g. whole NPPES responses) written, and the longest message kept.
+PAYLOAD_SAMPLE = float(os.environ.get('NPI_LOG_PAYLOAD_SAMPLE', 0.01))
+MAX_MESSAGE = int(os.environ.get('NPI_LOG_MAX_MESSAGE', 4096))
+
+# Background listener writing the queued records (None until setup()).
+listener = None
+
+
+# One JSON object per line: time, level, logger, thread, message (and the traceback, if any).
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        message = record.getMessage()
+        if len(message) > MAX_MESSAGE:
+            message = message[:MAX_MESSAGE] + '...[%s chars]' % len(message)
+        entry = {'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'), 'level': record.levelname,
+                 'logger': record.name, 'thread': record.threadName, 'message': message}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Queue handler that hands the record over as is: the message is merged with its arguments by the listener thread,
+# not the request thread (the stock QueueHandler formats it before queueing).
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+# Helper function to route the root logger through the queue to the rotating JSON log file. Safe to call twice.
+def setup():
+    global listener
+    if listener is not None:
+        return
+    records = queue.SimpleQueue()
+    handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+    handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(records, handler)
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(LazyQueueHandler(records))
+    listener.start()
+    # Write out what is still queued when the app exits.
+    atexit.register(listener.stop)
+
+
+# Debug log for a (possibly large) payload, written for a PAYLOAD_SAMPLE fraction of calls only.
+def log_payload(msg, *args):
+    if PAYLOAD_SAMPLE > 0 and random.random() < PAYLOAD_SAMPLE and logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(msg, *args)
@@ -0,0 +1,106 @@
+# In-process metrics registry (counters and histograms), served in Prometheus text format on /metrics.
+# Every app process keeps its own registry; Prometheus adds them up across processes/instances.
+import bisect
+import threading
+
+
+# Histogram buckets for latencies (seconds) and result-set sizes (rows).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+# Every metric created, in exposition order.
+registry = []
+
+
+# Helper function to format label values for the exposition format ('{a="x",b="y"}', '' for none).
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs) + '}'
+
+
+# Helper function to format a sample value (integers without a decimal point).
+def format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+# Monotonic counter, one series per combination of label values.
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append('%s%s %s' % (self.name, format_labels(self.labels, key), format_value(value)))
+        return lines
+
+
+# Histogram of observed values over fixed buckets, one series per combination of label values.
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per bucket counts (plus +Inf), sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][i] = series[0][i] + 1
+            series[1] = series[1] + value
+            series[2] = series[2] + 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets + ('+Inf',), counts):
+                    cumulative = cumulative + n
+                    le = bound if bound == '+Inf' else format_value(bound)
+                    lines.append('%s_bucket%s %s' % (self.name, format_labels(self.labels, key, [('le', le)]), cumulative))
+                lines.append('%s_sum%s %s' % (self.name, format_labels(self.labels, key), format_value(total)))
+                lines.append('%s_count%s %s' % (self.name, format_labels(self.labels, key), count))
+        return lines
+
+
+# Metrics recorded by the app.
+REQUEST_SECONDS = Histogram('npi_request_seconds', 'Route latency in seconds (until the response body has been sent, streamed bodies included).', ['route'])
+REQUESTS = Counter('npi_requests_total', 'Requests answered, by route and HTTP status.', ['route', 'status'])
+UPSTREAM_SECONDS = Histogram('npi_upstream_seconds', 'NPPES/PECOS API call latency in seconds, retries included.', ['upstream'])
+UPSTREAM_ERRORS = Counter('npi_upstream_errors_total', 'Failed NPPES/PECOS API calls (error) and calls refused by an open breaker (circuit_open).', ['upstream', 'reason'])
+FALLBACKS = Counter('npi_local_fallbacks_total', 'Lookups answered from local data because an upstream API failed, by upstream and call site.', ['upstream', 'site'])
+DB_QUERY_SECONDS = Histogram('npi_db_query_seconds', 'SQLite query time in seconds (execute and fetch).')
+DB_ROWS = Histogram('npi_db_rows', 'Rows returned per SQLite query.', buckets=SIZE_BUCKETS)
+RESULT_RECORDS = Histogram('npi_result_records', 'Provider records returned per request, by route.', ['route'], buckets=SIZE_BUCKETS)
+
+
+# Every metric in the Prometheus text exposition format (version 0.0.4).
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
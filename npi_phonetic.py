@@ -0,0 +1,38 @@
+# Phonetic keys and edit distance for fuzzy (misspelled) doctor name matching.
+
+
+# Soundex digit for each consonant; vowels (and Y) have none and H/W are skipped.
+SOUNDEX_CODES = {}
+for letters, code in (('BFPV', '1'), ('CGJKQSXZ', '2'), ('DT', '3'), ('L', '4'), ('MN', '5'), ('R', '6')):
+    for letter in letters:
+        SOUNDEX_CODES[letter] = code
+
+
+# American Soundex key of a name (SMITH, SMYTH and SMITHE are all S530), '' for a name without letters.
+def soundex(name):
+    letters = [c for c in (name or '').upper() if 'A' <= c <= 'Z']
+    if not letters:
+        return ''
+    key = letters[0]
+    last = SOUNDEX_CODES.get(letters[0], '')
+    for letter in letters[1:]:
+        code = SOUNDEX_CODES.get(letter, '')
+        if code and code != last:
+            key = key + code
+        # H and W do not separate letters with the same code, vowels do.
+        if letter not in 'HW':
+            last = code
+    return (key + '000')[:4]
+
+
+# Levenshtein edit distance between two strings.
+def levenshtein(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
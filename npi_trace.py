@@ -0,0 +1,113 @@
+# Per-request stage timings (normalize, sqlite, index, nppes, pecos, format), reported in a Server-Timing header
+# and, on request (?trace=1), as a trace payload tagged with the request ID.
+# The trace of the request being handled is kept per thread; bind() carries it over to lookup pool threads.
+import os
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+
+
+# Set NPI_TRACE=0 to turn stage timing off.
+TRACE_ENABLED = os.environ.get('NPI_TRACE', '1') == '1'
+
+# Trace of the request this thread is working for.
+local = threading.local()
+
+
+# Stage timings of one request. Stages run more than once (or on several threads) add up.
+class Trace:
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0.0, 0])
+            stage[0] = stage[0] + seconds
+            stage[1] = stage[1] + 1
+
+    # Server-Timing header value: each stage's total milliseconds and call count, then the total so far
+    # (for a streamed answer, only up to the start of streaming: see bind_stream for the rest).
+    def header(self, streamed=False):
+        with self.lock:
+            parts = ['%s;dur=%.2f;desc="%s calls"' % (name, seconds * 1000, count) for name, (seconds, count) in self.stages.items()]
+        if streamed:
+            parts.append('total;dur=%.2f;desc="until streaming started"' % ((time.perf_counter() - self.start) * 1000))
+        else:
+            parts.append('total;dur=%.2f' % ((time.perf_counter() - self.start) * 1000))
+        return ', '.join(parts)
+
+    def payload(self):
+        with self.lock:
+            stages = {name: {'ms': round(seconds * 1000, 2), 'calls': count} for name, (seconds, count) in self.stages.items()}
+        return {'request_id': self.request_id, 'total_ms': round((time.perf_counter() - self.start) * 1000, 2), 'stages': stages}
+
+
+# Start tracing a request on this thread; the request ID is the caller's (e.g. an X-Request-ID header) or a new one.
+def start(request_id=None):
+    trace = Trace(request_id or uuid.uuid4().hex[:16])
+    local.trace = trace if TRACE_ENABLED else None
+    return trace
+
+
+# Stop tracing on this thread, returning the finished trace (None if there was none).
+def finish():
+    trace = getattr(local, 'trace', None)
+    local.trace = None
+    return trace
+
+
+def current():
+    return getattr(local, 'trace', None)
+
+
+# Add seconds spent in a stage to the current trace (no-op outside a traced request).
+def add(name, seconds):
+    trace = getattr(local, 'trace', None)
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+# Time a block as a stage of the current trace.
+@contextmanager
+def stage(name):
+    st = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - st)
+
+
+# Wrap fn so that it runs with the calling thread's trace, for work handed to a thread pool.
+def bind(fn):
+    trace = current()
+    def run(*args, **kwargs):
+        previous = getattr(local, 'trace', None)
+        local.trace = trace
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            local.trace = previous
+    return run
+
+
+# Wrap a streamed response body so that it is produced with the calling thread's trace: the stages it runs
+# (after the response headers, and so the Server-Timing header, have gone out) still add up in the trace.
+def bind_stream(iterable):
+    trace = current()
+    def run():
+        iterator = iter(iterable)
+        while True:
+            previous = getattr(local, 'trace', None)
+            local.trace = trace
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                local.trace = previous
+            yield item
+    return run()
@@ -0,0 +1,206 @@
+# Upstream (NPPES/PECOS API) access shared by every route.
+import os
+import time
+import random
+import threading
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from npi_cache import TTLCache, MISS, shared_backend
+from npi_metrics import UPSTREAM_SECONDS, UPSTREAM_ERRORS
+import npi_trace
+
+
+# Consecutive failures before a breaker opens, and seconds it stays open before a probe is let through.
+BREAKER_THRESHOLD = int(os.environ.get('NPI_BREAKER_THRESHOLD', 5))
+BREAKER_COOLDOWN = float(os.environ.get('NPI_BREAKER_COOLDOWN', 30))
+
+# NPPES registry and PECOS data API endpoints.
+NPPES_URL = os.environ.get('NPPES_URL', "https://npiregistry.cms.hhs.gov/api/")
+PECOS_URL = os.environ.get('PECOS_URL', "https://data.cms.gov/data-api/v1/dataset/0824b6d0-14ad-47a0-94e2-f317a3658317/data")
+
+# Connect/read timeouts (seconds), kept-alive connections per host, and retries (with jittered backoff) per call.
+CONNECT_TIMEOUT = float(os.environ.get('NPI_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('NPI_READ_TIMEOUT', 10))
+POOL_SIZE = int(os.environ.get('NPI_POOL_SIZE', 16))
+RETRIES = int(os.environ.get('NPI_RETRIES', 2))
+RETRY_BACKOFF = float(os.environ.get('NPI_RETRY_BACKOFF', 0.25))
+
+# HTTP statuses worth retrying.
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Seconds NPPES records and PECOS DME flags stay cached, and how many NPIs each cache holds.
+NPPES_TTL = float(os.environ.get('NPI_NPPES_TTL', 24 * 3600))
+PECOS_TTL = float(os.environ.get('NPI_PECOS_TTL', 6 * 3600))
+CACHE_SIZE = int(os.environ.get('NPI_CACHE_SIZE', 20000))
+
+
+# Raised instead of calling an upstream whose breaker is open.
+# It is a RequestException so callers fall back to local data exactly as they do for a real failure.
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+# Raised for an upstream answer that is not what the API sends (a body that is not JSON, or JSON of the wrong shape).
+# It is a RequestException so it counts as an outage of that API and callers fall back to local data.
+class UpstreamError(requests.exceptions.RequestException):
+    pass
+
+
+# Process-wide circuit breaker for one upstream API.
+# CLOSED: calls go through. OPEN: calls are refused until the cooldown is over.
+# HALF-OPEN: one probe call goes through; success closes the breaker, failure opens it again.
+class CircuitBreaker:
+    def __init__(self, name, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = 'CLOSED'
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    # True if a call may go upstream now.
+    def allow(self):
+        with self.lock:
+            if self.state == 'CLOSED':
+                return True
+            if self.state == 'OPEN' and time.time() - self.opened_at >= self.cooldown:
+                self.state = 'HALF-OPEN'
+                self.probing = False
+            if self.state == 'HALF-OPEN' and not self.probing:
+                self.probing = True
+                logging.info('%s breaker half-open, probing', self.name)
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            if self.state != 'CLOSED':
+                print("-- " + self.name + " API BACK UP --")
+                logging.info('%s breaker closed', self.name)
+            self.state = 'CLOSED'
+            self.failures = 0
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures = self.failures + 1
+            if self.state == 'HALF-OPEN' or (self.state == 'CLOSED' and self.failures >= self.threshold):
+                print("-- " + self.name + " API DOWN: using local data for " + str(self.cooldown) + " seconds --")
+                logging.warning('%s breaker opened after %s failures', self.name, self.failures)
+                self.state = 'OPEN'
+                self.opened_at = time.time()
+                self.probing = False
+
+    # Run fn through the breaker: refuse while open, record the outcome (and its latency) otherwise.
+    def call(self, fn, *args, **kwargs):
+        if not self.allow():
+            UPSTREAM_ERRORS.inc(upstream=self.name, reason='circuit_open')
+            raise CircuitOpenError(self.name + " API circuit open")
+        st = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except requests.exceptions.RequestException:
+            self.timed(st)
+            UPSTREAM_ERRORS.inc(upstream=self.name, reason='error')
+            self.failure()
+            raise
+        except Exception:
+            # Not an outage (e.g. NPPES rejected the search), the API did answer.
+            self.timed(st)
+            self.success()
+            raise
+        self.timed(st)
+        self.success()
+        return result
+
+    # Record the latency of a call started at st for /metrics and the request's trace.
+    def timed(self, st):
+        elapsed = time.perf_counter() - st
+        UPSTREAM_SECONDS.observe(elapsed, upstream=self.name)
+        npi_trace.add(self.name.lower(), elapsed)
+
+
+nppes_breaker = CircuitBreaker('NPPES')
+pecos_breaker = CircuitBreaker('PECOS')
+
+# NPI keyed caches shared by every route.
+nppes_cache = TTLCache('nppes', CACHE_SIZE, NPPES_TTL, shared_backend)
+pecos_cache = TTLCache('pecos', CACHE_SIZE, PECOS_TTL, shared_backend)
+
+# Shared keep-alive session: one connection pool per upstream host, reused by every request thread.
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE))
+session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE))
+
+
+# NPPES record for one NPI, from the cache when possible.
+# Returns a registry response ({'result_count': n, 'results': [...]}) like nppes_search().
+def nppes_lookup(npinumber):
+    response = nppes_cache.get(int(npinumber))
+    if response is MISS:
+        response = nppes_search(search_params={'number': npinumber})
+    return response
+
+
+# NPPES API search, guarded by the NPPES breaker.
+# Returns the registry response ({'result_count': n, 'results': [...]}); every record returned is cached by NPI.
+def nppes_search(search_params, limit=None, skip=None):
+    params = dict(search_params, version='2.1')
+    if limit is not None:
+        params['limit'] = limit
+    if skip is not None:
+        params['skip'] = skip
+    response = nppes_breaker.call(get_nppes_response, NPPES_URL, params, None)
+    # NPPES rejected the search (e.g. bad criteria): nothing found rather than an outage.
+    if 'Errors' in response:
+        logging.error('NPPES search %s rejected: %s', search_params, response['Errors'])
+        return {'result_count': 0, 'results': []}
+    for result in response.get('results', []):
+        nppes_cache.set(int(result['number']), {'result_count': 1, 'results': [result]})
+    return response
+
+
+# PECOS data API query, guarded by the PECOS breaker. Returns the decoded JSON rows.
+def pecos_get(params, headers):
+    return pecos_breaker.call(get_pecos_rows, PECOS_URL, params, headers)
+
+
+# NPPES registry response ({'result_count': n, 'results': [...]}, or {'Errors': [...]} for a rejected search) from the
+# registry API; any other answer is an UpstreamError.
+def get_nppes_response(url, params, headers):
+    response = get_json(url, params, headers)
+    if not isinstance(response, dict) or ('Errors' not in response and not (isinstance(response.get('result_count'), int) and isinstance(response.get('results'), list))):
+        raise UpstreamError("Unexpected NPPES answer: " + str(response)[:200])
+    return response
+
+
+# PECOS rows ([{'NPI': ..., 'DME': ...}, ...]) from the data API; any other answer (e.g. an error object) is an
+# UpstreamError.
+def get_pecos_rows(url, params, headers):
+    rows = get_json(url, params, headers)
+    if not isinstance(rows, list) or not all(isinstance(row, dict) and 'NPI' in row for row in rows):
+        raise UpstreamError("Unexpected PECOS answer: " + str(rows)[:200])
+    return rows
+
+
+# GET helper on the shared session returning the decoded JSON body; a body that is not JSON is an UpstreamError.
+# Connection errors, timeouts and RETRY_STATUS answers are retried RETRIES times with jittered exponential backoff.
+def get_json(url, params, headers):
+    attempt = 0
+    while True:
+        try:
+            response = session.get(url, params=params, headers=headers, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            if response.status_code not in RETRY_STATUS or attempt >= RETRIES:
+                response.raise_for_status()
+                try:
+                    return response.json()
+                except ValueError:
+                    raise UpstreamError("Answer from " + url + " is not JSON: " + response.text[:200], response=response)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt >= RETRIES:
+                raise
+        time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+        attempt = attempt + 1
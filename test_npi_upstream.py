@@ -0,0 +1,95 @@
+# Upstream answers that are not JSON: the breaker counts them as failures and the routes fall back to local data.
+#   python -m pytest -q test_npi_upstream.py
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# One-provider database for the local fallback, set up before the app modules read NPI_DB.
+work_dir = tempfile.TemporaryDirectory()
+os.environ['NPI_DB'] = os.path.join(work_dir.name, 'npi.db')
+os.environ['NPI_SHARED_CACHE_DB'] = ''
+os.environ['NPI_LOG_FILE'] = os.path.join(work_dir.name, 'npi.log')
+
+import requests
+import npi_upstream
+import npi_app
+from npi_db import LOOKUP_COLUMNS
+
+
+NPI = 1234567893
+
+
+# Answers every GET with a 200 HTML page, like a proxy or maintenance page in front of the API.
+class HTMLHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = b"<html><body>Service temporarily unavailable</body></html>"
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class NonJSONAnswerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        conn = sqlite3.connect(os.environ['NPI_DB'])
+        conn.execute("CREATE TABLE npi_lookup (" + ", ".join(name + (" INTEGER" if name == 'npi' else " TEXT") for name, column in LOOKUP_COLUMNS) + ")")
+        row = dict.fromkeys((name for name, column in LOOKUP_COLUMNS), '')
+        row.update(npi=NPI, first_name='JANE', last_name='SMITH', mail_state='PA', practice_state='PA')
+        conn.execute("INSERT INTO npi_lookup VALUES (" + ", ".join("?" * len(row)) + ")", [row[name] for name, column in LOOKUP_COLUMNS])
+        conn.execute("CREATE TABLE pecos ([NPI] INTEGER, [DME] TEXT)")
+        conn.execute("INSERT INTO pecos VALUES (?, 'Y')", (NPI,))
+        conn.commit()
+        conn.close()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), HTMLHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%s/' % cls.server.server_address[1]
+        cls.urls = (npi_upstream.NPPES_URL, npi_upstream.PECOS_URL)
+        npi_upstream.NPPES_URL = url + 'api/'
+        npi_upstream.PECOS_URL = url + 'data'
+
+    @classmethod
+    def tearDownClass(cls):
+        npi_upstream.NPPES_URL, npi_upstream.PECOS_URL = cls.urls
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        for breaker in (npi_upstream.nppes_breaker, npi_upstream.pecos_breaker):
+            breaker.success()
+        npi_upstream.nppes_cache.clear()
+        npi_upstream.pecos_cache.clear()
+
+    def test_get_json_raises_upstream_error(self):
+        with self.assertRaises(npi_upstream.UpstreamError) as raised:
+            npi_upstream.get_json(npi_upstream.NPPES_URL, {'number': NPI}, None)
+        self.assertIsInstance(raised.exception, requests.exceptions.RequestException)
+
+    def test_breakers_count_failures(self):
+        with self.assertRaises(requests.exceptions.RequestException):
+            npi_upstream.nppes_lookup(NPI)
+        with self.assertRaises(requests.exceptions.RequestException):
+            npi_upstream.pecos_get([('column', 'DME,NPI')], None)
+        self.assertEqual(npi_upstream.nppes_breaker.failures, 1)
+        self.assertEqual(npi_upstream.pecos_breaker.failures, 1)
+
+    def test_routes_fall_back_to_local_data(self):
+        client = npi_app.npi_app.test_client()
+        response = client.get('/api/v1/npi/%s' % NPI)
+        self.assertEqual(response.status_code, 200)
+        record = response.get_json()['results'][0]
+        self.assertEqual((record['npi'], record['source'], record['dme']), (NPI, 'local', True))
+        response = client.post('/npi_check', data={'NPINUMBER': str(NPI)})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(str(NPI), response.get_data(as_text=True))
+
+
+if __name__ == '__main__':
+    unittest.main()